@@ -0,0 +1,6 @@
+import testutil
+from testutil import make_client
+
+
+def make_server(*args):
+    return testutil.make_server("--max-sendq=%d" % 2 ** 30, *args)
@@ -0,0 +1,73 @@
+import gc
+import sys
+import time
+
+from benchmarks import make_server, make_client
+
+
+MEMBERS = 500
+MESSAGES = 200
+TEXTS = [
+    "did anybody see the deploy notes for today?",
+    "the build is green again, thanks",
+    "lunch at noon? the usual place",
+    "I pushed the fix for the flaky test, please review",
+    "meeting moved to 15:30",
+]
+
+
+def run(mode):
+    server = make_server()
+    pairs = [make_client(server, "member%d" % i) for i in range(MEMBERS)]
+    channel = server.get_channel("#bench")
+    for (client, peer) in pairs:
+        peer.setblocking(False)
+        if mode != "plain":
+            client.data_received(b"COMPRESS DEFLATE OUT\r\n")
+        if mode == "deflate-diverged":
+            client.data_received(b"PING :%d\r\n" % id(client))
+        channel.add_member(client)
+        client.channels[channel.folded_name] = channel
+    drain(pairs)
+    sender = pairs[0][0]
+    received = 0
+    gc.disable()
+    start = time.process_time()
+    for i in range(MESSAGES):
+        sender.message_channel(channel, "SENDMSG", "#bench :%s (%d)" % (TEXTS[i % len(TEXTS)], i))
+        server.fanout.drain()
+        received += drain(pairs)
+    elapsed = time.process_time() - start
+    gc.enable()
+    for (client, peer) in pairs:
+        client.connection.close()
+        peer.close()
+    return (received, elapsed)
+
+
+def drain(pairs):
+    total = 0
+    for (client, peer) in pairs:
+        while client.has_output():
+            client.socket_writable_notification()
+            try:
+                while True:
+                    total += len(peer.recv(2 ** 20))
+            except BlockingIOError:
+                pass
+    return total
+
+
+def main(argv):
+    print("%-17s %14s %10s %14s %16s" % ("mode", "bytes/member", "saved", "cpu us/msg", "cpu us/KB saved"))
+    (plain_bytes, plain_cpu) = run("plain")
+    for mode in ("plain", "deflate-shared", "deflate-diverged"):
+        (received, cpu) = run(mode) if mode != "plain" else (plain_bytes, plain_cpu)
+        saved = plain_bytes - received
+        cost = (cpu - plain_cpu) * 1e6 / (saved / 1024.0) if saved > 0 else 0
+        print("%-17s %14.0f %9.1f%% %14.1f %16.2f" % (
+            mode, received / float(MEMBERS - 1), 100.0 * saved / plain_bytes, cpu * 1e6 / MESSAGES, cost))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
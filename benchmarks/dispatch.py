@@ -0,0 +1,108 @@
+import sys
+import timeit
+
+import chat
+from benchmarks import make_server, make_client
+
+
+LINES = [
+    "PING :benchmark",
+    "PONG :benchmark",
+    "LUSERS",
+    "NAMES #bench",
+    "SENDMSG peer :hello there",
+    "SENDMSG #bench :hello channel",
+    "BOGUS argument",
+]
+NUMBER = 20000
+
+
+def parse_line(line):
+    x = line.split(" ", 1)
+    command = x[0].upper()
+    if len(x) == 1:
+        arguments = []
+    else:
+        if len(x[1]) > 0 and x[1][0] == ":":
+            arguments = [x[1][1:]]
+        else:
+            y = x[1].split(" :", 1)
+            arguments = y[0].split()
+            if len(y) == 2:
+                arguments.append(y[1])
+    return (command, arguments)
+
+
+def closure_dispatch(client, line):
+    (command, arguments) = parse_line(line)
+    message = chat.Message(command, arguments)
+
+    def join_handler():
+        client.join_handler(message)
+
+    def list_handler():
+        client.list_handler(message)
+
+    def list_users_handler():
+        client.list_users_handler(message)
+
+    def names_handler():
+        client.names_handler(message)
+
+    def nick_handler():
+        client.nick_handler(message)
+
+    def send_message_handler():
+        client.send_message_handler(message)
+
+    def ping_handler():
+        client.ping_handler(message)
+
+    def pong_handler():
+        client.pong_handler(message)
+
+    def quit_handler():
+        client.quit_handler(message)
+
+    handler_table = {
+        "JOIN": join_handler,
+        "LIST": list_handler,
+        "LUSERS": list_users_handler,
+        "NAMES": names_handler,
+        "NICK": nick_handler,
+        "SENDMSG": send_message_handler,
+        "PING": ping_handler,
+        "PONG": pong_handler,
+        "SENDMSGP": send_message_handler,
+        "QUIT": quit_handler,
+    }
+
+    try:
+        handler_table[command]()
+    except KeyError:
+        client.reply("421 %s %s :Unknown command" % (client.nickname, command))
+
+
+def compiled_dispatch(client, line):
+    client.dispatch(chat.parse_message(line))
+
+
+def measure(dispatch, line):
+    server = make_server()
+    (client, _) = make_client(server, "bench")
+    (peer, _) = make_client(server, "peer")
+    client.dispatch(chat.Message("JOIN", ["#bench"]))
+    peer.dispatch(chat.Message("JOIN", ["#bench"]))
+    return min(timeit.repeat(lambda: dispatch(client, line), number=NUMBER, repeat=3)) / NUMBER
+
+
+def main(argv):
+    print("%-30s %12s %12s %8s" % ("command", "closures ns", "compiled ns", "speedup"))
+    for line in LINES:
+        old = measure(closure_dispatch, line)
+        new = measure(compiled_dispatch, line)
+        print("%-30s %12.0f %12.0f %7.2fx" % (line, old * 1e9, new * 1e9, old / new))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
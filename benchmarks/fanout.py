@@ -0,0 +1,86 @@
+import gc
+import sys
+import time
+
+from benchmarks import make_server, make_client
+
+
+MEMBER_COUNTS = [10, 100, 1000, 5000]
+MESSAGES = 200
+STALL_MESSAGES = 20
+
+
+def encode_once(sender, channel, command, message):
+    sender.message_channel(channel, command, message)
+    sender.server.fanout.drain()
+
+
+def per_member_encode(sender, channel, command, message):
+    line = ":%s %s %s" % (sender.prefix, command, message)
+    for client in channel.clients:
+        if client is not sender:
+            client.message(line)
+
+
+def measure(fanout, members, *args):
+    server = make_server(*args)
+    pairs = [make_client(server, "user%d" % i) for i in range(members)]
+    clients = [client for (client, peer) in pairs]
+    channel = server.get_channel("#bench")
+    for client in clients:
+        channel.add_member(client)
+    sender = clients[0]
+    gc.disable()
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        fanout(sender, channel, "SENDMSG", "#bench :message number %d with some typical chat text" % i)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    for (client, peer) in pairs:
+        peer.close()
+        client.connection.close()
+    return elapsed / MESSAGES
+
+
+def longest_stall(members, *args):
+    server = make_server(*args)
+    pairs = [make_client(server, "user%d" % i) for i in range(members)]
+    channel = server.get_channel("#bench")
+    for (client, peer) in pairs:
+        channel.add_member(client)
+    sender = pairs[0][0]
+    sender.message_channel(channel, "SENDMSG", "#bench :warm up")
+    server.fanout.drain()
+    stalls = []
+    gc.disable()
+    for i in range(STALL_MESSAGES):
+        start = time.perf_counter()
+        sender.message_channel(channel, "SENDMSG", "#bench :message number %d with some typical chat text" % i)
+        stalls.append(time.perf_counter() - start)
+        while server.tasks:
+            start = time.perf_counter()
+            server.run_tasks()
+            stalls.append(time.perf_counter() - start)
+    gc.enable()
+    for (client, peer) in pairs:
+        peer.close()
+        client.connection.close()
+    return max(stalls)
+
+
+def main(argv):
+    print("%8s %16s %16s %14s" % ("members", "encode-once us", "per-member us", "ns/member"))
+    for members in MEMBER_COUNTS:
+        once = measure(encode_once, members)
+        each = measure(per_member_encode, members)
+        print("%8d %16.1f %16.1f %14.1f" % (members, once * 1e6, each * 1e6, once * 1e9 / members))
+    print()
+    print("%8s %18s %18s" % ("members", "inline stall us", "sliced stall us"))
+    for members in MEMBER_COUNTS:
+        inline = longest_stall(members, "--fanout-threshold=%d" % members)
+        sliced = longest_stall(members)
+        print("%8d %18.1f %18.1f" % (members, inline * 1e6, sliced * 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import subprocess
+
+from optparse import OptionParser
+
+from benchmarks.memory import ROOT, raise_file_limit, rss
+
+
+SCENARIOS = ["registration", "join", "pingpong", "fanout"]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class ServerProcess(object):
+
+    def __init__(self, port, args):
+        self.port = port
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "chat.py"), "--listen=127.0.0.1", "--ports=%d" % port, "--flood-rate=0"] + args,
+            stdout=subprocess.DEVNULL, preexec_fn=raise_file_limit)
+        for _ in range(500):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                return
+            except socket.error:
+                time.sleep(0.01)
+        self.stop()
+        raise RuntimeError("server did not start on port %d" % port)
+
+    def cpu_seconds(self):
+        with open("/proc/%d/stat" % self.process.pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+    def rss(self):
+        return rss(self.process.pid)
+
+    def peak_rss(self):
+        with open("/proc/%d/status" % self.process.pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Network(object):
+
+    def __init__(self, port, args, nodes):
+        self.servers = []
+        try:
+            for i in range(nodes):
+                node_args = ["--server-name=node%d.bench" % i, "--link-password=bench", "--link-listen=127.0.0.1:%d" % (port + nodes + i)]
+                if i:
+                    node_args.append("--link=127.0.0.1:%d" % (port + nodes + i - 1))
+                self.servers.append(ServerProcess(port + i, node_args + args))
+        except RuntimeError:
+            self.stop()
+            raise
+        time.sleep(0.5)
+
+    def cpu_seconds(self):
+        return sum(x.cpu_seconds() for x in self.servers)
+
+    def rss(self):
+        return sum(x.rss() for x in self.servers)
+
+    def peak_rss(self):
+        return sum(x.peak_rss() for x in self.servers)
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+
+class LoadClient(object):
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port):
+        (self.reader, self.writer) = await asyncio.open_connection("127.0.0.1", port, limit=2 ** 16)
+
+    def send(self, line):
+        self.writer.write((line + "\r\n").encode())
+
+    async def read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("%s: connection closed by server" % self.nickname)
+        return line
+
+    async def read_until(self, token):
+        while True:
+            line = await self.read_line()
+            if token in line:
+                return line
+
+    async def register(self):
+        self.send("NICK %s" % self.nickname)
+        self.send("USER %s * * :%s" % (self.nickname, self.nickname))
+        await self.read_until(b" 251 ")
+
+    async def join(self, channel_name):
+        self.send("JOIN %s" % channel_name)
+        await self.read_until(b" 366 ")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_clients(options, count, prefix, latencies=None):
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def connect(i):
+        client = LoadClient("%s%d" % (prefix, i))
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.connect(options.port + i % options.nodes)
+                await client.register()
+            except (ConnectionError, OSError):
+                options.errors += 1
+                client.close()
+                return None
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+        return client
+    return [x for x in await asyncio.gather(*(connect(i) for i in range(count))) if x is not None]
+
+
+async def registration_scenario(options, clients):
+    latencies = []
+    yield
+    clients.extend(await connect_clients(options, options.clients, "reg", latencies))
+    yield (len(clients), latencies)
+
+
+async def join_scenario(options, clients):
+    clients.extend(await connect_clients(options, options.clients, "join"))
+    latencies = []
+
+    async def join(client):
+        start = time.perf_counter()
+        await client.join("#storm")
+        latencies.append(time.perf_counter() - start)
+    yield
+    await asyncio.gather(*(join(x) for x in clients))
+    yield (len(clients), latencies)
+
+
+async def pingpong_scenario(options, clients):
+    clients.extend(await connect_clients(options, 2 * options.pairs, "pp"))
+    latencies = []
+
+    async def play(a, b, rounds):
+        for i in range(rounds):
+            a.send("SENDMSG %s :%d" % (b.nickname, time.perf_counter_ns()))
+            line = await b.read_until(b" SENDMSG ")
+            latencies.append((time.perf_counter_ns() - int(line.rsplit(b":", 1)[1])) / 1e9)
+            b.send("SENDMSG %s :%d" % (a.nickname, time.perf_counter_ns()))
+            line = await a.read_until(b" SENDMSG ")
+            latencies.append((time.perf_counter_ns() - int(line.rsplit(b":", 1)[1])) / 1e9)
+    yield
+    await asyncio.gather(*(play(clients[i], clients[i + 1], options.rounds) for i in range(0, len(clients) - 1, 2)))
+    yield (len(latencies), latencies)
+
+
+async def fanout_scenario(options, clients):
+    clients.extend(await connect_clients(options, options.members + 1, "fan"))
+    sender = clients[0]
+    members = clients[1:]
+    await asyncio.gather(*(x.join("#fanout") for x in clients))
+    if options.nodes > 1:
+        await asyncio.sleep(0.5)
+    latencies = []
+
+    async def receive(client):
+        for _ in range(options.messages):
+            line = await client.read_until(b" SENDMSG #fanout :")
+            latencies.append((time.perf_counter_ns() - int(line.rsplit(b" ", 1)[1])) / 1e9)
+
+    async def send():
+        interval = 1.0 / options.rate if options.rate else 0
+        for i in range(options.messages):
+            sender.send("SENDMSG #fanout :%d %d" % (i, time.perf_counter_ns()))
+            await sender.writer.drain()
+            await asyncio.sleep(interval)
+    yield
+    await asyncio.gather(send(), *(receive(x) for x in members))
+    yield (len(latencies), latencies)
+
+
+async def run_measured(scenario, options, server, clients):
+    options.errors = 0
+    steps = scenario(options, clients)
+    await steps.__anext__()
+    cpu = server.cpu_seconds()
+    start = time.perf_counter()
+    (messages, latencies) = await steps.__anext__()
+    elapsed = time.perf_counter() - start
+    cpu = server.cpu_seconds() - cpu
+    latencies.sort()
+    return {
+        "messages": messages,
+        "connect_errors": options.errors,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": messages / elapsed if elapsed else None,
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+        "server": {
+            "cpu_seconds": cpu,
+            "cpu_percent": 100 * cpu / elapsed if elapsed else None,
+            "rss_bytes": server.rss(),
+            "peak_rss_bytes": server.peak_rss(),
+        },
+    }
+
+
+def run_scenario(name, options):
+    scenario = {
+        "registration": registration_scenario,
+        "join": join_scenario,
+        "pingpong": pingpong_scenario,
+        "fanout": fanout_scenario,
+    }[name]
+    if options.nodes > 1:
+        server = Network(options.port, options.server_args.split(), options.nodes)
+    else:
+        server = ServerProcess(options.port, options.server_args.split())
+    clients = []
+
+    async def main():
+        try:
+            return await asyncio.wait_for(run_measured(scenario, options, server, clients), options.timeout)
+        finally:
+            for client in clients:
+                client.close()
+    try:
+        return asyncio.run(main())
+    finally:
+        server.stop()
+
+
+def server_version():
+    output = subprocess.check_output([sys.executable, os.path.join(ROOT, "chat.py"), "--version"])
+    return output.decode().strip()
+
+
+def main(argv):
+    op = OptionParser(usage="%prog [options] [scenario ...]", description="Generate load against a local chat server. Scenarios: %s." % ", ".join(SCENARIOS))
+    op.add_option("--port", metavar="X", type="int", default=16668, help="run the server on port X (default: %default)")
+    op.add_option("--nodes", metavar="N", type="int", default=1, help="run N linked servers on consecutive ports and spread the clients over them (default: %default)")
+    op.add_option("--server-args", metavar="X", default="", help="extra arguments passed to chat.py")
+    op.add_option("--clients", metavar="N", type="int", default=1000, help="clients in the registration and join storms (default: %default)")
+    op.add_option("--concurrency", metavar="N", type="int", default=200, help="connect at most N clients at a time (default: %default)")
+    op.add_option("--pairs", metavar="N", type="int", default=100, help="client pairs in the ping-pong scenario (default: %default)")
+    op.add_option("--rounds", metavar="N", type="int", default=100, help="round trips per ping-pong pair (default: %default)")
+    op.add_option("--members", metavar="N", type="int", default=1000, help="channel members in the fanout scenario (default: %default)")
+    op.add_option("--messages", metavar="N", type="int", default=100, help="messages sent in the fanout scenario (default: %default)")
+    op.add_option("--rate", metavar="X", type="float", default=0, help="send fanout messages at X per second, 0 for as fast as possible (default: %default)")
+    op.add_option("--timeout", metavar="X", type="float", default=300, help="give up on a scenario after X seconds (default: %default)")
+    op.add_option("--output", metavar="FILE", default="load-results.json", help="write results as JSON to FILE (default: %default)")
+    (options, args) = op.parse_args(argv[1:])
+    for name in args:
+        if name not in SCENARIOS:
+            op.error("Unknown scenario: %r" % name)
+
+    raise_file_limit()
+    results = {
+        "version": server_version(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "server_args": options.server_args,
+        "parameters": {
+            "clients": options.clients,
+            "pairs": options.pairs,
+            "rounds": options.rounds,
+            "members": options.members,
+            "messages": options.messages,
+            "rate": options.rate,
+            "nodes": options.nodes,
+        },
+        "scenarios": {},
+    }
+    for name in args or SCENARIOS:
+        result = run_scenario(name, options)
+        results["scenarios"][name] = result
+        latency = result["latency_seconds"]
+        print("%-13s %10.0f msg/s  p50 %8.2f ms  p99 %8.2f ms  p999 %8.2f ms  cpu %5.1f%%  rss %6.1f MiB  connect errors %d" % (
+            name, result["messages_per_second"], latency["p50"] * 1e3, latency["p99"] * 1e3, latency["p999"] * 1e3,
+            result["server"]["cpu_percent"], result["server"]["rss_bytes"] / 2.0 ** 20, result["connect_errors"]))
+
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s." % options.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
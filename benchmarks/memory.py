@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import socket
+import resource
+import subprocess
+
+from optparse import OptionParser
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def raise_file_limit():
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not available for pid %d" % pid)
+
+
+def connect(port, nickname):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(("NICK %s\r\nUSER %s * * :%s\r\n" % (nickname, nickname, nickname)).encode())
+    data = b""
+    while b" 251 " not in data:
+        chunk = s.recv(4096)
+        if not chunk:
+            raise RuntimeError("server closed the connection of %s" % nickname)
+        data += chunk
+    return s
+
+
+def wait_for_server(port):
+    for _ in range(500):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            time.sleep(0.01)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+def main(argv):
+    op = OptionParser(description="Measure server memory per idle registered connection.")
+    op.add_option("--connections", metavar="N", type="int", default=5000, help="open N connections (default: %default)")
+    op.add_option("--port", metavar="X", type="int", default=16667, help="run the server on port X (default: %default)")
+    op.add_option("--server-args", metavar="X", default="", help="extra arguments passed to chat.py")
+    (options, args) = op.parse_args(argv[1:])
+
+    raise_file_limit()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "chat.py"), "--listen=127.0.0.1", "--ports=%d" % options.port] + options.server_args.split(),
+        preexec_fn=raise_file_limit)
+    connections = []
+    try:
+        wait_for_server(options.port)
+        connections.append(connect(options.port, "warmup"))
+        time.sleep(0.5)
+        before = rss(server.pid)
+        for i in range(options.connections):
+            connections.append(connect(options.port, "idle%d" % i))
+        time.sleep(0.5)
+        after = rss(server.pid)
+    finally:
+        for s in connections:
+            s.close()
+        server.terminate()
+        server.wait()
+
+    print("connections:         %d" % options.connections)
+    print("server RSS before:   %.1f MiB" % (before / 2.0 ** 20))
+    print("server RSS after:    %.1f MiB" % (after / 2.0 ** 20))
+    print("bytes per connection: %.0f" % ((after - before) / float(options.connections)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
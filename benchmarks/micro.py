@@ -0,0 +1,219 @@
+import os
+import gc
+import sys
+import re
+import json
+import time
+
+from optparse import OptionParser
+
+import chat
+from framing import LineFramer
+from casemapping import CaseMapping
+from benchmarks import make_server, make_client
+from benchmarks.memory import raise_file_limit
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+TRAFFIC = (
+    b"PING :irc.example.org\r\n"
+    b"SENDMSG #lobby :hey, did anybody see the deploy notes for today?\r\n"
+    b"SENDMSG friend :lunch at noon?\r\n"
+    b"SENDMSG #lobby :\xd0\xbf\xd1\x80\xd0\xb8\xd0\xb2\xd1\x96\xd1\x82 \xd1\x83\xd1\x81\xd1\x96\xd0\xbc\r\n"
+    b"PONG :irc.example.org\r\n"
+    b"NAMES #lobby\r\n"
+    b"SENDMSG #lobby :ok\r\n"
+    b"LUSERS\r\n"
+)
+TRAFFIC_LINES = TRAFFIC.count(b"\n")
+
+
+class Fixture(object):
+
+    def __init__(self, members=0, channel_name="#lobby"):
+        self.server = make_server()
+        self.pairs = [make_client(self.server, "member%d" % i) for i in range(members + 1)]
+        self.client = self.pairs[0][0]
+        self.channel = self.server.get_channel(channel_name)
+        for (client, peer) in self.pairs:
+            peer.setblocking(False)
+            self.channel.add_member(client)
+            client.channels[self.channel.folded_name] = self.channel
+        self.drain()
+
+    def drain(self):
+        for (client, peer) in self.pairs:
+            while client.write_queue_size():
+                client.socket_writable_notification()
+                try:
+                    while peer.recv(2 ** 20):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def close(self):
+        for (client, peer) in self.pairs:
+            client.connection.close()
+            peer.close()
+
+
+CALIBRATION_TABLE = {"lobby": 1, "friend": 2}
+CALIBRATION_PATTERN = re.compile(r"[a-z]+[0-9]*\Z")
+
+
+def calibration_loop(number):
+    table = CALIBRATION_TABLE
+    match = CALIBRATION_PATTERN.match
+    start = time.perf_counter()
+    for i in range(number):
+        text = "member%d" % i
+        table.get(text)
+        match(text)
+        text.upper().split("E")
+    return (time.perf_counter() - start) / number
+
+
+def measure(function, number, repeat=9, reset=None):
+    ratios = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            if reset is not None:
+                reset()
+            unit = calibration_loop(2000)
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            elapsed = (time.perf_counter() - start) / number
+            ratios.append(elapsed / min(unit, calibration_loop(2000)))
+    finally:
+        gc.enable()
+    ratios.sort()
+    return ratios[len(ratios) // 2]
+
+
+def calibrate():
+    gc.disable()
+    try:
+        return min(calibration_loop(20000) for _ in range(5))
+    finally:
+        gc.enable()
+
+
+def bench_fold():
+    fold = CaseMapping("rfc1459").fold
+    return measure(lambda: fold("Some[Nick]^"), 100000)
+
+
+def bench_framing():
+    def run():
+        for line in LineFramer().feed(TRAFFIC):
+            chat.parse_message(line)
+    return measure(run, 10000) / TRAFFIC_LINES
+
+
+def bench_data_received():
+    fixture = Fixture(members=20)
+    make_client(fixture.server, "friend")
+    try:
+        return measure(lambda: fixture.client.data_received(TRAFFIC), 200, reset=fixture.drain) / TRAFFIC_LINES
+    finally:
+        fixture.close()
+
+
+def bench_names():
+    fixture = Fixture(members=5000, channel_name="#big")
+    message = chat.Message("NAMES", ["#big"])
+    try:
+        return measure(lambda: fixture.client.names_handler(message), 20, reset=fixture.drain)
+    finally:
+        fixture.close()
+
+
+def bench_fanout():
+    fixture = Fixture(members=1000)
+
+    def fanout():
+        fixture.client.message_channel(fixture.channel, "SENDMSG", "#lobby :hello everyone")
+        fixture.server.fanout.drain()
+    try:
+        return measure(fanout, 50, reset=fixture.drain)
+    finally:
+        fixture.close()
+
+
+def bench_nickname_validation():
+    match = chat.Client._Client__validate_nickname_regexp.match
+    return measure(lambda: match("Some_Nick[away]"), 100000)
+
+
+def bench_idle_poll():
+    fixture = Fixture(members=1000)
+    try:
+        return measure(lambda: fixture.server.engine.poll(0), 200)
+    finally:
+        fixture.close()
+
+
+BENCHMARKS = [
+    ("casemapping.fold", bench_fold),
+    ("framing.parse_line", bench_framing),
+    ("client.data_received_line", bench_data_received),
+    ("names.5000_members", bench_names),
+    ("message_channel.1000_members", bench_fanout),
+    ("nickname.validate", bench_nickname_validation),
+    ("engine.poll.1000_idle", bench_idle_poll),
+]
+
+
+def main(argv):
+    op = OptionParser(usage="%prog [options] [benchmark ...]", description="Run in-process microbenchmarks of the server's hot paths and compare them with stored baselines.")
+    op.add_option("--baseline", metavar="FILE", default=BASELINE, help="read baselines from FILE (default: benchmarks/baseline.json)")
+    op.add_option("--threshold", metavar="X", type="float", default=1.3, help="fail when a benchmark is more than X times slower than its baseline; both are measured relative to a calibration loop timed alongside them (default: %default)")
+    op.add_option("--update-baseline", action="store_true", help="store the measured numbers as the new baseline")
+    (options, args) = op.parse_args(argv[1:])
+    names = [name for (name, _) in BENCHMARKS]
+    for name in args:
+        if name not in names:
+            op.error("Unknown benchmark: %r (known: %s)" % (name, ", ".join(names)))
+
+    raise_file_limit()
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError):
+        baseline = {}
+
+    unit = calibrate()
+    print("Calibration loop: %.0f ns; results are in calibration units." % (unit * 1e9))
+    failed = []
+    print("%-30s %10s %10s %8s %12s" % ("benchmark", "units", "baseline", "ratio", "~ns/op"))
+    for (name, function) in BENCHMARKS:
+        if args and name not in args:
+            continue
+        result = function()
+        reference = baseline.get(name)
+        if reference:
+            ratio = result / reference
+            status = "" if ratio <= options.threshold else "  REGRESSION"
+            print("%-30s %10.2f %10.2f %7.2fx %12.0f%s" % (name, result, reference, ratio, result * unit * 1e9, status))
+            if status:
+                failed.append(name)
+        else:
+            print("%-30s %10.2f %10s %8s %12.0f" % (name, result, "-", "-", result * unit * 1e9))
+        if options.update_baseline:
+            baseline[name] = round(result, 3)
+
+    if options.update_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to %s." % options.baseline)
+    elif failed:
+        print("%d benchmark(s) slower than %.2fx their baseline: %s" % (len(failed), options.threshold, ", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
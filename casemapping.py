@@ -0,0 +1,21 @@
+import string
+
+
+CASEMAPPINGS = {
+    "ascii": ("", ""),
+    "rfc1459": ("[]\\^", "{}|~"),
+    "strict-rfc1459": ("[]\\", "{}|"),
+}
+
+
+class CaseMapping(object):
+
+    def __init__(self, name="rfc1459"):
+        if name not in CASEMAPPINGS:
+            raise ValueError("Unsupported casemapping: %r" % name)
+        (upper, lower) = CASEMAPPINGS[name]
+        self.name = name
+        self.table = str.maketrans(string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+
+    def fold(self, s):
+        return s.translate(self.table)
@@ -0,0 +1,18 @@
+from nose.tools import assert_equal, assert_raises
+
+from casemapping import CaseMapping
+
+
+class TestCaseMapping:
+
+    def test_rfc1459(self):
+        assert_equal(CaseMapping("rfc1459").fold("Nick[]\\^"), "nick{}|~")
+
+    def test_strict_rfc1459(self):
+        assert_equal(CaseMapping("strict-rfc1459").fold("Nick[]\\^"), "nick{}|^")
+
+    def test_ascii(self):
+        assert_equal(CaseMapping("ascii").fold("Nick[]\\^"), "nick[]\\^")
+
+    def test_unknown(self):
+        assert_raises(ValueError, CaseMapping, "unicode")
@@ -1,32 +1,227 @@
+import os
 import re
 import sys
+import hmac
+import base64
 import time
+import zlib
+import signal
 import socket
-import select
-import string
+import traceback
+import errno
+import bisect
+import functools
+import collections
 
 from optparse import OptionParser
-from setuptools_scm import get_version
+
+from framing import LineFramer
+from casemapping import CASEMAPPINGS, CaseMapping
+from timers import TimerWheel
+from metrics import Metrics, MetricsEndpoint
+from logwriter import LogWriter
+from history import MIN_SEGMENT_SIZE, HistoryStore, parse_timestamp, strip_tags
+from handoff import ControlSocket, HandoffError, take_over
+from cluster import LINK_MAX_SENDQ, LINK_RETRY, Broker, LinkListener, Route, ServerRoute
+from compression import MAX_INFLATED_SIZE, new_deflate_state, new_inflater
+from fanout import FanoutScheduler
+from userindex import UserIndex, has_wildcards, literal_prefix
+from engine import IOV_MAX, create_engine, available_backends, available_engines
+
+
+def get_version():
+    try:
+        from version import version
+        return version
+    except ImportError:
+        pass
+    try:
+        from setuptools_scm import get_version
+        return get_version(root=os.path.dirname(os.path.abspath(__file__)))
+    except (ImportError, LookupError):
+        return "unknown"
 
 
 VERSION = get_version()
 
+NICKNAME_LENGTH = 51
+LIST_BATCH_SIZE = 100
+WHOIS_CHANNELS_LENGTH = 400
+CAPABILITIES = ("server-time",)
+FANOUT_COST_MEMBERS = 100
+ACCEPT_RETRY = 1
+CLIENT_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
 
-def lower(s):
-    return s.translate(str.maketrans(string.ascii_lowercase.upper() + "[]\\^", string.ascii_lowercase + "{}|~"))
+
+def mask_to_regexp(mask):
+    return re.compile(re.escape(mask).replace(r"\*", ".*").replace(r"\?", ".") + r"\Z", re.DOTALL)
+
+
+class ChannelListFilter(object):
+
+    def __init__(self, masks, negated_masks, min_users=0, max_users=None):
+        self.masks = [mask_to_regexp(x) for x in masks]
+        self.negated_masks = [mask_to_regexp(x) for x in negated_masks]
+        self.min_users = min_users
+        self.max_users = max_users
+        if len(masks) == 1:
+            self.prefix = re.split(r"[*?]", masks[0], 1)[0]
+        else:
+            self.prefix = ""
+
+    def match(self, channel):
+        users = len(channel.clients)
+        if users < self.min_users or (self.max_users is not None and users > self.max_users):
+            return False
+        name = channel.folded_name
+        if self.masks and not any(x.match(name) for x in self.masks):
+            return False
+        return not any(x.match(name) for x in self.negated_masks)
+
+
+def parse_user_mask(mask):
+    if "!" in mask:
+        (nickname, rest) = mask.split("!", 1)
+    elif "@" in mask:
+        (nickname, rest) = ("*", mask)
+    else:
+        (nickname, rest) = (mask, "")
+    (user, _, host) = rest.partition("@")
+    return (nickname or "*", user or "*", host or "*")
+
+
+class UserFilter(object):
+
+    def __init__(self, server, mask, real_name=False, opers_only=False):
+        if real_name:
+            (nickname, user, host) = ("*", "*", "*")
+            self.real_name = mask_to_regexp(mask.lower())
+        else:
+            (nickname, user, host) = parse_user_mask(mask)
+            self.real_name = None
+        nickname = server.fold(nickname)
+        user = user.lower()
+        host = host.lower()
+        self.nickname = mask_to_regexp(nickname)
+        self.user = mask_to_regexp(user)
+        self.host = mask_to_regexp(host)
+        self.opers_only = opers_only
+        self.prefix = literal_prefix(nickname)
+        self.host_key = None if has_wildcards(host) else host
+        self.user_key = None if has_wildcards(user) or self.host_key is not None else user
+
+    def candidates(self, index):
+        return index.search(self.prefix, self.host_key, self.user_key, LIST_BATCH_SIZE)
+
+    def match(self, client):
+        if self.opers_only and not client.oper:
+            return False
+        if not self.nickname.match(client.folded_nickname):
+            return False
+        if not self.user.match(client.user.lower()) or not self.host.match(client.host.lower()):
+            return False
+        return self.real_name is None or self.real_name.match(client.real_name.lower()) is not None
+
+
+def format_number(value, scale=1):
+    if value is None:
+        return "-"
+    return "%.0f" % (value * scale)
+
+
+class NamesChunk(object):
+    __slots__ = ("names", "size", "data")
+
+    def __init__(self, names):
+        self.names = names
+        self.size = sum(len(x) for x in names) + len(names) - 1
+        self.data = None
+
+    def render(self):
+        if self.data is None:
+            self.data = " ".join(self.names).encode()
+        return self.data
 
 
 class Channel(object):
+    __slots__ = ("server", "name", "folded_name", "clients", "routes", "_topic", "_key", "__names_chunks", "__names_heads", "__names_capacity")
 
-    def __init__(self, server, name):
+    def __init__(self, server, name, folded_name=None):
         self.server = server
         self.name = name
+        if folded_name is None:
+            folded_name = server.fold(name)
+        self.folded_name = folded_name
         self.clients = set()
+        self.routes = {}
         self._topic = ""
         self._key = None
+        self.__names_chunks = []
+        self.__names_heads = []
+        self.__names_capacity = 512 - len(":%s 353 %s = %s :\r\n" % (server.name, "x" * NICKNAME_LENGTH, name))
 
     def add_member(self, client):
-        self.clients.add(client)
+        if client not in self.clients:
+            self.clients.add(client)
+            self.__insert_name(client.nickname)
+            route = client.route
+            if route is not None:
+                self.routes[route] = self.routes.get(route, 0) + 1
+
+    def rename_member(self, old_nickname, new_nickname):
+        self.__remove_name(old_nickname)
+        self.__insert_name(new_nickname)
+
+    def names_chunks(self):
+        return [x.render() for x in self.__names_chunks]
+
+    def __insert_name(self, name):
+        chunks = self.__names_chunks
+        heads = self.__names_heads
+        if not chunks:
+            chunks.append(NamesChunk([name]))
+            heads.append(name)
+            return
+        i = max(bisect.bisect_right(heads, name) - 1, 0)
+        chunk = chunks[i]
+        bisect.insort(chunk.names, name)
+        chunk.size += len(name) + 1
+        chunk.data = None
+        heads[i] = chunk.names[0]
+        if chunk.size > self.__names_capacity and len(chunk.names) > 1:
+            half = len(chunk.names) // 2
+            tail = NamesChunk(chunk.names[half:])
+            chunk.names = chunk.names[:half]
+            chunk.size -= tail.size + 1
+            chunks.insert(i + 1, tail)
+            heads.insert(i + 1, tail.names[0])
+
+    def __remove_name(self, name):
+        chunks = self.__names_chunks
+        heads = self.__names_heads
+        i = bisect.bisect_right(heads, name) - 1
+        if i < 0:
+            return
+        chunk = chunks[i]
+        j = bisect.bisect_left(chunk.names, name)
+        if j == len(chunk.names) or chunk.names[j] != name:
+            return
+        del chunk.names[j]
+        if not chunk.names:
+            del chunks[i]
+            del heads[i]
+            return
+        chunk.size -= len(name) + 1
+        chunk.data = None
+        heads[i] = chunk.names[0]
+        if i + 1 < len(chunks) and chunk.size + 1 + chunks[i + 1].size <= self.__names_capacity:
+            chunk.names.extend(chunks[i + 1].names)
+            chunk.size += 1 + chunks[i + 1].size
+            del chunks[i + 1]
+            del heads[i + 1]
 
     def get_topic(self):
         return self._topic
@@ -45,106 +240,389 @@ class Channel(object):
     key = property(get_key, set_key)
 
     def remove_client(self, client):
-        self.clients.discard(client)
+        if client in self.clients:
+            self.clients.discard(client)
+            self.__remove_name(client.nickname)
+            route = client.route
+            if route is not None:
+                self.routes[route] -= 1
+                if not self.routes[route]:
+                    del self.routes[route]
         if not self.clients:
             self.server.remove_channel(self)
 
 
+class Message(object):
+    __slots__ = ("command", "params", "prefix", "folded_target")
+
+    def __init__(self, command, params, prefix=None):
+        self.command = command
+        self.params = params
+        self.prefix = prefix
+        self.folded_target = None
+
+
+def parse_message(line):
+    prefix = None
+    if line[:1] == ":":
+        x = line.split(" ", 1)
+        if len(x) == 1:
+            return None
+        prefix = x[0][1:]
+        line = x[1]
+    x = line.lstrip(" ").split(" ", 1)
+    command = x[0].upper()
+    if not command:
+        return None
+    if len(x) == 1:
+        params = []
+    elif x[1][:1] == ":":
+        params = [x[1][1:]]
+    else:
+        y = x[1].split(" :", 1)
+        params = y[0].split()
+        if len(y) == 2:
+            params.append(y[1])
+    return Message(command, params, prefix)
+
+
+def format_message(message):
+    params = list(message.params)
+    if params and (not params[-1] or " " in params[-1] or params[-1][:1] == ":"):
+        params[-1] = ":" + params[-1]
+    line = " ".join([message.command] + params)
+    if message.prefix is not None:
+        line = ":%s %s" % (message.prefix, line)
+    return line
+
+
 class Client(object):
     __validate_nickname_regexp = re.compile(r"^[][`_^{|}A-Za-z][][`_^{|}A-Za-z0-9-]{0,50}$")
+    __validate_channel_regexp = re.compile(r"^[&#+!][^\x00\x07\x0a\x0d ,:]{0,50}$")
+
+    registration_handlers = {}
+    command_handlers = {}
+    command_costs = {}
+
+    route = None
 
-    def __init__(self, server, connection):
+    __slots__ = (
+        "channels", "server", "connection", "nickname", "folded_nickname", "user", "real_name", "host", "port",
+        "closed", "registered", "oper", "signon", "deflate", "inflate", "capabilities", "__negotiating", "__timestamp", "__sent_ping", "__read_framer", "__write_queue", "__write_queue_size",
+        "__write_offset", "__registration_timer", "__idle_timer", "__read_queue", "__read_waiting", "__tokens",
+        "__tokens_time", "__flood_timer", "__reply_task", "__reply_running")
+
+    def __init__(self, server, connection, address):
         self.channels = {}
 
         self.server = server
         self.connection = connection
 
         self.nickname = None
+        self.folded_nickname = None
         self.user = None
         self.real_name = None
 
-        (self.host, self.port) = connection.getpeername()
-
-        self.__timestamp = time.time()
-        self.__read_buffer = ""
-        self.__write_buffer = ""
+        self.host = sys.intern(address[0])
+        self.port = address[1]
+
+        self.__timestamp = time.monotonic()
+        self.signon = time.time()
+        self.__read_framer = None
+        self.__read_queue = None
+        self.__read_waiting = False
+        self.__tokens = server.flood_burst
+        self.__tokens_time = self.__timestamp
+        self.__flood_timer = None
+        self.__reply_task = None
+        self.__reply_running = False
+        self.capabilities = set()
+        self.__negotiating = False
+        self.__write_queue = None
+        self.__write_queue_size = 0
+        self.__write_offset = 0
+        self.deflate = None
+        self.inflate = None
+        self.closed = False
         self.__sent_ping = False
-        self.__handle_command = self.__registration_handler
+        self.registered = False
+        self.oper = False
+        self.__registration_timer = server.timers.schedule(server.registration_timeout, self.__registration_timeout)
+        self.__idle_timer = server.timers.schedule(server.ping_interval, self.__check_idle)
+
+    def set_nickname(self, nickname, folded_nickname=None):
+        if folded_nickname is None:
+            folded_nickname = self.server.fold(nickname)
+        self.nickname = sys.intern(nickname)
+        self.folded_nickname = sys.intern(folded_nickname)
 
     def get_prefix(self):
         return "%s!%s@%s" % (self.nickname, self.user, self.host)
     prefix = property(get_prefix)
 
-    def check_aliveness(self):
-        now = time.time()
-        if self.__timestamp + 180 < now:
+    def __registration_timeout(self):
+        self.__registration_timer = None
+        self.disconnect("Registration timeout")
+
+    def __check_idle(self):
+        server = self.server
+        now = time.monotonic()
+        idle = now - self.__timestamp
+        if idle >= server.ping_timeout:
+            self.__idle_timer = None
             self.disconnect("ping timeout")
             return
-        if not self.__sent_ping and self.__timestamp + 90 < now:
-            if self.__handle_command == self.__command_handler:
-                self.message("PING :%s" % self.server.name)
+        if idle >= server.ping_interval:
+            if not self.__sent_ping and self.registered:
+                self.message("PING :%s" % server.name)
                 self.__sent_ping = True
-            else:
-                self.disconnect("ping timeout")
+            delay = server.ping_timeout - idle
+        else:
+            delay = server.ping_interval - idle
+        self.__idle_timer = server.timers.schedule(delay, self.__check_idle)
 
     def write_queue_size(self):
-        return len(self.__write_buffer)
+        return self.__write_queue_size
+
+    def has_output(self):
+        return self.__write_queue is not None
+
+    def snapshot(self):
+        queue = self.__write_queue
+        pending = b"".join(queue)[self.__write_offset:] if queue else b""
+        framer = self.__read_framer
+        return {
+            "host": self.host,
+            "port": self.port,
+            "nickname": self.nickname,
+            "user": self.user,
+            "real_name": self.real_name,
+            "registered": self.registered,
+            "oper": self.oper,
+            "signon": self.signon,
+            "capabilities": sorted(self.capabilities),
+            "channels": [x.name for x in self.channels.values()],
+            "idle": time.monotonic() - self.__timestamp,
+            "sent_ping": self.__sent_ping,
+            "tokens": self.__tokens,
+            "read_buffer": base64.b64encode(framer.buffer if framer is not None else b"").decode(),
+            "read_queue": [format_message(x) for x in self.__read_queue or ()],
+            "write_queue": base64.b64encode(pending).decode(),
+        }
 
-    def __parse_read_buffer(self):
-        lines = re.compile(r"\r?\n").split(self.__read_buffer)
-        self.__read_buffer = lines[-1]
-        lines = lines[:-1]
+    def restore(self, state):
+        if state["nickname"] is not None:
+            self.set_nickname(state["nickname"])
+        self.user = state["user"]
+        self.real_name = state["real_name"]
+        self.oper = state["oper"]
+        self.signon = state.get("signon", self.signon)
+        self.capabilities = set(state.get("capabilities", []))
+        if state["registered"]:
+            self.registered = True
+            self.server.timers.cancel(self.__registration_timer)
+            self.__registration_timer = None
+        self.__timestamp = time.monotonic() - state["idle"]
+        self.__sent_ping = state["sent_ping"]
+        self.__tokens = state["tokens"]
+        read_buffer = base64.b64decode(state["read_buffer"])
+        if read_buffer:
+            self.__read_framer = LineFramer()
+            self.__read_framer.feed(read_buffer)
+        pending = base64.b64decode(state["write_queue"])
+        if pending:
+            self.__append_write_queue(pending)
+        if state["read_queue"]:
+            self.__read_queue = collections.deque(parse_message(x) for x in state["read_queue"])
+            self.__read_waiting = True
+            self.server.schedule_read_queue(self)
+
+    def __queue_lines(self, lines):
+        server = self.server
+        queue = self.__read_queue
+        throttled = queue is not None and self.__read_waiting
+        if queue is None:
+            queue = self.__read_queue = collections.deque()
         for line in lines:
-            if not line:
-                continue
-            x = line.split(" ", 1)
-            command = x[0].upper()
-            if len(x) == 1:
-                arguments = []
-            else:
-                if len(x[1]) > 0 and x[1][0] == ":":
-                    arguments = [x[1][1:]]
-                else:
-                    y = x[1].split(" :", 1)
-                    arguments = y[0].split()
-                    if len(y) == 2:
-                        arguments.append(y[1])
-            self.__handle_command(command, arguments)
-
-    def __registration_handler(self, command, arguments):
+            message = parse_message(line)
+            if message is not None:
+                queue.append(message)
+        if throttled and len(queue) > server.max_read_queue:
+            self.disconnect("Excess Flood")
+        elif not self.__read_waiting:
+            self.process_read_queue()
+
+    def command_cost(self, message):
+        cost = self.command_costs.get(message.command, 1)
+        if callable(cost):
+            cost = cost(self, message)
+        return min(cost, self.server.flood_burst)
+
+    def send_message_cost(self, message):
+        if message.params:
+            message.folded_target = self.server.fold(message.params[0])
+            channel = self.server.channels.get(message.folded_target)
+            if channel is not None:
+                return 1 + len(channel.clients) / FANOUT_COST_MEMBERS
+        return 1
+
+    def process_read_queue(self):
         server = self.server
-        if command == "NICK":
-            if len(arguments) < 1:
-                self.reply("431 :No nickname given")
+        queue = self.__read_queue
+        rate = server.flood_rate
+        self.__read_waiting = False
+        if rate:
+            now = time.monotonic()
+            self.__tokens = min(server.flood_burst, self.__tokens + (now - self.__tokens_time) * rate)
+            self.__tokens_time = now
+        budget = server.lines_per_tick
+        while queue and not self.closed:
+            if self.__reply_task is not None:
+                self.__read_waiting = True
                 return
-            nick = arguments[0]
-            if server.get_client(nick):
-                self.reply("433 * %s :Nickname is already in use" % nick)
-            elif not self.__validate_nickname_regexp.match(nick):
-                self.reply("432 * %s :Error in nickname" % nick)
-            else:
-                self.nickname = nick
-                server.client_changed_nickname(self, None)
-        elif command == "USER":
-            if len(arguments) < 4:
-                self.reply("461 %s USER :Not enough parameters" % self.nickname)
+            if budget == 0:
+                self.__read_waiting = True
+                server.schedule_read_queue(self)
+                return
+            message = queue[0]
+            if rate:
+                cost = self.command_cost(message)
+                if cost > self.__tokens:
+                    self.__read_waiting = True
+                    self.__flood_timer = server.timers.schedule((cost - self.__tokens) / rate, self.__flood_timeout)
+                    return
+                self.__tokens -= cost
+            queue.popleft()
+            budget -= 1
+            self.dispatch(message)
+        self.__read_queue = None
+
+    def add_reply_task(self, task):
+        self.__reply_task = task
+        self.__resume_reply()
+
+    def __resume_reply(self):
+        if not self.__reply_running:
+            self.__reply_running = True
+            self.server.add_task(self.__run_reply())
+
+    def __run_reply(self):
+        limit = self.server.max_sendq // 2
+        while not self.closed:
+            if self.__write_queue_size > limit:
+                self.__reply_running = False
+                return
+            try:
+                next(self.__reply_task)
+            except StopIteration:
+                break
+            if self.__write_queue_size <= limit:
+                yield
+        self.__reply_running = False
+        self.__reply_task = None
+        if self.__read_queue is not None and not self.closed:
+            self.server.schedule_read_queue(self)
+
+    def __flood_timeout(self):
+        self.__flood_timer = None
+        self.process_read_queue()
+
+    def dispatch(self, message):
+        if self.registered:
+            handler = self.command_handlers.get(message.command)
+            if handler is None:
+                self.reply("421 %s %s :Unknown command" % (self.nickname, message.command))
+                return
+        else:
+            handler = self.registration_handlers.get(message.command)
+            if handler is None:
                 return
-            self.user = arguments[0]
-            self.real_name = arguments[3]
-        elif command == "QUIT":
-            self.disconnect("Client quit")
+        metrics = self.server.metrics
+        start = metrics.clock()
+        handler(self, message)
+        metrics.command_histogram(message.command).observe(metrics.clock() - start)
+
+    @classmethod
+    def add_command(cls, command, handler, registration=False, cost=1):
+        if registration:
+            cls.registration_handlers[command.upper()] = handler
+        else:
+            cls.command_handlers[command.upper()] = handler
+            cls.command_costs[command.upper()] = cost
+
+    def registration_nick_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("431 :No nickname given")
             return
+        nick = arguments[0]
+        folded_nick = server.fold(nick)
+        if server.get_client(nick, folded_nick):
+            self.reply("433 * %s :Nickname is already in use" % nick)
+        elif not self.__validate_nickname_regexp.match(nick):
+            self.reply("432 * %s :Error in nickname" % nick)
+        else:
+            self.set_nickname(nick, folded_nick)
+            server.client_changed_nickname(self, None)
+            self.__complete_registration()
+
+    def registration_user_handler(self, message):
+        arguments = message.params
+        if len(arguments) < 4:
+            self.reply("461 %s USER :Not enough parameters" % self.nickname)
+            return
+        self.user = sys.intern(arguments[0])
+        self.real_name = arguments[3]
+        self.__complete_registration()
+
+    def registration_quit_handler(self, message):
+        self.disconnect("Client quit")
+
+    def cap_handler(self, message):
+        arguments = message.params
+        target = self.nickname or "*"
+        subcommand = arguments[0].upper() if arguments else ""
+        if subcommand in ("LS", "REQ") and not self.registered:
+            self.__negotiating = True
+        if subcommand == "LS":
+            self.reply("CAP %s LS :%s" % (target, " ".join(CAPABILITIES)))
+        elif subcommand == "LIST":
+            self.reply("CAP %s LIST :%s" % (target, " ".join(sorted(self.capabilities))))
+        elif subcommand == "REQ":
+            requested = arguments[1].split() if len(arguments) > 1 else []
+            if requested and all(x.lstrip("-") in CAPABILITIES for x in requested):
+                for name in requested:
+                    if name.startswith("-"):
+                        self.capabilities.discard(name[1:])
+                    else:
+                        self.capabilities.add(name)
+                self.reply("CAP %s ACK :%s" % (target, " ".join(requested)))
+            else:
+                self.reply("CAP %s NAK :%s" % (target, " ".join(requested)))
+        elif subcommand == "END":
+            if self.__negotiating:
+                self.__negotiating = False
+                self.__complete_registration()
+        else:
+            self.reply("410 %s %s :Invalid CAP command" % (target, arguments[0] if arguments else "*"))
 
-        if self.nickname and self.user:
+    def __complete_registration(self):
+        server = self.server
+        if self.nickname and self.user and not self.__negotiating:
             self.reply("001 %s :Hi, welcome to Chat" % self.nickname)
             self.reply("002 %s :Your host is %s, running version is %s" % (self.nickname, server.name, VERSION))
             self.reply("003 %s %s chat-%s o o" % (self.nickname, server.name, VERSION))
             self.send_list_users()
-            self.__handle_command = self.__command_handler
+            self.registered = True
+            self.signon = time.time()
+            server.user_index.add(self)
+            server.propagate(None, "user", self.nickname, self.user, self.host, self.real_name, self.signon)
+            server.timers.cancel(self.__registration_timer)
+            self.__registration_timer = None
 
     def __send_names(self, arguments, for_join=False):
         server = self.server
-        valid_channel_re = re.compile(r"^[&#+!][^\x00\x07\x0a\x0d ,:]{0,50}$")
         if len(arguments) > 0:
             channel_names = arguments[0].split(",")
         else:
@@ -155,199 +633,618 @@ class Client(object):
             keys = []
         keys.extend((len(channel_names) - len(keys)) * [None])
         for (i, channel_name) in enumerate(channel_names):
-            if for_join and lower(channel_name) in self.channels:
+            folded_name = server.fold(channel_name)
+            if for_join and folded_name in self.channels:
                 continue
-            if not valid_channel_re.match(channel_name):
+            if not self.__validate_channel_regexp.match(channel_name):
                 self.reply("403 %s %s :No such channel" % (self.nickname, channel_name))
                 continue
-            channel = server.get_channel(channel_name)
+            if for_join:
+                channel = server.get_channel(channel_name, folded_name)
+            else:
+                channel = server.channels.get(folded_name)
+                if channel is None:
+                    self.reply("366 %s %s :End of NAMES list" % (self.nickname, channel_name))
+                    continue
             if channel.key is not None and channel.key != keys[i]:
                 self.reply("475 %s %s :Cannot join channel (+k) - bad key" % (self.nickname, channel_name))
                 continue
 
             if for_join:
                 channel.add_member(self)
-                self.channels[lower(channel_name)] = channel
+                self.channels[folded_name] = channel
+                server.propagate(None, "join", self.nickname, channel.name)
                 self.message_channel(channel, "JOIN", channel_name, True)
+                self.channel_log(channel, "joined", meta=True)
                 if channel.topic:
                     self.reply("332 %s %s :%s" % (self.nickname, channel.name, channel.topic))
                 else:
                     self.reply("331 %s %s :No topic is set" % (self.nickname, channel.name))
 
-            names_prefix = "353 %s = %s :" % (self.nickname, channel_name)
-            names = ""
-            names_max_len = 512 - (len(server.name) + 2 + 2)
-            for name in sorted(x.nickname for x in channel.members):
-                if not names:
-                    names = names_prefix + name
-                elif len(names) + len(name) >= names_max_len:
-                    self.reply(names)
-                    names = names_prefix + name
-                else:
-                    names += " " + name
-            if names:
-                self.reply(names)
+            names_prefix = (":%s 353 %s = %s :" % (server.name, self.nickname, channel_name)).encode()
+            for names in channel.names_chunks():
+                self.enqueue(names_prefix + names + b"\r\n")
             self.reply("366 %s %s :End of NAMES list" % (self.nickname, channel_name))
+            if for_join and server.history is not None and server.history_join_lines:
+                self.send_history(server.history.get(folded_name).latest(server.history_join_lines))
 
-    def __command_handler(self, command, arguments):
-        def join_handler():
-            if len(arguments) < 1:
-                self.reply("461 %s JOIN :Not enough parameters" % self.nickname)
-                return
-            if arguments[0] == "0":
-                for (channel_name, channel) in self.channels.items():
-                    self.message_channel(channel, "PART", channel_name, True)
-                    server.remove_client_from_channel(self, channel_name)
-                self.channels = {}
-                return
-            self.__send_names(arguments, for_join=True)
+    def join_handler(self, message):
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("461 %s JOIN :Not enough parameters" % self.nickname)
+            return
+        if arguments[0] == "0":
+            for channel in self.channels.values():
+                self.message_channel(channel, "PART", channel.name, True)
+                self.channel_log(channel, "left", meta=True)
+                self.server.propagate(None, "part", self.nickname, channel.name)
+                channel.remove_client(self)
+            self.channels = {}
+            return
+        self.__send_names(arguments, for_join=True)
 
-        def list_handler():
-            if len(arguments) < 1:
-                channels = server.channels.values()
-            else:
-                channels = []
-                for channel_name in arguments[0].split(","):
-                    if server.has_channel(channel_name):
-                        channels.append(server.get_channel(channel_name))
-            sorted_channels = sorted(channels, key=lambda x: x.name)
-            for channel in sorted_channels:
-                self.reply("322 %s %s %d :%s" % (self.nickname, channel.name, len(channel.members), channel.topic))
+    def list_handler(self, message):
+        server = self.server
+        arguments = message.params
+        channel_names = []
+        masks = []
+        negated_masks = []
+        user_limits = [0, None]
+        if len(arguments) > 0:
+            for x in arguments[0].split(","):
+                if x[:1] in "<>" and x[1:].isdigit():
+                    if x[0] == ">":
+                        user_limits[0] = int(x[1:]) + 1
+                    else:
+                        user_limits[1] = int(x[1:]) - 1
+                elif x[:1] == "!":
+                    negated_masks.append(server.fold(x[1:]))
+                elif "*" in x or "?" in x:
+                    masks.append(server.fold(x))
+                elif x:
+                    channel_names.append(x)
+        list_filter = ChannelListFilter(masks, negated_masks, *user_limits)
+        if channel_names:
+            channels = []
+            for channel_name in channel_names:
+                channel = server.channels.get(server.fold(channel_name))
+                if channel and list_filter.match(channel):
+                    channels.append(channel)
+            for channel in sorted(channels, key=lambda x: x.folded_name):
+                self.send_list_entry(channel)
             self.reply("323 %s :End of LIST" % self.nickname)
+        else:
+            self.add_reply_task(self.__list_channels(list_filter))
 
-        def list_users_handler():
-            self.send_list_users()
+    def who_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("461 %s WHO :Not enough parameters" % self.nickname)
+            return
+        mask = arguments[0]
+        flags = arguments[1] if len(arguments) > 1 else ""
+        end_reply = "315 %s %s :End of WHO list" % (self.nickname, mask)
+        if mask[:1] == "#":
+            channel = server.channels.get(server.fold(mask))
+            members = sorted(channel.clients, key=lambda x: x.folded_nickname) if channel else []
+            batches = [members[i:i + LIST_BATCH_SIZE] for i in range(0, len(members), LIST_BATCH_SIZE)]
+            user_filter = UserFilter(server, "*", opers_only="o" in flags)
+            send_entry = functools.partial(self.send_who_entry, mask if channel is None else channel.name)
+        else:
+            user_filter = UserFilter(server, mask, "r" in flags, "o" in flags)
+            batches = user_filter.candidates(server.user_index)
+            send_entry = functools.partial(self.send_who_entry, "*")
+        self.add_reply_task(self.__send_users("WHO", batches, user_filter, send_entry, end_reply))
+
+    def whois_handler(self, message):
+        arguments = message.params
+        if len(arguments) < 1 or not arguments[-1]:
+            self.reply("431 %s :No nickname given" % self.nickname)
+            return
+        masks = [x for x in arguments[-1].split(",") if x]
+        self.add_reply_task(self.__whois(masks))
 
-        def names_handler():
-            self.__send_names(arguments)
+    def list_users_handler(self, message):
+        self.send_list_users()
 
-        def nick_handler():
-            if len(arguments) < 1:
-                self.reply("431 :No nickname given")
-                return
-            new_nick = arguments[0]
-            client = server.get_client(new_nick)
-            if new_nick == self.nickname:
-                pass
-            elif client and client is not self:
-                self.reply("433 %s %s :Nickname is already in use" % (self.nickname, new_nick))
-            elif not self.__validate_nickname_regexp.match(new_nick):
-                self.reply("432 %s %s :Erroneous Nickname" % (self.nickname, new_nick))
-            else:
-                old_nickname = self.nickname
-                self.nickname = new_nick
-                server.client_changed_nickname(self, old_nickname)
+    def names_handler(self, message):
+        self.__send_names(message.params)
 
-        def send_message_handler():
-            if len(arguments) == 0:
-                self.reply("411 %s :No recipient given (%s)" % (self.nickname, command))
-                return
-            if len(arguments) == 1:
-                self.reply("412 %s :No text to send" % self.nickname)
-                return
+    def nick_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("431 :No nickname given")
+            return
+        new_nick = arguments[0]
+        folded_nick = server.fold(new_nick)
+        client = server.get_client(new_nick, folded_nick)
+        if new_nick == self.nickname:
+            pass
+        elif client and client is not self:
+            self.reply("433 %s %s :Nickname is already in use" % (self.nickname, new_nick))
+        elif not self.__validate_nickname_regexp.match(new_nick):
+            self.reply("432 %s %s :Erroneous Nickname" % (self.nickname, new_nick))
+        else:
+            old_nickname = self.nickname
+            old_folded_nickname = self.folded_nickname
+            for channel in self.channels.values():
+                self.channel_log(channel, "changed nickname to %s" % new_nick, meta=True)
+            self.set_nickname(new_nick, folded_nick)
+            self.signon = time.time()
+            server.client_changed_nickname(self, old_folded_nickname)
+            for channel in self.channels.values():
+                channel.rename_member(old_nickname, new_nick)
+            server.propagate(None, "nick", old_nickname, new_nick, self.signon)
+
+    def send_message_handler(self, message):
+        server = self.server
+        command = message.command
+        arguments = message.params
+        if len(arguments) == 0:
+            self.reply("411 %s :No recipient given (%s)" % (self.nickname, command))
+            return
+        if len(arguments) == 1:
+            self.reply("412 %s :No text to send" % self.nickname)
+            return
 
-            target_name = arguments[0]
-            message = arguments[1]
-            client = server.get_client(target_name)
-            if client:
-                client.message(":%s %s %s :%s" % (self.prefix, command, target_name, message))
-            elif server.has_channel(target_name):
-                channel = server.get_channel(target_name)
-                self.message_channel(channel, command, "%s :%s" % (channel.name, message))
-            else:
-                self.reply("401 %s %s :No such nick/channel" % (self.nickname, target_name))
+        target_name = arguments[0]
+        text = arguments[1]
+        folded_name = message.folded_target or server.fold(target_name)
+        client = server.get_client(target_name, folded_name)
+        channel = None if client else server.channels.get(folded_name)
+        if client:
+            client.message(":%s %s %s :%s" % (self.prefix, command, target_name, text))
+        elif channel:
+            data = self.message_channel(channel, command, "%s :%s" % (channel.name, text))
+            if server.history is not None:
+                server.history.append(channel.folded_name, data)
+            self.channel_log(channel, text)
+        else:
+            self.reply("401 %s %s :No such nick/channel" % (self.nickname, target_name))
 
-        def ping_handler():
-            if len(arguments) < 1:
-                self.reply("409 %s :No origin specified" % self.nickname)
-                return
-            self.reply("PONG %s :%s" % (server.name, arguments[0]))
+    def ping_handler(self, message):
+        if len(message.params) < 1:
+            self.reply("409 %s :No origin specified" % self.nickname)
+            return
+        self.reply("PONG %s :%s" % (self.server.name, message.params[0]))
 
-        def pong_handler():
-            pass
+    def pong_handler(self, message):
+        pass
 
-        def quit_handler():
-            if len(arguments) < 1:
-                quit_message = self.nickname
-            else:
-                quit_message = arguments[0]
-            self.disconnect(quit_message)
+    def chathistory_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if server.history is None:
+            self.reply("421 %s %s :Unknown command" % (self.nickname, message.command))
+            return
+        if len(arguments) < 4:
+            self.reply("461 %s CHATHISTORY :Not enough parameters" % self.nickname)
+            return
+        (subcommand, target, reference, limit) = arguments[:4]
+        subcommand = subcommand.upper()
+        if subcommand not in ("BEFORE", "AFTER", "LATEST"):
+            self.message("FAIL CHATHISTORY INVALID_PARAMS %s :Unknown subcommand" % subcommand)
+            return
+        folded_name = server.fold(target)
+        if folded_name not in self.channels:
+            self.message("FAIL CHATHISTORY INVALID_TARGET %s %s :Messages could not be retrieved" % (subcommand, target))
+            return
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            self.message("FAIL CHATHISTORY INVALID_PARAMS %s %s :Invalid limit" % (subcommand, arguments[3]))
+            return
+        limit = min(limit, server.history_max_lines)
+        timestamp = None
+        if reference.startswith("timestamp="):
+            timestamp = parse_timestamp(reference[len("timestamp="):])
+        if timestamp is None and (subcommand != "LATEST" or reference != "*"):
+            self.message("FAIL CHATHISTORY INVALID_PARAMS %s %s :Invalid timestamp" % (subcommand, reference))
+            return
+        history = server.history.get(folded_name)
+        if subcommand == "BEFORE":
+            chunks = history.before(timestamp, limit)
+        elif subcommand == "AFTER":
+            chunks = history.after(timestamp, limit)
+        else:
+            chunks = history.latest(limit, timestamp)
+        self.send_history(chunks)
 
-        handler_table = {
-            "JOIN": join_handler,
-            "LIST": list_handler,
-            "LUSERS": list_users_handler,
-            "NAMES": names_handler,
-            "NICK": nick_handler,
-            "SENDMSG": send_message_handler,
-            "PING": ping_handler,
-            "PONG": pong_handler,
-            "SENDMSGP": send_message_handler,
-            "QUIT": quit_handler,
-        }
+    def oper_handler(self, message):
+        if len(message.params) < 2:
+            self.reply("461 %s OPER :Not enough parameters" % self.nickname)
+            return
+        password = self.server.opers.get(message.params[0])
+        if password is None or not hmac.compare_digest(password.encode(), message.params[1].encode()):
+            self.reply("464 %s :Password incorrect" % self.nickname)
+            return
+        self.oper = True
+        self.server.print_info("%s is now an operator (%s).", self.prefix, message.params[0])
+        self.reply("381 %s :You are now an IRC operator" % self.nickname)
 
+    def stats_handler(self, message):
+        if not self.oper:
+            self.reply("481 %s :Permission Denied- You're not an IRC operator" % self.nickname)
+            return
+        if len(message.params) < 1:
+            self.reply("461 %s STATS :Not enough parameters" % self.nickname)
+            return
+        query = message.params[0][:1]
         server = self.server
-        try:
-            handler_table[command]()
-        except KeyError:
-            self.reply("421 %s %s :Unknown command" % (self.nickname, command))
+        metrics = server.metrics
+        if query == "m":
+            for command in sorted(metrics.commands):
+                h = metrics.commands[command]
+                self.reply("212 %s %s %d %d %s" % (self.nickname, command, h.count, 1e6 * h.sum / h.count, format_number(h.quantile(0.99), 1e6)))
+        elif query == "u":
+            uptime = int(time.time() - metrics.started)
+            self.reply("242 %s :Server Up %d days %d:%02d:%02d" % (self.nickname, uptime // 86400, uptime // 3600 % 24, uptime // 60 % 60, uptime % 60))
+        elif query == "z":
+            loop = metrics.loop_time
+            sendq = metrics.sendq_histogram(server)
+            for line in [
+                    "users %d channels %d connections %d" % (len(server.nicknames), len(server.channels), len(server.clients)),
+                    "connections accepted %d refused %d" % (metrics.connections_accepted, metrics.connections_refused),
+                    "bytes received %d sent %d" % (metrics.bytes_received, metrics.bytes_sent),
+                    "loop iterations %d idle %d avg %s p99 %s us" % (loop.count, metrics.idle_polls, format_number(loop.sum / loop.count if loop.count else None, 1e6), format_number(loop.quantile(0.99), 1e6)),
+                    "loop ready fds p50 %s p99 %s" % (format_number(metrics.ready_fds.quantile(0.5)), format_number(metrics.ready_fds.quantile(0.99))),
+                    "sendq p50 %s p99 %s bytes" % (format_number(sendq.quantile(0.5)), format_number(sendq.quantile(0.99))),
+                    "timers %d tasks %d" % (len(server.timers), len(server.tasks)),
+                    "fanout direct %d queued %d pending jobs %d deliveries %d" % (metrics.fanout_direct, metrics.fanout_queued, len(server.fanout), server.fanout.pending),
+                    "fanout lag p50 %s p99 %s us" % (format_number(metrics.fanout_lag.quantile(0.5), 1e6), format_number(metrics.fanout_lag.quantile(0.99), 1e6))]:
+                self.reply("249 %s z :%s" % (self.nickname, line))
+        self.reply("219 %s %s :End of STATS report" % (self.nickname, query or "*"))
+
+    def compress_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if not server.compress_level:
+            self.reply("421 %s COMPRESS :Unknown command" % (self.nickname or "*"))
+            return
+        if len(arguments) < 1:
+            self.reply("461 %s COMPRESS :Not enough parameters" % (self.nickname or "*"))
+            return
+        method = arguments[0].upper()
+        direction = arguments[1].upper() if len(arguments) > 1 else "BOTH"
+        if method != "DEFLATE":
+            self.message("FAIL COMPRESS UNSUPPORTED_METHOD %s :Only DEFLATE is supported" % arguments[0])
+        elif direction not in ("BOTH", "OUT"):
+            self.message("FAIL COMPRESS INVALID_PARAMS %s :Expected BOTH or OUT" % arguments[1])
+        elif self.deflate is not None:
+            self.message("FAIL COMPRESS ALREADY_ACTIVE :Compression is already enabled")
+        else:
+            self.reply("COMPRESS DEFLATE %s" % direction)
+            self.deflate = server.deflate_state()
+            if direction == "BOTH":
+                self.inflate = new_inflater()
+
+    def quit_handler(self, message):
+        if len(message.params) < 1:
+            quit_message = self.nickname
+        else:
+            quit_message = message.params[0]
+        self.disconnect(quit_message)
 
     def socket_readable_notification(self):
         try:
-            data = self.connection.recv(2 ** 10)
-            self.server.print_debug("[%s:%d] -> %r" % (self.host, self.port, data))
+            data = self.connection.recv(self.server.recv_size)
+            self.server.print_debug("[%s:%d] -> %r", self.host, self.port, data)
             quit_message = "EOT"
         except socket.error as x:
             data = b""
             quit_message = x
         if data:
-            self.__read_buffer += data.decode()
-            self.__parse_read_buffer()
-            self.__timestamp = time.time()
-            self.__sent_ping = False
+            self.data_received(data)
         else:
             self.disconnect(quit_message)
 
+    def data_received(self, data):
+        self.server.metrics.bytes_received += len(data)
+        inflate = self.inflate
+        if inflate is not None:
+            try:
+                data = inflate.decompress(data, MAX_INFLATED_SIZE)
+            except zlib.error:
+                self.disconnect("Bad compressed data")
+                return
+            if inflate.unconsumed_tail:
+                self.disconnect("Excess Flood")
+                return
+        framer = self.__read_framer
+        if framer is None:
+            framer = LineFramer()
+        lines = framer.feed(data)
+        self.__read_framer = framer if framer.pending() else None
+        self.__queue_lines(lines)
+        self.__timestamp = time.monotonic()
+        self.__sent_ping = False
+
     def socket_writable_notification(self):
+        deflate = self.deflate
+        if deflate is not None and deflate.pending:
+            self.__append_write_queue(deflate.flush())
+        queue = self.__write_queue
+        if queue is None:
+            return
+        chunks = [memoryview(queue[0])[self.__write_offset:]]
+        for i in range(1, min(len(queue), IOV_MAX)):
+            chunks.append(queue[i])
         try:
-            sent = self.connection.send(self.__write_buffer.encode())
-            self.server.print_debug("[%s:%d] <- %r" % (self.host, self.port, self.__write_buffer[:sent]))
-            self.__write_buffer = self.__write_buffer[sent:]
+            sent = self.connection.sendmsg(chunks)
+        except BlockingIOError:
+            return
         except socket.error as x:
             self.disconnect(x)
+            return
+        if self.server.debug:
+            self.server.print_debug("[%s:%d] <- %r", self.host, self.port, b"".join(chunks)[:sent])
+        self.server.metrics.bytes_sent += sent
+        self.__write_queue_size -= sent
+        sent += self.__write_offset
+        while queue and sent >= len(queue[0]):
+            sent -= len(queue.popleft())
+        self.__write_offset = sent
+        if not queue:
+            self.__write_queue = None
+            self.server.engine.set_write_interest(self, False)
+        if self.__reply_task is not None and self.__write_queue_size <= self.server.max_sendq // 2:
+            self.__resume_reply()
+
+    def transport_writable_notification(self, transport):
+        deflate = self.deflate
+        if deflate is not None and deflate.pending:
+            self.__append_write_queue(deflate.flush())
+        queue = self.__write_queue
+        if self.server.debug:
+            self.server.print_debug("[%s:%d] <- %r", self.host, self.port, b"".join(queue))
+        self.server.metrics.bytes_sent += self.__write_queue_size
+        transport.writelines(queue)
+        self.__write_queue = None
+        self.__write_queue_size = 0
+        if self.__reply_task is not None:
+            self.__resume_reply()
 
     def disconnect(self, quit_message):
-        self.message("ERROR :%s" % quit_message)
-        self.server.print_info("Disconnected connection from %s:%s (%s)." % (self.host, self.port, quit_message))
+        if self.closed:
+            return
+        self.closed = True
+        for timer in (self.__registration_timer, self.__idle_timer, self.__flood_timer):
+            if timer is not None:
+                self.server.timers.cancel(timer)
+        self.__read_queue = None
+        data = ("ERROR :%s\r\n" % quit_message).encode()
+        deflate = self.deflate
+        if deflate is not None:
+            (deflate, data) = deflate.compress(data)
+            data += deflate.flush()
+            deflate.users -= 1
+            self.deflate = None
+        self.__append_write_queue(data)
+        self.server.print_info("Disconnected connection from %s:%s (%s).", self.host, self.port, quit_message)
+        self.server.engine.unregister(self)
         self.connection.close()
         self.server.remove_client(self, quit_message)
 
+    def __append_write_queue(self, data):
+        if self.__write_queue is None:
+            self.__write_queue = collections.deque()
+            self.server.engine.set_write_interest(self, True)
+        self.__write_queue.append(data)
+        self.__write_queue_size += len(data)
+
+    def enqueue(self, data):
+        if self.closed:
+            return
+        if self.deflate is not None:
+            (self.deflate, data) = self.deflate.compress(data)
+        self.enqueue_compressed(data)
+
+    def enqueue_compressed(self, data):
+        if self.closed:
+            return
+        if self.__write_queue_size + len(data) > self.server.max_sendq:
+            self.__write_queue = None
+            self.__write_queue_size = 0
+            self.__write_offset = 0
+            self.disconnect("SendQ exceeded")
+            return
+        self.__append_write_queue(data)
+
+    def channel_log(self, channel, message, meta=False):
+        log = self.server.log
+        if log.channel_dir is None:
+            return
+        if meta:
+            log.channel(channel.folded_name, "* %s %s", (self.nickname, message), {"nick": self.nickname, "event": "meta"})
+        else:
+            log.channel(channel.folded_name, "<%s> %s", (self.nickname, message), {"nick": self.nickname, "event": "message"})
+
     def message(self, msg):
-        self.__write_buffer += msg + "\r\n"
+        self.enqueue((msg + "\r\n").encode())
 
     def reply(self, msg):
         self.message(":%s %s" % (self.server.name, msg))
 
     def message_channel(self, channel, command, message, include_self=False):
-        line = ":%s %s %s" % (self.prefix, command, message)
-        for client in channel.members:
-            if client != self or include_self:
-                client.message(line)
+        data = (":%s %s %s\r\n" % (self.prefix, command, message)).encode()
+        if include_self:
+            self.enqueue(data)
+        self.server.fanout.deliver(channel, data, self)
+        if channel.routes:
+            self.server.forward_channel(channel, data)
+        return data
+
+    def send_history(self, chunks):
+        tagged = "server-time" in self.capabilities
+        for chunk in chunks:
+            self.enqueue(chunk if tagged else strip_tags(chunk))
+
+    def send_list_entry(self, channel):
+        self.reply("322 %s %s %d :%s" % (self.nickname, channel.name, len(channel.clients), channel.topic))
+
+    def __list_channels(self, list_filter):
+        server = self.server
+        index = server.channel_index
+        prefix = list_filter.prefix
+        position = bisect.bisect_left(index, prefix)
+        while not self.closed:
+            batch = index[position:position + LIST_BATCH_SIZE]
+            for folded_name in batch:
+                if not folded_name.startswith(prefix):
+                    batch = []
+                    break
+                channel = server.channels.get(folded_name)
+                if channel is not None and list_filter.match(channel):
+                    self.send_list_entry(channel)
+                if self.closed:
+                    return
+            if len(batch) < LIST_BATCH_SIZE:
+                self.reply("323 %s :End of LIST" % self.nickname)
+                return
+            yield
+            position = bisect.bisect_right(index, batch[-1])
+
+    def send_who_entry(self, channel_name, client):
+        route = client.route
+        server_name = self.server.name if route is None or route.name is None else route.name
+        self.reply("352 %s %s %s %s %s %s H%s :%d %s" % (
+            self.nickname, channel_name, client.user, client.host, server_name, client.nickname,
+            "*" if client.oper else "", 0 if route is None else 1, client.real_name))
+
+    def send_whois_entry(self, client):
+        route = client.route
+        server_name = self.server.name if route is None or route.name is None else route.name
+        self.reply("311 %s %s %s %s * :%s" % (self.nickname, client.nickname, client.user, client.host, client.real_name))
+        names = []
+        size = 0
+        for channel_name in sorted(x.name for x in client.channels.values()):
+            if size + len(channel_name) > WHOIS_CHANNELS_LENGTH:
+                self.reply("319 %s %s :%s" % (self.nickname, client.nickname, " ".join(names)))
+                names = []
+                size = 0
+            names.append(channel_name)
+            size += len(channel_name) + 1
+        if names:
+            self.reply("319 %s %s :%s" % (self.nickname, client.nickname, " ".join(names)))
+        self.reply("312 %s %s %s :Chat" % (self.nickname, client.nickname, server_name))
+        if client.oper:
+            self.reply("313 %s %s :is an IRC operator" % (self.nickname, client.nickname))
+
+    def __whois(self, masks):
+        server = self.server
+        for mask in masks:
+            user_filter = UserFilter(server, mask)
+            end_reply = "318 %s %s :End of WHOIS list" % (self.nickname, mask)
+            missing_reply = "401 %s %s :No such nick/channel" % (self.nickname, mask)
+            yield from self.__send_users("WHOIS", user_filter.candidates(server.user_index), user_filter, self.send_whois_entry, end_reply, missing_reply)
+
+    def __send_users(self, command, batches, user_filter, send_entry, end_reply, missing_reply=None):
+        server = self.server
+        nicknames = server.nicknames
+        count = 0
+        for batch in batches:
+            for client in batch:
+                if client.closed or nicknames.get(client.folded_nickname) is not client or not user_filter.match(client):
+                    continue
+                if count == server.who_limit:
+                    self.reply("416 %s %s :Output too long" % (self.nickname, command))
+                    self.reply(end_reply)
+                    return
+                send_entry(client)
+                count += 1
+            if self.closed:
+                return
+            yield
+        if count == 0 and missing_reply is not None:
+            self.reply(missing_reply)
+        self.reply(end_reply)
 
     def send_list_users(self):
-        self.reply("251 %s :There are %d users on server" % (self.nickname, len(self.server.clients)))
+        self.reply("251 %s :There are %d users on server" % (self.nickname, len(self.server.clients) + self.server.remote_users))
+
+
+for (command, handler) in [
+        ("NICK", Client.registration_nick_handler),
+        ("USER", Client.registration_user_handler),
+        ("COMPRESS", Client.compress_handler),
+        ("CAP", Client.cap_handler),
+        ("QUIT", Client.registration_quit_handler)]:
+    Client.add_command(command, handler, registration=True)
+
+for (command, handler, cost) in [
+        ("JOIN", Client.join_handler, 2),
+        ("LIST", Client.list_handler, 5),
+        ("LUSERS", Client.list_users_handler, 1),
+        ("NAMES", Client.names_handler, 2),
+        ("NICK", Client.nick_handler, 2),
+        ("SENDMSG", Client.send_message_handler, Client.send_message_cost),
+        ("PING", Client.ping_handler, 0.5),
+        ("PONG", Client.pong_handler, 0),
+        ("SENDMSGP", Client.send_message_handler, Client.send_message_cost),
+        ("CHATHISTORY", Client.chathistory_handler, 3),
+        ("WHO", Client.who_handler, 3),
+        ("WHOIS", Client.whois_handler, 2),
+        ("OPER", Client.oper_handler, 2),
+        ("STATS", Client.stats_handler, 2),
+        ("COMPRESS", Client.compress_handler, 1),
+        ("CAP", Client.cap_handler, 1),
+        ("QUIT", Client.quit_handler, 0)]:
+    Client.add_command(command, handler, cost=cost)
 
 
 class Server:
 
     def __init__(self, options):
         self.channels = {}
+        self.channel_index = []
         self.clients = {}
         self.nicknames = {}
+        self.user_index = UserIndex()
+        self.fanout = FanoutScheduler(self, options.fanout_threshold, options.fanout_slice)
+        self.tasks = collections.deque()
+        self.server_sockets = []
+        self.routes = []
+        self.servers = {}
+        self.remote_users = 0
+        self.read_queues = collections.deque()
+        self.__processing_read_queues = False
+        self.__deflate_pool = None
 
         self.ports = options.ports
         self.verbose = options.verbose
         self.debug = options.debug
+        self.max_sendq = options.max_sendq
+        self.backlog = options.backlog
+        self.accept_batch = options.accept_batch
+        self.max_clients = options.max_clients
+        self.max_clients_per_host = options.max_clients_per_host
+        self.host_connections = {}
+        self.who_limit = options.who_limit
+        self.recv_size = options.recv_size
+        self.ping_interval = options.ping_interval
+        self.ping_timeout = options.ping_timeout
+        self.registration_timeout = options.registration_timeout
+        self.flood_rate = options.flood_rate
+        self.flood_burst = options.flood_burst
+        self.lines_per_tick = options.lines_per_tick
+        self.max_read_queue = options.max_read_queue
+        self.compress_level = options.compress_level
+        self.timers = TimerWheel()
+        self.log = LogWriter(options.log_file, options.log_format, options.log_max_bytes, options.log_backups, options.channel_log_dir)
+        self.casemapping = CaseMapping(options.casemapping)
+        self.fold = self.casemapping.fold
+        self.opers = dict(options.opers)
+        self.metrics = Metrics()
+        if options.history_dir:
+            self.history = HistoryStore(options.history_dir, options.history_segment_size, options.history_segments, options.history_retention)
+        else:
+            self.history = None
+        self.history_join_lines = options.history_join_lines
+        self.history_max_lines = options.history_max_lines
 
         if options.listen:
             self.address = socket.gethostbyname(options.listen)
@@ -355,123 +1252,414 @@ class Server:
             self.address = ""
 
         server_name_limit = 63
-        self.name = socket.getfqdn(self.address)[:server_name_limit]
+        self.name = (options.server_name or socket.getfqdn(self.address))[:server_name_limit]
+
+        self.engine = create_engine(options.engine, self, options.backend)
+        self.metrics_listen = options.metrics_listen
+        self.metrics_endpoint = None
+        self.control_path = options.control_socket
+        self.control_socket = None
+        self.takeover = options.takeover
+        self.reuse_port = options.workers > 1
+        self.link_password = options.link_password
+        self.max_link_sendq = options.max_link_sendq
+        self.link_listen = options.link_listen
+        self.link_listener = None
+        self.links = options.links
 
     def has_channel(self, name):
-        return lower(name) in self.channels
-
-    def get_channel(self, channel_name):
-        if lower(channel_name) in self.channels:
-            channel = self.channels[lower(channel_name)]
-        else:
-            channel = Channel(self, channel_name)
-            self.channels[lower(channel_name)] = channel
+        return self.fold(name) in self.channels
+
+    def get_channel(self, channel_name, folded_name=None):
+        if folded_name is None:
+            folded_name = self.fold(channel_name)
+        channel = self.channels.get(folded_name)
+        if channel is None:
+            channel = Channel(self, channel_name, folded_name)
+            self.channels[folded_name] = channel
+            bisect.insort(self.channel_index, folded_name)
         return channel
 
     def remove_channel(self, channel):
-        del self.channels[lower(channel.name)]
+        del self.channels[channel.folded_name]
+        i = bisect.bisect_left(self.channel_index, channel.folded_name)
+        del self.channel_index[i]
 
-    def client_changed_nickname(self, client, old_nickname):
-        if old_nickname:
-            del self.nicknames[lower(old_nickname)]
-        self.nicknames[lower(client.nickname)] = client
+    def client_changed_nickname(self, client, old_folded_nickname):
+        if old_folded_nickname:
+            del self.nicknames[old_folded_nickname]
+        self.nicknames[client.folded_nickname] = client
+        if client.registered:
+            self.user_index.rename(client, old_folded_nickname)
 
     def remove_client_from_channel(self, client, channel_name):
-        if lower(channel_name) in self.channels:
-            channel = self.channels[lower(channel_name)]
+        channel = self.channels.get(self.fold(channel_name))
+        if channel:
             channel.remove_client(client)
 
-    def get_client(self, nickname):
-        return self.nicknames.get(lower(nickname))
+    def get_client(self, nickname, folded_nickname=None):
+        if folded_nickname is None:
+            folded_nickname = self.fold(nickname)
+        return self.nicknames.get(folded_nickname)
 
     def remove_client(self, client, quit_message):
         for x in client.channels.values():
             client.channel_log(x, "quit (%s)" % quit_message, meta=True)
             x.remove_client(client)
-        if client.nickname and lower(client.nickname) in self.nicknames:
-            del self.nicknames[lower(client.nickname)]
+        if client.folded_nickname and self.nicknames.get(client.folded_nickname) is client:
+            del self.nicknames[client.folded_nickname]
+            self.user_index.remove(client)
+            if client.registered:
+                self.propagate(None, "quit", client.nickname, str(quit_message))
         del self.clients[client.connection]
-
-    def print_info(self, msg):
+        count = self.host_connections[client.host] - 1
+        if count:
+            self.host_connections[client.host] = count
+        else:
+            del self.host_connections[client.host]
+
+    def propagate(self, origin, *message):
+        for route in self.routes:
+            if route is not origin:
+                route.send(*message)
+
+    def forward_channel(self, channel, data, origin=None):
+        data = data.decode()
+        for route in channel.routes:
+            if route is not origin:
+                route.send("channel", channel.name, data)
+
+    def add_task(self, task):
+        self.tasks.append(task)
+        if len(self.tasks) == 1:
+            self.engine.wake()
+
+    def run_tasks(self):
+        tasks = self.tasks
+        for _ in range(len(tasks)):
+            task = tasks.popleft()
+            try:
+                next(task)
+            except StopIteration:
+                continue
+            tasks.append(task)
+
+    def close(self):
+        if self.history is not None:
+            self.history.close()
+        self.log.close()
+
+    def deflate_state(self):
+        state = self.__deflate_pool
+        if state is None or not state.fresh:
+            state = self.__deflate_pool = new_deflate_state(self.compress_level)
+        state.users += 1
+        return state
+
+    def schedule_read_queue(self, client):
+        self.read_queues.append(client)
+        if not self.__processing_read_queues:
+            self.__processing_read_queues = True
+            self.add_task(self.__process_read_queues())
+
+    def __process_read_queues(self):
+        clients = self.read_queues
+        while clients:
+            for _ in range(len(clients)):
+                clients.popleft().process_read_queue()
+            yield
+        self.__processing_read_queues = False
+
+    def print_info(self, msg, *args):
         if self.verbose:
-            print(msg)
-            sys.stdout.flush()
+            self.log.log("info", msg, args)
 
-    def print_debug(self, msg):
+    def print_debug(self, msg, *args):
         if self.debug:
-            print(msg)
-            sys.stdout.flush()
-
-    def print_error(self, msg):
-        sys.stderr.write("%s\n" % msg)
+            self.log.log("debug", msg, args)
+
+    def print_error(self, msg, *args):
+        self.log.log("error", msg, args)
+
+    def snapshot(self):
+        if any(x.deflate is not None for x in self.clients.values()):
+            raise HandoffError("connections with compression cannot be handed over")
+        self.fanout.drain()
+        fds = [x.fileno() for x in self.server_sockets]
+        state = {
+            "listeners": list(range(len(fds))),
+            "metrics": None,
+            "control": None,
+            "started": self.metrics.started,
+            "channels": [{"name": x.name, "topic": x.topic, "key": x.key} for x in self.channels.values()],
+            "clients": [],
+        }
+        for (name, s) in [("metrics", self.metrics_endpoint), ("control", self.control_socket)]:
+            if s is not None:
+                state[name] = len(fds)
+                fds.append(s.socket.fileno())
+        for client in self.clients.values():
+            client_state = client.snapshot()
+            client_state["fd"] = len(fds)
+            fds.append(client.connection.fileno())
+            state["clients"].append(client_state)
+        return (state, fds)
+
+    def restore(self, state, sockets):
+        self.metrics.started = state["started"]
+        for client_state in state["clients"]:
+            connection = sockets[client_state["fd"]]
+            connection.setblocking(False)
+            client = Client(self, connection, (client_state["host"], client_state["port"]))
+            self.clients[connection] = client
+            self.host_connections[client.host] = self.host_connections.get(client.host, 0) + 1
+            self.engine.register(client)
+            client.restore(client_state)
+            if client.folded_nickname is not None:
+                self.nicknames[client.folded_nickname] = client
+                if client.registered:
+                    self.user_index.add(client)
+            for channel_name in client_state["channels"]:
+                channel = self.get_channel(channel_name)
+                channel.add_member(client)
+                client.channels[channel.folded_name] = channel
+        for channel_state in state["channels"]:
+            channel = self.channels.get(self.fold(channel_state["name"]))
+            if channel is not None:
+                channel.topic = channel_state["topic"]
+                channel.key = channel_state["key"]
+        server_sockets = [sockets[i] for i in state["listeners"]]
+        for s in server_sockets:
+            s.listen(self.backlog)
+            s.setblocking(False)
+        return server_sockets
+
+    def take_over(self):
+        try:
+            (connection, state, fds) = take_over(self.control_path)
+        except (OSError, ValueError, HandoffError) as e:
+            self.print_error("Could not take over from %s: %s.", self.control_path, e)
+            sys.exit(1)
+        sockets = [socket.socket(fileno=x) for x in fds]
+        try:
+            server_sockets = self.restore(state, sockets)
+            if state["metrics"] is not None and self.metrics_listen:
+                self.metrics_endpoint = MetricsEndpoint(self, self.metrics_listen, sockets[state["metrics"]])
+            if state["control"] is not None:
+                self.control_socket = ControlSocket(self, self.control_path, sockets[state["control"]])
+            connection.sendall(b"READY\n")
+        finally:
+            connection.close()
+        for s in server_sockets:
+            self.print_info("Listening on %s:%d.", *s.getsockname()[:2])
+        self.print_info("Took over %d connections.", len(self.clients))
+        return server_sockets
 
     def start(self):
+        if self.takeover:
+            server_sockets = self.take_over()
+        else:
+            server_sockets = self.bind()
+        self.server_sockets = server_sockets
+
+        if self.metrics_listen:
+            if self.metrics_endpoint is None:
+                self.metrics_endpoint = MetricsEndpoint(self, self.metrics_listen)
+            self.metrics_endpoint.start()
+            self.print_info("Serving metrics on %s.", self.metrics_endpoint.address)
+        if self.control_path:
+            if self.control_socket is None:
+                self.control_socket = ControlSocket(self, self.control_path)
+            self.control_socket.start()
+        for route in self.routes:
+            route.start()
+        if self.link_listen:
+            self.link_listener = LinkListener(self, self.link_listen)
+            self.link_listener.start()
+            self.print_info("Accepting server links on %s.", self.link_listen)
+        for address in self.links:
+            self.connect_link(address)
+
+        try:
+            self.run(server_sockets)
+        except RuntimeError:
+            self.print_error("Fatal exception")
+            raise
+
+    def bind(self):
         server_sockets = []
         for port in self.ports:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
             try:
                 s.bind((self.address, port))
             except socket.error as e:
-                self.print_error("Could not bind port %s: %s." % (port, e))
+                self.print_error("Could not bind port %s: %s.", port, e)
                 sys.exit(1)
 
-            s.listen(5)
+            s.listen(self.backlog)
+            s.setblocking(False)
             server_sockets.append(s)
 
-            self.print_info("Listening on port %d." % port)
+            self.print_info("Listening on port %d.", port)
+        return server_sockets
 
+    def add_route(self, route):
+        self.routes.append(route)
+        route.start()
+
+    def connect_link(self, address):
+        (host, _, port) = address.rpartition(":")
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
         try:
-            self.run(server_sockets)
-        except RuntimeError:
-            self.print_error("Fatal exception")
-            raise
+            s.connect((host or "127.0.0.1", int(port)))
+        except BlockingIOError:
+            pass
+        except socket.error as e:
+            self.print_error("Could not link to %s: %s.", address, e)
+            s.close()
+            self.timers.schedule(LINK_RETRY, lambda: self.connect_link(address))
+            return
+        self.add_route(ServerRoute(self, s, address))
+
+    def add_client(self, connection, address):
+        client = Client(self, connection, address)
+        self.clients[connection] = client
+        self.host_connections[client.host] = self.host_connections.get(client.host, 0) + 1
+        self.metrics.connections_accepted += 1
+        self.engine.register(client)
+        self.print_info("Accepted connection from %s:%s.", address[0], address[1])
+        return client
+
+    def refuse_reason(self, host):
+        if self.max_clients and len(self.clients) >= self.max_clients:
+            return "Server is full"
+        if self.max_clients_per_host and self.host_connections.get(host, 0) >= self.max_clients_per_host:
+            return "Too many connections from your host"
+        return None
+
+    def setup_connection(self, connection):
+        for (level, option, value) in CLIENT_SOCKET_OPTIONS:
+            try:
+                connection.setsockopt(level, option, value)
+            except socket.error:
+                pass
 
-    def run(self, server_sockets):
-        last_aliveness_check = time.time()
+    def refuse_connection(self, connection, address, reason):
+        self.metrics.connections_refused += 1
+        self.print_info("Refused connection from %s:%s (%s).", address[0], address[1], reason)
+        try:
+            connection.setblocking(False)
+            connection.send(("ERROR :%s\r\n" % reason).encode())
+        except socket.error:
+            pass
+        connection.close()
 
-        while True:
-            (iwtd, owtd, ewtd) = select.select(server_sockets + [x.connection for x in self.clients.values()], [x.connection for x in self.clients.values() if x.write_queue_size() > 0], [], 10)
-            for x in iwtd:
-                if x in self.clients:
-                    self.clients[x].socket_readable_notification()
-                else:
-                    (connection, address) = x.accept()
-                    try:
-                        self.clients[connection] = Client(self, connection)
-                        self.print_info("Accepted connection from %s:%s." % (address[0], address[1]))
-                    except socket.error as e:
-                        try:
-                            self.print_error("Socket Error: %s" % e)
-                            connection.close()
-                        except socket.error as e:
-                            self.print_error("Socket Error: %s" % e)
-                            pass
-
-            for x in owtd:
-                if x in self.clients:
-                    self.clients[x].socket_writable_notification()
-
-            now = time.time()
-            if last_aliveness_check + 10 < now:
-                for client in list(self.clients.values()):
-                    client.check_aliveness()
-                last_aliveness_check = now
+    def accept_connection(self, server_socket):
+        for _ in range(self.accept_batch):
+            try:
+                (connection, address) = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                self.print_error("Could not accept a connection: %s.", e)
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    self.pause_accepting()
+                    return
+                continue
+            reason = self.refuse_reason(address[0])
+            if reason is not None:
+                self.refuse_connection(connection, address, reason)
+                continue
+            try:
+                connection.setblocking(False)
+                self.setup_connection(connection)
+                self.add_client(connection, address)
+            except socket.error as e:
+                try:
+                    self.print_error("Socket Error: %s", e)
+                    connection.close()
+                except socket.error as e:
+                    self.print_error("Socket Error: %s", e)
+                    pass
+
+    def pause_accepting(self):
+        for s in self.server_sockets:
+            self.engine.unwatch(s)
+        self.timers.schedule(ACCEPT_RETRY, self.resume_accepting)
+
+    def resume_accepting(self):
+        for s in self.server_sockets:
+            self.engine.watch(s, functools.partial(self.accept_connection, s))
 
+    def run(self, server_sockets):
+        self.engine.run(server_sockets)
 
-def main(argv):
+
+def option_parser():
     op = OptionParser(version=VERSION, description="Simple IRC chat server.")
     op.add_option("--debug", action="store_true", help="print debug messages to stdout")
     op.add_option("--verbose", action="store_true", help="be verbose (print some progress messages to stdout)")
     op.add_option("--listen", metavar="X", help="listen on specific IP address X")
     op.add_option("--ports", metavar="X", help="listen to ports X (a list separated by comma or whitespace)")
+    op.add_option("--backlog", metavar="X", type="int", default=1024, help="queue at most X pending connections per port (default: %default)")
+    op.add_option("--accept-batch", metavar="X", type="int", default=64, help="accept at most X connections per port per event loop iteration (default: %default)")
+    op.add_option("--max-clients", metavar="X", type="int", default=0, help="refuse connections beyond X clients, 0 for no limit (default: %default)")
+    op.add_option("--max-clients-per-host", metavar="X", type="int", default=0, help="refuse connections beyond X clients from one address, 0 for no limit (default: %default)")
+    op.add_option("--fanout-threshold", metavar="X", type="int", default=500, help="deliver messages to channels with at most X members immediately (default: %default)")
+    op.add_option("--fanout-slice", metavar="X", type="int", default=2000, help="deliver at most X queued channel messages per event loop iteration (default: %default)")
+    op.add_option("--max-sendq", metavar="X", type="int", default=2 ** 20, help="disconnect clients with more than X bytes of unsent data (default: %default)")
+    op.add_option("--recv-size", metavar="X", type="int", default=2 ** 14, help="read up to X bytes per recv call (default: %default)")
+    op.add_option("--ping-interval", metavar="X", type="float", default=90, help="send PING to clients idle for X seconds (default: %default)")
+    op.add_option("--ping-timeout", metavar="X", type="float", default=180, help="disconnect clients idle for X seconds (default: %default)")
+    op.add_option("--registration-timeout", metavar="X", type="float", default=90, help="disconnect clients not registered within X seconds (default: %default)")
+    op.add_option("--flood-rate", metavar="X", type="float", default=4, help="let clients spend X command cost units per second, 0 to disable flood control (default: %default)")
+    op.add_option("--flood-burst", metavar="X", type="float", default=20, help="let clients save up to X command cost units (default: %default)")
+    op.add_option("--who-limit", metavar="X", type="int", default=200, help="send at most X entries per WHO or WHOIS mask (default: %default)")
+    op.add_option("--lines-per-tick", metavar="X", type="int", default=10, help="process at most X lines per client per event loop iteration (default: %default)")
+    op.add_option("--max-read-queue", metavar="X", type="int", default=200, help="disconnect clients that keep sending while more than X lines wait to be processed (default: %default)")
+    op.add_option("--compress-level", metavar="X", type="int", default=6, help="let clients enable COMPRESS DEFLATE at zlib level X, 0 to disable compression (default: %default)")
+    op.add_option("--casemapping", metavar="X", default="rfc1459", choices=sorted(CASEMAPPINGS), help="compare nicknames and channel names using casemapping X: %s (default: %%default)" % ", ".join(sorted(CASEMAPPINGS)))
+    op.add_option("--oper", metavar="NAME:PASSWORD", action="append", dest="opers", default=[], help="allow OPER NAME PASSWORD (may be given several times)")
+    op.add_option("--metrics-listen", metavar="X", help="serve Prometheus metrics over HTTP on X ([host:]port, default host 127.0.0.1) or on the Unix socket X (a path containing /)")
+    op.add_option("--log-file", metavar="X", help="write server messages to file X instead of stdout and stderr")
+    op.add_option("--log-format", metavar="X", default="text", choices=["text", "json"], help="log format X: text or json (default: %default)")
+    op.add_option("--log-max-bytes", metavar="X", type="int", default=2 ** 24, help="rotate log files larger than X bytes, 0 to never rotate (default: %default)")
+    op.add_option("--log-backups", metavar="X", type="int", default=5, help="keep X rotated copies of each log file (default: %default)")
+    op.add_option("--channel-log-dir", metavar="X", help="store channel log in directory X")
+    op.add_option("--history-dir", metavar="X", help="store channel history in directory X")
+    op.add_option("--history-segment-size", metavar="X", type="int", default=2 ** 20, help="store channel history in segment files of X bytes (default: %default)")
+    op.add_option("--history-segments", metavar="X", type="int", default=16, help="keep at most X history segments per channel (default: %default)")
+    op.add_option("--history-retention", metavar="X", type="float", default=0, help="forget channel history older than X seconds, 0 to keep it (default: %default)")
+    op.add_option("--history-join-lines", metavar="X", type="int", default=20, help="replay the last X channel messages on JOIN (default: %default)")
+    op.add_option("--history-max-lines", metavar="X", type="int", default=100, help="return at most X messages per CHATHISTORY request (default: %default)")
+    op.add_option("--control-socket", metavar="X", help="accept hot restart requests on the Unix socket X")
+    op.add_option("--takeover", action="store_true", help="take over listening sockets, clients and channels from the server running with the same --control-socket")
+    op.add_option("--server-name", metavar="X", help="use X as the server name (default: the host name)")
+    op.add_option("--link-listen", metavar="X", help="accept server links on X ([host:]port)")
+    op.add_option("--link", metavar="HOST:PORT", action="append", dest="links", default=[], help="link to the server accepting links on HOST:PORT (may be given several times)")
+    op.add_option("--link-password", metavar="X", help="require and send password X on server links")
+    op.add_option("--max-link-sendq", metavar="X", type="int", default=LINK_MAX_SENDQ, help="close server and worker links with more than X bytes of unsent data (default: %default)")
+    op.add_option("--workers", metavar="X", type="int", default=1, help="run X worker processes accepting on the same ports (default: %default)")
+    op.add_option("--engine", metavar="X", default="selectors", choices=available_engines(), help="event engine X: %s (default: selectors)" % ", ".join(available_engines()))
+    op.add_option("--backend", metavar="X", default="auto", choices=available_backends(), help="event loop backend X: %s (default: auto)" % ", ".join(available_backends()))
+    return op
+
+
+def main(argv):
+    op = option_parser()
     (options, args) = op.parse_args(argv[1:])
 
     if options.debug:
         options.verbose = True
     if options.ports is None:
         options.ports = "8888"
+    if options.takeover and not options.control_socket:
+        op.error("--takeover requires --control-socket")
 
     ports = []
     for port in re.split(r"[,\s]+", options.ports):
@@ -481,11 +1669,104 @@ def main(argv):
             op.error("Bad port: %r" % port)
     options.ports = ports
 
-    server = Server(options)
+    opers = []
+    for oper in options.opers:
+        (name, separator, password) = oper.partition(":")
+        if not name or not separator:
+            op.error("Bad operator: %r (expected NAME:PASSWORD)" % oper)
+        opers.append((name, password))
+    options.opers = opers
+
+    if options.channel_log_dir and not os.path.isdir(options.channel_log_dir):
+        op.error("Channel log directory does not exist: %r" % options.channel_log_dir)
+    if options.history_dir and not os.path.isdir(options.history_dir):
+        op.error("History directory does not exist: %r" % options.history_dir)
+    if options.history_segment_size < MIN_SEGMENT_SIZE:
+        op.error("History segments must be at least %d bytes" % MIN_SEGMENT_SIZE)
+
+    if not 0 <= options.compress_level <= 9:
+        op.error("Bad compression level: %d" % options.compress_level)
+    if options.workers < 1:
+        op.error("Bad number of workers: %d" % options.workers)
+    if options.backlog < 1 or options.accept_batch < 1:
+        op.error("--backlog and --accept-batch must be positive")
+    if options.fanout_threshold < 0 or options.fanout_slice < 1:
+        op.error("Bad fanout threshold or slice")
+    if options.max_clients < 0 or options.max_clients_per_host < 0:
+        op.error("Client limits cannot be negative")
+    if options.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            op.error("--workers requires SO_REUSEPORT")
+        for (name, value) in [("--control-socket", options.control_socket), ("--history-dir", options.history_dir), ("--metrics-listen", options.metrics_listen)]:
+            if value:
+                op.error("--workers cannot be combined with %s" % name)
+
+    if (options.link_listen or options.links) and not options.link_password:
+        op.error("--link and --link-listen require --link-password")
+    if options.link_listen or options.links:
+        for (name, value) in [("--workers", options.workers > 1), ("--control-socket", options.control_socket)]:
+            if value:
+                op.error("Server links cannot be combined with %s" % name)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if options.workers > 1:
+        run_workers(options)
+    else:
+        serve(Server(options))
+
+
+def serve(server):
     try:
         server.start()
     except KeyboardInterrupt:
         server.print_error("Interrupted.")
+    finally:
+        server.close()
+
+
+def run_worker(options, connection):
+    code = 1
+    try:
+        server = Server(options)
+        server.routes.append(Route(server, connection))
+        serve(server)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def run_workers(options):
+    connections = []
+    pids = []
+    for _ in range(options.workers):
+        (connection, worker_connection) = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            for x in connections:
+                x.close()
+            run_worker(options, worker_connection)
+        worker_connection.close()
+        connections.append(connection)
+        pids.append(pid)
+    try:
+        Broker(options.casemapping, connections, options.max_link_sendq).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
 
 
 if __name__ == "__main__":
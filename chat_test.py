@@ -1,11 +1,17 @@
 import re
+import random
 import os
 import time
 import signal
 import socket
+import tempfile
 import subprocess
 
-from nose.tools import assert_not_in, assert_true
+from nose.tools import assert_equal, assert_in, assert_is_none, assert_not_in, assert_true
+
+import chat
+from chat import format_message, parse_message
+from testutil import connect, make_client, make_server, received, run_tasks
 
 
 SERVER_PORT = 12345
@@ -84,3 +90,385 @@ class TestBasicFunctionality(ServerFixture):
         self.connect("john")
         self.send("john", "lusers")
         self.expect("john", r":local\S+ 251 apa :There are \d+ users on servers*")
+
+
+class TestParseMessage:
+
+    def test_command_is_upper_cased(self):
+        message = parse_message("ping :fisk")
+        assert_equal((message.command, message.params, message.prefix), ("PING", ["fisk"], None))
+
+    def test_trailing_parameter(self):
+        message = parse_message("SENDMSG #chan :hello there")
+        assert_equal(message.params, ["#chan", "hello there"])
+
+    def test_prefix(self):
+        message = parse_message(":john!john@host SENDMSG john :hi")
+        assert_equal((message.prefix, message.command), ("john!john@host", "SENDMSG"))
+
+    def test_empty_line(self):
+        assert_is_none(parse_message(""))
+
+    def test_format_round_trip(self):
+        for line in ["PING :fisk", "SENDMSG #chan :hello there", ":john!john@host SENDMSG john hi", "USER a * * :", "JOIN #a,#b key"]:
+            assert_equal(format_message(parse_message(line)), line.replace(" :fisk", " fisk"))
+
+
+class TestFloodControl:
+
+    def test_excess_lines_wait_for_tokens(self):
+        server = make_server("--flood-rate=1", "--flood-burst=5")
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        client.data_received(b"PING :a\r\n" * 20)
+        assert_equal(received(client, peer).count("PONG"), 4)
+        assert_true(not client.closed)
+
+    def test_lines_per_tick(self):
+        server = make_server("--lines-per-tick=3")
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        client.data_received(b"PING :a\r\n" * 7)
+        assert_equal(received(client, peer).count("PONG"), 3)
+        server.run_tasks()
+        assert_equal(received(client, peer).count("PONG"), 3)
+        server.run_tasks()
+        assert_equal(received(client, peer).count("PONG"), 1)
+        assert_equal(len(server.tasks), 1)
+        server.run_tasks()
+        assert_equal(len(server.tasks), 0)
+
+    def test_excess_flood(self):
+        server = make_server("--flood-rate=1", "--flood-burst=5", "--max-read-queue=10")
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"PING :a\r\n" * 30)
+        assert_true(not client.closed)
+        client.data_received(b"PING :a\r\n")
+        assert_true(client.closed)
+        assert_true("ERROR :Excess Flood" in received(client, peer))
+
+    def test_channel_message_target_is_folded_once(self):
+        server = make_server("--flood-rate=1")
+        (john, _) = make_client(server, "john")
+        (jack, peer) = make_client(server, "jack")
+        john.data_received(b"JOIN #Chan\r\n")
+        jack.data_received(b"JOIN #chan\r\n")
+        received(jack, peer)
+        folded = []
+        fold = server.fold
+        server.fold = lambda name: folded.append(name) or fold(name)
+        john.data_received(b"SENDMSG #CHAN :hi\r\n")
+        assert_equal(folded, ["#CHAN"])
+        assert_equal(received(jack, peer), ":john!john@127.0.0.1 SENDMSG #Chan :hi\r\n")
+
+    def test_excess_flood_without_flood_control(self):
+        server = make_server("--max-read-queue=10", "--lines-per-tick=5")
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        client.data_received(b"PING :a\r\n" * 30)
+        run_tasks(server)
+        assert_true(not client.closed)
+        assert_equal(received(client, peer).count("PONG"), 30)
+        client.data_received(b"PING :a\r\n" * 30)
+        assert_true(not client.closed)
+        client.data_received(b"PING :a\r\n")
+        assert_true(client.closed)
+        assert_true("ERROR :Excess Flood" in received(client, peer))
+
+
+class TestHistoryReplay:
+
+    def history_lines(self, client, peer):
+        return [x for x in received(client, peer).splitlines() if " SENDMSG " in x]
+
+    def test_time_tags_need_server_time(self):
+        with tempfile.TemporaryDirectory() as directory:
+            server = make_server("--history-dir=%s" % directory)
+            (john, _) = make_client(server, "john")
+            john.data_received(b"JOIN #chan\r\nSENDMSG #chan :one\r\nSENDMSG #chan :two\r\n")
+            (plain, peer) = make_client(server, "plain")
+            plain.data_received(b"JOIN #chan\r\nCHATHISTORY LATEST #chan * 10\r\n")
+            assert_equal(self.history_lines(plain, peer), [":john!john@127.0.0.1 SENDMSG #chan :one", ":john!john@127.0.0.1 SENDMSG #chan :two"] * 2)
+            (tagged, peer) = connect(server)
+            tagged.data_received(b"CAP LS 302\r\nNICK tagged\r\nUSER tagged * * :tagged\r\nCAP REQ :server-time\r\n")
+            output = received(tagged, peer)
+            assert_in("CAP * LS :server-time\r\n", output)
+            assert_in("CAP tagged ACK :server-time\r\n", output)
+            assert_not_in(" 001 ", output)
+            tagged.data_received(b"CAP END\r\nJOIN #chan\r\n")
+            lines = self.history_lines(tagged, peer)
+            assert_equal(len(lines), 2)
+            assert_true(all(x.startswith("@time=") for x in lines))
+            tagged.data_received(b"CAP REQ :-server-time\r\nCHATHISTORY LATEST #chan * 1\r\n")
+            assert_equal(self.history_lines(tagged, peer), [":john!john@127.0.0.1 SENDMSG #chan :two"])
+            server.close()
+
+    def test_unknown_capabilities_are_refused(self):
+        server = make_server()
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        client.data_received(b"CAP REQ :server-time sasl\r\nCAP LIST\r\nCAP FOO\r\n")
+        assert_equal(received(client, peer).splitlines(), [
+            ":%s CAP john NAK :server-time sasl" % server.name,
+            ":%s CAP john LIST :" % server.name,
+            ":%s 410 john FOO :Invalid CAP command" % server.name,
+        ])
+
+
+class TestAccept:
+
+    def make_server(self, *args):
+        server = make_server(*args)
+        server.ports = [0]
+        server.server_sockets = server.bind()
+        return server
+
+    def connect(self, server, count):
+        port = server.server_sockets[0].getsockname()[1]
+        sockets = [socket.create_connection(("127.0.0.1", port)) for _ in range(count)]
+        time.sleep(0.05)
+        return sockets
+
+    def test_accepts_a_batch_per_call(self):
+        server = self.make_server("--accept-batch=3")
+        sockets = self.connect(server, 5)
+        server.accept_connection(server.server_sockets[0])
+        assert_equal(len(server.clients), 3)
+        server.accept_connection(server.server_sockets[0])
+        assert_equal(len(server.clients), 5)
+        server.accept_connection(server.server_sockets[0])
+        for client in server.clients.values():
+            assert_equal(client.connection.gettimeout(), 0.0)
+            assert_true(client.connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        for s in sockets:
+            s.close()
+
+    def test_client_limits(self):
+        server = self.make_server("--max-clients-per-host=2")
+        sockets = self.connect(server, 3)
+        server.accept_connection(server.server_sockets[0])
+        assert_equal(len(server.clients), 2)
+        assert_equal(server.host_connections, {"127.0.0.1": 2})
+        assert_equal(server.metrics.connections_refused, 1)
+        assert_equal(sockets[2].recv(4096), b"ERROR :Too many connections from your host\r\n")
+        next(iter(server.clients.values())).disconnect("bye")
+        assert_equal(server.host_connections, {"127.0.0.1": 1})
+        for s in sockets:
+            s.close()
+
+
+class Member(object):
+    route = None
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class TestNamesChunks:
+
+    def check(self, server, channel, members):
+        chunks = [x.decode().split(" ") for x in channel.names_chunks()]
+        assert_equal(sum(chunks, []), sorted(members))
+        for names in chunks:
+            line = ":%s 353 %s = %s :%s\r\n" % (server.name, "x" * chat.NICKNAME_LENGTH, channel.name, " ".join(names))
+            assert_true(len(line) <= 512)
+
+    def test_random_operations_keep_chunks_sorted_and_short(self):
+        server = make_server()
+        channel = server.get_channel("#chan")
+        rng = random.Random(42)
+        members = {"anchor": Member("anchor")}
+        channel.add_member(members["anchor"])
+        for step in range(3000):
+            op = rng.random()
+            if len(members) > 1 and op < 0.35:
+                nickname = rng.choice(sorted(set(members) - {"anchor"}))
+                channel.remove_client(members.pop(nickname))
+            elif len(members) > 1 and op < 0.5:
+                old = rng.choice(sorted(set(members) - {"anchor"}))
+                new = "r%d_%s" % (step, old)[:chat.NICKNAME_LENGTH]
+                member = members.pop(old)
+                member.nickname = new
+                members[new] = member
+                channel.rename_member(old, new)
+            else:
+                nickname = "n%05d%s" % (rng.randrange(100000), "x" * rng.randrange(40))
+                if nickname not in members:
+                    members[nickname] = Member(nickname)
+                    channel.add_member(members[nickname])
+            if step % 50 == 0:
+                self.check(server, channel, members)
+        self.check(server, channel, members)
+
+    def test_names_reply_is_split_into_lines(self):
+        server = make_server()
+        (client, peer) = make_client(server, "john")
+        channel = server.get_channel("#chan")
+        names = ["member%03d" % i for i in range(200)]
+        for name in names:
+            channel.add_member(Member(name))
+        received(client, peer)
+        client.data_received(b"NAMES #chan\r\n")
+        lines = received(client, peer).split("\r\n")[:-1]
+        assert_true(len(lines) > 2)
+        assert_true(all(len(x) + 2 <= 512 for x in lines))
+        assert_equal(sum((x.split(" :", 1)[1].split(" ") for x in lines[:-1]), []), names)
+        assert_equal(lines[-1], ":%s 366 john #chan :End of NAMES list" % server.name)
+
+
+class TestList:
+
+    def make_channels(self, server):
+        sizes = {}
+        for i in range(350):
+            name = "#%s%03d" % ("ab"[i % 2], i)
+            channel = server.get_channel(name)
+            for j in range(i % 7):
+                channel.add_member(Member("m%d" % j))
+            if channel.clients:
+                sizes[name] = len(channel.clients)
+            else:
+                server.remove_channel(channel)
+        return sizes
+
+    def listed(self, server, client, peer, query):
+        client.data_received(b"LIST " + query + b"\r\n")
+        assert_equal(received(client, peer), "")
+        counts = []
+        output = ""
+        while server.tasks:
+            server.run_tasks()
+            chunk = received(client, peer)
+            counts.append(chunk.count(" 322 "))
+            output += chunk
+        lines = output.split("\r\n")[:-1]
+        assert_equal(lines[-1], ":%s 323 john :End of LIST" % server.name)
+        return (counts, [x.split(" ")[3] for x in lines[:-1]])
+
+    def test_list_streams_across_ticks(self):
+        server = make_server()
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        sizes = self.make_channels(server)
+        (counts, names) = self.listed(server, client, peer, b">0")
+        assert_true(len([x for x in counts if x]) >= 3)
+        assert_true(max(counts) <= chat.LIST_BATCH_SIZE)
+        assert_equal(names, sorted(sizes))
+
+    def test_list_filters(self):
+        server = make_server()
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        sizes = self.make_channels(server)
+        (_, names) = self.listed(server, client, peer, b">2,<6")
+        assert_equal(names, sorted(x for (x, n) in sizes.items() if 2 < n < 6))
+        (_, names) = self.listed(server, client, peer, b"#a*,!#a1*")
+        assert_equal(names, sorted(x for x in sizes if x.startswith("#a") and not x.startswith("#a1")))
+        (_, names) = self.listed(server, client, peer, b"#b0?1,>3")
+        assert_equal(names, sorted(x for (x, n) in sizes.items() if re.match(r"#b0.1$", x) and n > 3))
+
+    def test_list_waits_for_the_send_queue_outside_the_task_list(self):
+        server = make_server("--max-sendq=4096")
+        (client, peer) = make_client(server, "john")
+        received(client, peer)
+        sizes = self.make_channels(server)
+        client.data_received(b"LIST\r\n")
+        output = ""
+        parked = 0
+        while "323 john" not in output:
+            server.run_tasks()
+            if client.write_queue_size() > server.max_sendq // 2:
+                assert_equal(len(server.tasks), 0)
+                parked += 1
+            output += received(client, peer)
+        assert_true(parked >= 2)
+        assert_equal(output.count(" 322 "), len(sizes))
+
+
+class TestWriteQueue:
+
+    def read_all(self, peer):
+        chunks = []
+        try:
+            while True:
+                chunks.append(peer.recv(2 ** 16))
+        except BlockingIOError:
+            pass
+        return b"".join(chunks)
+
+    def test_partial_writes_keep_byte_order(self):
+        server = make_server()
+        (client, peer) = connect(server, buffer_size=4096)
+        expected = b"".join(b"line %05d %s\r\n" % (i, b"x" * (i % 97)) for i in range(2000))
+        for line in expected.splitlines(True):
+            client.enqueue(line)
+        output = b""
+        calls = 0
+        offsets = set()
+        while client.has_output():
+            client.socket_writable_notification()
+            offsets.add(client._Client__write_offset)
+            calls += 1
+            output += self.read_all(peer)
+        assert_true(calls > 5)
+        assert_true(len(offsets) > 2)
+        assert_equal(output, expected)
+        assert_equal(client.write_queue_size(), 0)
+
+    def test_full_socket_keeps_the_connection(self):
+        server = make_server("--max-sendq=%d" % 2 ** 24)
+        (client, peer) = connect(server, buffer_size=4096)
+        expected = (b"x" * 1000 + b"\r\n") * 500
+        for line in expected.splitlines(True):
+            client.enqueue(line)
+        for _ in range(100):
+            client.socket_writable_notification()
+        assert_true(not client.closed)
+        output = self.read_all(peer)
+        while client.has_output():
+            client.socket_writable_notification()
+            output += self.read_all(peer)
+        assert_equal(output, expected)
+
+    def test_writes_are_batched_by_iov_max(self):
+        server = make_server()
+        (client, peer) = connect(server)
+        extra = 7
+        for i in range(chat.IOV_MAX + extra):
+            client.enqueue(b"%d\r\n" % i)
+        client.socket_writable_notification()
+        assert_equal(len(client._Client__write_queue), extra)
+        client.socket_writable_notification()
+        assert_true(not client.has_output())
+        assert_equal(self.read_all(peer), b"".join(b"%d\r\n" % i for i in range(chat.IOV_MAX + extra)))
+
+    def test_sendq_exceeded(self):
+        server = make_server("--max-sendq=20000")
+        (client, peer) = connect(server, buffer_size=4096)
+        line = b"x" * 1000 + b"\r\n"
+        for _ in range(15):
+            client.enqueue(line)
+        client.socket_writable_notification()
+        assert_true(not client.closed)
+        while not client.closed:
+            client.enqueue(line)
+        assert_equal(client.write_queue_size(), len(b"ERROR :SendQ exceeded\r\n"))
+        assert_true(client.connection not in server.clients)
+
+
+class TestChannelFanout:
+
+    def test_message_is_encoded_once(self):
+        server = make_server()
+        pairs = [make_client(server, "user%d" % i) for i in range(20)]
+        for (client, peer) in pairs:
+            client.data_received(b"JOIN #chan\r\n")
+        for (client, peer) in pairs:
+            received(client, peer)
+        sender = pairs[0][0]
+        data = sender.message_channel(server.channels["#chan"], "SENDMSG", "#chan :hello")
+        assert_equal(data, b":user0!user0@127.0.0.1 SENDMSG #chan :hello\r\n")
+        assert_true(not sender.has_output())
+        for (client, peer) in pairs[1:]:
+            assert_equal(len(client._Client__write_queue), 1)
+            assert_true(client._Client__write_queue[0] is data)
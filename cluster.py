@@ -0,0 +1,633 @@
+import hmac
+import json
+import socket
+import selectors
+import collections
+
+from framing import LineFramer
+from casemapping import CaseMapping
+from engine import IOV_MAX
+
+
+LINK_LINE_LENGTH = 2 ** 20
+LINK_RECV_SIZE = 2 ** 16
+LINK_PROTOCOL_VERSION = 1
+LINK_RETRY = 10
+LINK_MAX_SENDQ = 2 ** 26
+
+
+class RemoteClient(object):
+    __slots__ = ("route", "channels", "nickname", "folded_nickname", "user", "real_name", "host", "signon")
+
+    registered = True
+    closed = False
+    oper = False
+    deflate = None
+
+    def __init__(self, route, nickname, folded_nickname, user, host, real_name, signon=0):
+        self.route = route
+        self.channels = {}
+        self.nickname = nickname
+        self.folded_nickname = folded_nickname
+        self.user = user
+        self.host = host
+        self.real_name = real_name
+        self.signon = signon
+
+    def get_prefix(self):
+        return "%s!%s@%s" % (self.nickname, self.user, self.host)
+    prefix = property(get_prefix)
+
+    def message(self, msg):
+        self.route.send("private", self.nickname, msg)
+
+    def enqueue(self, data):
+        pass
+    enqueue_compressed = enqueue
+
+
+class Link(object):
+
+    def __init__(self, engine, sock, max_sendq=LINK_MAX_SENDQ):
+        self.engine = engine
+        self.socket = sock
+        sock.setblocking(False)
+        self.framer = LineFramer(LINK_LINE_LENGTH)
+        self.output = collections.deque()
+        self.output_size = 0
+        self.output_offset = 0
+        self.max_sendq = max_sendq
+        self.closed = False
+
+    def start(self):
+        self.engine.watch(self.socket, self.readable)
+
+    def send(self, *message):
+        self.write((json.dumps(message, ensure_ascii=False) + "\n").encode())
+
+    def write(self, data):
+        if self.closed:
+            return
+        if self.output_size + len(data) > self.max_sendq:
+            self.sendq_exceeded()
+            return
+        if not self.output:
+            self.engine.watch(self.socket, self.readable, self.writable)
+        self.output.append(data)
+        self.output_size += len(data)
+
+    def readable(self):
+        try:
+            data = self.socket.recv(LINK_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b""
+        if not data:
+            self.close()
+            return
+        for line in self.framer.feed(data):
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+                if not isinstance(message, list) or not message or not isinstance(message[0], str):
+                    raise ValueError("expected a command list")
+                self.handle(message, line)
+            except (TypeError, ValueError, AttributeError) as e:
+                self.malformed(e)
+            if self.closed:
+                return
+
+    def writable(self):
+        queue = self.output
+        if not queue:
+            return
+        chunks = [memoryview(queue[0])[self.output_offset:]]
+        for i in range(1, min(len(queue), IOV_MAX)):
+            chunks.append(queue[i])
+        try:
+            sent = self.socket.sendmsg(chunks)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            self.close()
+            return
+        self.output_size -= sent
+        sent += self.output_offset
+        while queue and sent >= len(queue[0]):
+            sent -= len(queue.popleft())
+        self.output_offset = sent
+        if not queue:
+            self.engine.watch(self.socket, self.readable)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.engine.unwatch(self.socket)
+        self.socket.close()
+        self.output.clear()
+        self.output_size = 0
+        self.output_offset = 0
+        self.closed_notification()
+
+    def sendq_exceeded(self):
+        self.close()
+
+    def handle(self, message, line):
+        pass
+
+    def malformed(self, error):
+        self.close()
+
+    def closed_notification(self):
+        pass
+
+
+class Route(Link):
+    handlers = {}
+    name = None
+
+    def __init__(self, server, sock):
+        Link.__init__(self, server.engine, sock, server.max_link_sendq)
+        self.server = server
+
+    def handle(self, message, line):
+        handler = self.handlers.get(message[0])
+        if handler is None:
+            raise ValueError("unknown command %r" % message[0])
+        handler(self, *message[1:])
+
+    def malformed(self, error):
+        self.server.print_error("Malformed message from %s: %s.", self.name or "a server link", error)
+        self.close()
+
+    def sendq_exceeded(self):
+        self.server.print_error("SendQ exceeded on %s.", self.name or "a server link")
+        self.close()
+
+    def remote_client(self, nickname):
+        client = self.server.get_client(nickname)
+        if client is not None and client.route is self:
+            return client
+        return None
+
+    def forget(self, client):
+        server = self.server
+        for channel in client.channels.values():
+            channel.remove_client(client)
+        client.channels = {}
+        if server.nicknames.get(client.folded_nickname) is client:
+            del server.nicknames[client.folded_nickname]
+            server.user_index.remove(client)
+        server.remote_users -= 1
+
+    def collide(self, client, nickname, signon):
+        if client.route is None:
+            client.disconnect("Nickname collision")
+        else:
+            client.route.forget(client)
+        return True
+
+    def user_handler(self, nickname, user, host, real_name, signon=0):
+        server = self.server
+        folded_nickname = server.fold(nickname)
+        client = server.nicknames.get(folded_nickname)
+        if client is not None and not self.collide(client, nickname, signon):
+            return
+        client = RemoteClient(self, nickname, folded_nickname, user, host, real_name, signon)
+        server.nicknames[folded_nickname] = client
+        server.user_index.add(client)
+        server.remote_users += 1
+        server.propagate(self, "user", nickname, user, host, real_name, signon)
+
+    def nick_handler(self, old_nickname, new_nickname, signon=0):
+        server = self.server
+        client = self.remote_client(old_nickname)
+        if client is None:
+            return
+        folded_nickname = server.fold(new_nickname)
+        other = server.nicknames.get(folded_nickname)
+        if other is not None and other is not client and not self.collide(other, new_nickname, signon):
+            self.forget(client)
+            server.propagate(self, "quit", old_nickname, "Nickname collision")
+            return
+        old_folded_nickname = client.folded_nickname
+        del server.nicknames[old_folded_nickname]
+        client.nickname = new_nickname
+        client.folded_nickname = folded_nickname
+        client.signon = signon
+        server.nicknames[folded_nickname] = client
+        server.user_index.rename(client, old_folded_nickname)
+        for channel in client.channels.values():
+            channel.rename_member(old_nickname, new_nickname)
+        server.propagate(self, "nick", old_nickname, new_nickname, signon)
+
+    def quit_handler(self, nickname, quit_message):
+        client = self.remote_client(nickname)
+        if client is not None:
+            self.forget(client)
+            self.server.propagate(self, "quit", nickname, quit_message)
+
+    def join_handler(self, nickname, channel_name):
+        client = self.remote_client(nickname)
+        if client is None:
+            return
+        channel = self.server.get_channel(channel_name)
+        if channel.folded_name in client.channels:
+            return
+        channel.add_member(client)
+        client.channels[channel.folded_name] = channel
+        self.server.propagate(self, "join", nickname, channel_name)
+
+    def part_handler(self, nickname, channel_name):
+        client = self.remote_client(nickname)
+        if client is None:
+            return
+        channel = client.channels.pop(self.server.fold(channel_name), None)
+        if channel is not None:
+            channel.remove_client(client)
+            self.server.propagate(self, "part", nickname, channel_name)
+
+    def channel_handler(self, channel_name, data):
+        channel = self.server.channels.get(self.server.fold(channel_name))
+        if channel is None:
+            return
+        encoded = data.encode()
+        self.server.fanout.deliver(channel, encoded)
+        if channel.routes:
+            self.server.forward_channel(channel, encoded, self)
+
+    def private_handler(self, nickname, msg):
+        client = self.server.get_client(nickname)
+        if client is not None and client.route is not self:
+            client.message(msg)
+
+    def collision_handler(self, nickname):
+        client = self.server.get_client(nickname)
+        if client is not None and client.route is None:
+            client.disconnect("Nickname collision")
+
+    def closed_notification(self):
+        server = self.server
+        server.print_error("Lost the link to the broker.")
+        for client in list(server.nicknames.values()):
+            if client.route is self:
+                self.forget(client)
+        server.routes.remove(self)
+
+
+Route.handlers = {
+    "user": Route.user_handler,
+    "nick": Route.nick_handler,
+    "quit": Route.quit_handler,
+    "join": Route.join_handler,
+    "part": Route.part_handler,
+    "channel": Route.channel_handler,
+    "private": Route.private_handler,
+    "collision": Route.collision_handler,
+}
+
+
+class ServerRoute(Route):
+    handlers = dict(Route.handlers)
+
+    def __init__(self, server, sock, address=None):
+        Route.__init__(self, server, sock)
+        self.address = address
+        self.name = None
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+
+    def start(self):
+        Route.start(self)
+        self.send("hello", LINK_PROTOCOL_VERSION, self.server.name, self.server.link_password)
+
+    def handle(self, message, line):
+        if self.name is None and message[0] not in ("hello", "error"):
+            self.close()
+            return
+        Route.handle(self, message, line)
+
+    def refuse(self, reason):
+        self.server.print_error("Refused server link: %s.", reason)
+        self.send("error", reason)
+        self.writable()
+        self.close()
+
+    def hello_handler(self, version, name, password):
+        server = self.server
+        if self.name is not None:
+            return
+        if not isinstance(name, str) or not isinstance(password, str):
+            self.refuse("Malformed hello")
+        elif version != LINK_PROTOCOL_VERSION:
+            self.refuse("Unsupported link protocol version %r" % version)
+        elif not hmac.compare_digest(password.encode(), server.link_password.encode()):
+            self.refuse("Bad link password")
+        elif name == server.name or name in server.servers:
+            self.refuse("Server %s is already linked" % name)
+        else:
+            self.name = name
+            server.servers[name] = self
+            server.print_info("Linked with %s.", name)
+            server.propagate(self, "server", name)
+            self.send_burst()
+
+    def send_burst(self):
+        server = self.server
+        for (name, route) in server.servers.items():
+            if route is not self:
+                self.send("server", name)
+        for client in server.nicknames.values():
+            if client.registered and client.route is not self:
+                self.send("user", client.nickname, client.user, client.host, client.real_name, client.signon)
+        for channel in server.channels.values():
+            for client in channel.clients:
+                if client.registered and client.route is not self:
+                    self.send("join", client.nickname, channel.name)
+            if channel.topic:
+                self.send("topic", channel.name, channel.topic)
+
+    def server_handler(self, name):
+        server = self.server
+        if name == server.name or name in server.servers:
+            self.refuse("Loop detected: %s is already linked" % name)
+            return
+        server.servers[name] = self
+        server.propagate(self, "server", name)
+
+    def squit_handler(self, name):
+        server = self.server
+        if server.servers.get(name) is self:
+            del server.servers[name]
+            server.propagate(self, "squit", name)
+
+    def topic_handler(self, channel_name, topic):
+        channel = self.server.channels.get(self.server.fold(channel_name))
+        if channel is not None and channel.topic != topic:
+            channel.topic = topic
+            self.server.propagate(self, "topic", channel_name, topic)
+
+    def kill_handler(self, nickname, reason):
+        client = self.server.get_client(nickname)
+        if client is not None and client.route is not self:
+            self.kill(client, reason)
+
+    def error_handler(self, reason):
+        self.server.print_error("Link %s closed by peer: %s.", self.name or self.address, reason)
+        self.close()
+
+    def kill(self, client, reason):
+        route = client.route
+        if route is None:
+            client.disconnect(reason)
+            return
+        route.forget(client)
+        route.send("kill", client.nickname, reason)
+        for other in self.server.routes:
+            if other is not route:
+                other.send("quit", client.nickname, reason)
+
+    def collide(self, client, nickname, signon):
+        if client.route is None and not client.registered:
+            client.disconnect("Nickname collision")
+            return True
+        if signon <= client.signon:
+            self.kill(client, "Nickname collision")
+        if signon >= client.signon:
+            self.send("kill", nickname, "Nickname collision")
+            return False
+        return True
+
+    def closed_notification(self):
+        server = self.server
+        server.routes.remove(self)
+        if self.name is not None:
+            server.print_error("Lost the link to %s.", self.name)
+            split = [x for (x, route) in server.servers.items() if route is self]
+            for name in split:
+                del server.servers[name]
+                server.propagate(self, "squit", name)
+            reason = "%s %s" % (server.name, self.name)
+            for client in list(server.nicknames.values()):
+                if client.route is self:
+                    self.forget(client)
+                    server.propagate(self, "quit", client.nickname, reason)
+        if self.address is not None:
+            server.timers.schedule(LINK_RETRY, lambda: server.connect_link(self.address))
+
+
+ServerRoute.handlers.update({
+    "hello": ServerRoute.hello_handler,
+    "server": ServerRoute.server_handler,
+    "squit": ServerRoute.squit_handler,
+    "topic": ServerRoute.topic_handler,
+    "kill": ServerRoute.kill_handler,
+    "error": ServerRoute.error_handler,
+})
+del ServerRoute.handlers["collision"]
+
+
+class LinkListener(object):
+
+    def __init__(self, server, address):
+        self.server = server
+        self.address = address
+        (host, _, port) = address.rpartition(":")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host or server.address, int(port)))
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+
+    def start(self):
+        self.server.engine.watch(self.socket, self.accept)
+
+    def accept(self):
+        try:
+            (connection, _) = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.server.add_route(ServerRoute(self.server, connection))
+
+
+class WorkerLink(Link):
+
+    def __init__(self, broker, sock, max_sendq=LINK_MAX_SENDQ):
+        Link.__init__(self, broker, sock, max_sendq)
+        self.broker = broker
+
+    def handle(self, message, line):
+        self.broker.handle(self, message, line)
+
+    def closed_notification(self):
+        self.broker.worker_exited(self)
+
+
+class BrokerUser(object):
+    __slots__ = ("link", "nickname", "channels")
+
+    def __init__(self, link, nickname):
+        self.link = link
+        self.nickname = nickname
+        self.channels = set()
+
+
+class Broker(object):
+    handlers = {}
+
+    def __init__(self, casemapping, sockets, max_sendq=LINK_MAX_SENDQ):
+        self.fold = CaseMapping(casemapping).fold
+        self.selector = selectors.DefaultSelector()
+        self.watchers = {}
+        self.users = {}
+        self.channels = {}
+        self.links = [WorkerLink(self, s, max_sendq) for s in sockets]
+
+    def watch(self, fileobj, on_readable=None, on_writable=None):
+        events = 0
+        if on_readable is not None:
+            events |= selectors.EVENT_READ
+        if on_writable is not None:
+            events |= selectors.EVENT_WRITE
+        if fileobj in self.watchers:
+            self.selector.modify(fileobj, events)
+        else:
+            self.selector.register(fileobj, events)
+        self.watchers[fileobj] = (on_readable, on_writable)
+
+    def unwatch(self, fileobj):
+        if self.watchers.pop(fileobj, None) is not None:
+            self.selector.unregister(fileobj)
+
+    def poll(self, timeout=None):
+        for (key, events) in self.selector.select(timeout):
+            watcher = self.watchers.get(key.fileobj)
+            if watcher is not None and events & selectors.EVENT_READ:
+                watcher[0]()
+            watcher = self.watchers.get(key.fileobj)
+            if watcher is not None and events & selectors.EVENT_WRITE and watcher[1] is not None:
+                watcher[1]()
+
+    def run(self):
+        for link in self.links:
+            link.start()
+        while self.links:
+            self.poll()
+
+    def handle(self, link, message, line):
+        handler = self.handlers.get(message[0])
+        if handler is None:
+            raise ValueError("unknown command %r" % message[0])
+        handler(self, link, line, *message[1:])
+
+    def broadcast(self, origin, line):
+        data = (line + "\n").encode()
+        for link in self.links:
+            if link is not origin:
+                link.write(data)
+
+    def __owned_user(self, link, nickname):
+        user = self.users.get(self.fold(nickname))
+        if user is not None and user.link is link:
+            return user
+        return None
+
+    def __leave(self, link, folded_channel_name):
+        members = self.channels[folded_channel_name]
+        members[link] -= 1
+        if not members[link]:
+            del members[link]
+            if not members:
+                del self.channels[folded_channel_name]
+
+    def __forget(self, user, quit_message):
+        del self.users[self.fold(user.nickname)]
+        for folded_channel_name in user.channels:
+            self.__leave(user.link, folded_channel_name)
+        self.broadcast(user.link, json.dumps(["quit", user.nickname, quit_message], ensure_ascii=False))
+
+    def user_handler(self, link, line, nickname, user, host, real_name, signon=0):
+        folded_nickname = self.fold(nickname)
+        if folded_nickname in self.users:
+            link.send("collision", nickname)
+            return
+        self.users[folded_nickname] = BrokerUser(link, nickname)
+        self.broadcast(link, line)
+
+    def nick_handler(self, link, line, old_nickname, new_nickname, signon=0):
+        user = self.__owned_user(link, old_nickname)
+        if user is None:
+            return
+        folded_nickname = self.fold(new_nickname)
+        other = self.users.get(folded_nickname)
+        if other is not None and other is not user:
+            self.__forget(user, "Nickname collision")
+            link.send("collision", new_nickname)
+            return
+        del self.users[self.fold(old_nickname)]
+        user.nickname = new_nickname
+        self.users[folded_nickname] = user
+        self.broadcast(link, line)
+
+    def quit_handler(self, link, line, nickname, quit_message):
+        user = self.__owned_user(link, nickname)
+        if user is not None:
+            del self.users[self.fold(nickname)]
+            for folded_channel_name in user.channels:
+                self.__leave(link, folded_channel_name)
+            self.broadcast(link, line)
+
+    def join_handler(self, link, line, nickname, channel_name):
+        user = self.__owned_user(link, nickname)
+        folded_channel_name = self.fold(channel_name)
+        if user is None or folded_channel_name in user.channels:
+            return
+        user.channels.add(folded_channel_name)
+        members = self.channels.setdefault(folded_channel_name, {})
+        members[link] = members.get(link, 0) + 1
+        self.broadcast(link, line)
+
+    def part_handler(self, link, line, nickname, channel_name):
+        user = self.__owned_user(link, nickname)
+        folded_channel_name = self.fold(channel_name)
+        if user is None or folded_channel_name not in user.channels:
+            return
+        user.channels.discard(folded_channel_name)
+        self.__leave(link, folded_channel_name)
+        self.broadcast(link, line)
+
+    def channel_handler(self, link, line, channel_name, data):
+        members = self.channels.get(self.fold(channel_name))
+        if not members:
+            return
+        data = (line + "\n").encode()
+        for other in members:
+            if other is not link:
+                other.write(data)
+
+    def private_handler(self, link, line, nickname, msg):
+        user = self.users.get(self.fold(nickname))
+        if user is not None and user.link is not link:
+            user.link.write((line + "\n").encode())
+
+    def worker_exited(self, link):
+        self.links.remove(link)
+        for user in list(self.users.values()):
+            if user.link is link:
+                self.__forget(user, "Worker exited")
+
+
+Broker.handlers = {
+    "user": Broker.user_handler,
+    "nick": Broker.nick_handler,
+    "quit": Broker.quit_handler,
+    "join": Broker.join_handler,
+    "part": Broker.part_handler,
+    "channel": Broker.channel_handler,
+    "private": Broker.private_handler,
+}
@@ -0,0 +1,338 @@
+import json
+import socket
+
+from nose.tools import assert_equal, assert_in, assert_is_none, assert_not_in, assert_true
+
+from cluster import LINK_PROTOCOL_VERSION, Broker, RemoteClient, Route, ServerRoute
+from testutil import make_client, make_server, received, run_tasks
+
+
+def sent_messages(route):
+    messages = [json.loads(x) for x in b"".join(route.output).decode().splitlines()]
+    route.output.clear()
+    route.output_size = 0
+    return messages
+
+
+class TestRoute:
+
+    def make_route(self):
+        server = make_server()
+        (connection, peer) = socket.socketpair()
+        route = Route(server, connection)
+        server.routes.append(route)
+        return (server, route)
+
+    def deliver(self, route, *message):
+        route.handle(list(message), json.dumps(message))
+
+    def test_local_events_are_announced(self):
+        (server, route) = self.make_route()
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"JOIN #chan\r\nNICK jack\r\nQUIT :bye\r\n")
+        messages = sent_messages(route)
+        assert_equal([x[0] for x in messages], ["user", "join", "nick", "quit"])
+        assert_equal(messages[0][1:5], ["john", "john", "127.0.0.1", "john"])
+        assert_equal(messages[1:], [
+            ["join", "john", "#chan"],
+            ["nick", "john", "jack", client.signon],
+            ["quit", "jack", "bye"],
+        ])
+
+    def test_remote_members(self):
+        (server, route) = self.make_route()
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"JOIN #chan\r\n")
+        self.deliver(route, "user", "mary", "mary", "example.org", "Mary")
+        self.deliver(route, "user", "anna", "anna", "example.org", "Anna")
+        for nickname in ("mary", "anna"):
+            self.deliver(route, "join", nickname, "#chan")
+        remote = server.get_client("MARY")
+        assert_true(isinstance(remote, RemoteClient))
+        received(client, peer)
+        client.data_received(b"NAMES #chan\r\nLUSERS\r\n")
+        output = received(client, peer)
+        assert_in("353 john = #chan :anna john mary", output)
+        assert_in("There are 3 users on server", output)
+        sent_messages(route)
+        client.data_received(b"SENDMSG #chan :hello\r\nSENDMSG mary :hi\r\n")
+        assert_equal(sent_messages(route), [
+            ["channel", "#chan", ":john!john@127.0.0.1 SENDMSG #chan :hello\r\n"],
+            ["private", "mary", ":john!john@127.0.0.1 SENDMSG mary :hi"],
+        ])
+        self.deliver(route, "quit", "mary", "bye")
+        self.deliver(route, "part", "anna", "#chan")
+        assert_is_none(server.get_client("mary"))
+        assert_equal(server.channels["#chan"].routes, {})
+        client.data_received(b"SENDMSG #chan :alone\r\n")
+        assert_equal(sent_messages(route), [])
+
+    def test_remote_channel_and_private_messages(self):
+        (server, route) = self.make_route()
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"JOIN #chan\r\n")
+        received(client, peer)
+        self.deliver(route, "channel", "#chan", ":mary!mary@example.org SENDMSG #chan :hello\r\n")
+        self.deliver(route, "private", "john", ":mary!mary@example.org SENDMSG john :hi")
+        assert_equal(received(client, peer), ":mary!mary@example.org SENDMSG #chan :hello\r\n:mary!mary@example.org SENDMSG john :hi\r\n")
+
+    def test_replies_keep_command_order(self):
+        (server, route) = self.make_route()
+        (client, peer) = make_client(server, "john")
+        for i in range(5):
+            self.deliver(route, "user", "u%d" % i, "u", "example.org", "U")
+        received(client, peer)
+        client.data_received(b"WHO u*\r\nNICK u3\r\nWHOIS u1\r\nLIST\r\nPING :x\r\n")
+        assert_equal(received(client, peer), "")
+        run_tasks(server)
+        replies = [x.split(" ")[1] for x in received(client, peer).splitlines()]
+        assert_equal(replies, ["352"] * 5 + ["315", "433", "311", "312", "318", "323", "PONG"])
+
+    def test_remote_user_wins_nickname_collision(self):
+        (server, route) = self.make_route()
+        (client, peer) = make_client(server, "john")
+        self.deliver(route, "user", "John", "john", "example.org", "John")
+        assert_true(client.closed)
+        assert_in("Nickname collision", received(client, peer))
+        assert_true(isinstance(server.get_client("john"), RemoteClient))
+        assert_equal(server.remote_users, 1)
+
+
+class TestServerRoute:
+
+    def make_server(self):
+        return make_server("--server-name=a.test", "--link-password=secret")
+
+    def make_route(self, server, name):
+        (connection, peer) = socket.socketpair()
+        route = ServerRoute(server, connection)
+        server.routes.append(route)
+        route.hello_handler(LINK_PROTOCOL_VERSION, name, "secret")
+        return route
+
+    def test_burst(self):
+        server = self.make_server()
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"JOIN #chan\r\n")
+        server.channels["#chan"].topic = "news"
+        other = self.make_route(server, "b.test")
+        sent_messages(other)
+        route = self.make_route(server, "c.test")
+        assert_equal(sent_messages(other), [["server", "c.test"]])
+        messages = sent_messages(route)
+        assert_equal(messages[0], ["server", "b.test"])
+        assert_equal(messages[1][:5], ["user", "john", "john", "127.0.0.1", "john"])
+        assert_equal(messages[2:], [["join", "john", "#chan"], ["topic", "#chan", "news"]])
+
+    def test_bad_password(self):
+        server = self.make_server()
+        (connection, peer) = socket.socketpair()
+        route = ServerRoute(server, connection)
+        server.routes.append(route)
+        route.hello_handler(LINK_PROTOCOL_VERSION, "b.test", "wrong")
+        assert_true(route.closed)
+        assert_equal(server.routes, [])
+        assert_in(b"Bad link password", peer.recv(4096))
+
+    def feed(self, route, peer, data):
+        peer.sendall(data)
+        route.readable()
+
+    def test_malformed_input_closes_only_that_link(self):
+        server = self.make_server()
+        (client, _) = make_client(server, "john")
+        linked = self.make_route(server, "b.test")
+        for data in [b"5\n", b"[]\n", b"{\"a\": 1}\n", b"[7]\n", b"not json\n", b"[\"hello\"]\n",
+                     b"[\"hello\", 1, \"c.test\", 5]\n", b"[\"hello\", 1, [\"c.test\"], \"secret\"]\n"]:
+            (connection, peer) = socket.socketpair()
+            route = ServerRoute(server, connection)
+            server.routes.append(route)
+            self.feed(route, peer, data)
+            assert_true(route.closed, data)
+            assert_equal(server.routes, [linked])
+        assert_equal(list(server.servers), ["b.test"])
+        assert_true(not client.closed)
+
+    def test_unauthenticated_commands_close_the_link(self):
+        server = self.make_server()
+        (connection, peer) = socket.socketpair()
+        route = ServerRoute(server, connection)
+        server.routes.append(route)
+        self.feed(route, peer, b"[\"user\", \"eve\", \"eve\", \"evil.org\", \"Eve\", 0]\n")
+        assert_true(route.closed)
+        assert_is_none(server.get_client("eve"))
+
+    def test_bad_arguments_close_an_authenticated_link(self):
+        server = self.make_server()
+        (connection, peer) = socket.socketpair()
+        route = ServerRoute(server, connection)
+        server.routes.append(route)
+        self.feed(route, peer, json.dumps(["hello", LINK_PROTOCOL_VERSION, "b.test", "secret"]).encode() + b"\n")
+        assert_equal(list(server.servers), ["b.test"])
+        self.feed(route, peer, b"[\"user\", \"eve\"]\n[\"user\", \"mallory\", \"m\", \"h\", \"M\", 0]\n")
+        assert_true(route.closed)
+        assert_is_none(server.get_client("mallory"))
+        assert_equal(server.servers, {})
+
+    def test_loop_is_refused(self):
+        server = self.make_server()
+        self.make_route(server, "b.test")
+        route = self.make_route(server, "c.test")
+        route.server_handler("b.test")
+        assert_true(route.closed)
+        assert_equal(list(server.servers), ["b.test"])
+
+    def test_older_nickname_wins(self):
+        server = self.make_server()
+        (client, peer) = make_client(server, "john")
+        route = self.make_route(server, "b.test")
+        sent_messages(route)
+        route.user_handler("JOHN", "john", "example.org", "John", client.signon + 10)
+        assert_true(not client.closed)
+        assert_equal(sent_messages(route), [["kill", "JOHN", "Nickname collision"]])
+        route.user_handler("JOHN", "john", "example.org", "John", client.signon - 10)
+        assert_true(client.closed)
+        assert_true(isinstance(server.get_client("john"), RemoteClient))
+
+    def test_channel_messages_cross_each_link_once(self):
+        server = self.make_server()
+        (client, peer) = make_client(server, "john")
+        client.data_received(b"JOIN #chan\r\n")
+        routes = [self.make_route(server, name) for name in ("b.test", "c.test", "d.test")]
+        for (route, nicknames) in [(routes[0], ["mary"]), (routes[1], ["anna", "kate"])]:
+            for nickname in nicknames:
+                route.user_handler(nickname, nickname, "example.org", nickname, 1)
+                route.join_handler(nickname, "#chan")
+        for route in routes:
+            sent_messages(route)
+        routes[0].channel_handler("#chan", ":mary!mary@example.org SENDMSG #chan :hi\r\n")
+        assert_equal(sent_messages(routes[0]), [])
+        assert_equal(sent_messages(routes[1]), [["channel", "#chan", ":mary!mary@example.org SENDMSG #chan :hi\r\n"]])
+        assert_equal(sent_messages(routes[2]), [])
+        assert_in("SENDMSG #chan :hi", received(client, peer))
+
+    def test_netsplit(self):
+        server = self.make_server()
+        route = self.make_route(server, "b.test")
+        other = self.make_route(server, "c.test")
+        route.server_handler("d.test")
+        route.user_handler("mary", "mary", "example.org", "Mary", 1)
+        route.join_handler("mary", "#chan")
+        sent_messages(other)
+        route.close()
+        assert_equal(sent_messages(other), [["squit", "b.test"], ["squit", "d.test"], ["quit", "mary", "a.test b.test"]])
+        assert_equal(list(server.servers), ["c.test"])
+        assert_equal(server.channels, {})
+        assert_equal(server.remote_users, 0)
+
+    def test_output_survives_partial_writes(self):
+        server = self.make_server()
+        (connection, peer) = socket.socketpair()
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        route = ServerRoute(server, connection)
+        server.routes.append(route)
+        peer.setblocking(False)
+        lines = [["topic", "#chan%d" % i, "x" * (i % 300)] for i in range(2000)]
+        for line in lines:
+            route.send(*line)
+        expected = b"".join(route.output)
+        output = b""
+        while len(output) < len(expected):
+            route.writable()
+            try:
+                output += peer.recv(2 ** 20)
+            except BlockingIOError:
+                pass
+        assert_equal((len(route.output), route.output_size), (0, 0))
+        assert_equal(output, expected)
+        assert_equal([json.loads(x) for x in output.decode().splitlines()], lines)
+
+    def test_stalled_link_is_squit(self):
+        server = make_server("--server-name=a.test", "--link-password=secret", "--max-link-sendq=4096")
+        route = self.make_route(server, "b.test")
+        other = self.make_route(server, "c.test")
+        route.server_handler("d.test")
+        sent_messages(other)
+        route.send("topic", "#chan", "x" * 4096)
+        assert_true(route.closed)
+        assert_equal(sent_messages(other), [["squit", "b.test"], ["squit", "d.test"]])
+        assert_equal(list(server.servers), ["c.test"])
+
+
+class Worker(object):
+
+    def __init__(self):
+        (self.connection, broker_connection) = socket.socketpair()
+        self.broker_connection = broker_connection
+        self.buffer = b""
+
+    def send(self, broker, *message):
+        self.connection.sendall((json.dumps(message) + "\n").encode())
+        broker.poll(0.1)
+        broker.poll(0)
+
+    def messages(self):
+        self.connection.setblocking(False)
+        try:
+            while True:
+                self.buffer += self.connection.recv(2 ** 20)
+        except BlockingIOError:
+            pass
+        (lines, _, self.buffer) = self.buffer.rpartition(b"\n")
+        return [json.loads(x) for x in lines.decode().splitlines()]
+
+
+class TestBroker:
+
+    def make_broker(self, count=3):
+        workers = [Worker() for _ in range(count)]
+        broker = Broker("rfc1459", [x.broker_connection for x in workers])
+        for link in broker.links:
+            link.start()
+        return (broker, workers)
+
+    def test_users_are_replicated(self):
+        (broker, (a, b, c)) = self.make_broker()
+        a.send(broker, "user", "john", "john", "host", "John")
+        assert_equal(a.messages(), [])
+        for worker in (b, c):
+            assert_equal(worker.messages(), [["user", "john", "john", "host", "John"]])
+
+    def test_nickname_collision(self):
+        (broker, (a, b, c)) = self.make_broker()
+        a.send(broker, "user", "john", "john", "host", "John")
+        b.send(broker, "user", "JOHN", "john", "host", "John")
+        assert_equal(b.messages()[-1], ["collision", "JOHN"])
+        assert_equal(c.messages(), [["user", "john", "john", "host", "John"]])
+        b.send(broker, "quit", "JOHN", "Nickname collision")
+        assert_equal(c.messages(), [])
+
+    def test_channel_messages_reach_each_member_worker_once(self):
+        (broker, (a, b, c)) = self.make_broker()
+        for (worker, nicknames) in [(a, ["john"]), (b, ["mary", "anna"])]:
+            for nickname in nicknames:
+                worker.send(broker, "user", nickname, nickname, "host", nickname)
+                worker.send(broker, "join", nickname, "#chan")
+        for worker in (a, b, c):
+            worker.messages()
+        a.send(broker, "channel", "#CHAN", ":john!john@host SENDMSG #chan :hi\r\n")
+        assert_equal(b.messages(), [["channel", "#CHAN", ":john!john@host SENDMSG #chan :hi\r\n"]])
+        assert_equal(c.messages(), [])
+        b.send(broker, "part", "mary", "#chan")
+        b.send(broker, "quit", "anna", "bye")
+        assert_equal(list(broker.channels["#chan"].values()), [1])
+        a.send(broker, "quit", "john", "bye")
+        assert_not_in("#chan", broker.channels)
+
+    def test_worker_exit(self):
+        (broker, (a, b, c)) = self.make_broker()
+        a.send(broker, "user", "john", "john", "host", "John")
+        a.send(broker, "join", "john", "#chan")
+        b.messages()
+        a.connection.close()
+        broker.poll(0.1)
+        broker.poll(0)
+        assert_equal(len(broker.links), 2)
+        assert_equal(b.messages(), [["quit", "john", "Worker exited"]])
+        assert_equal(broker.users, {})
+        assert_equal(broker.channels, {})
@@ -0,0 +1,63 @@
+import zlib
+
+
+DICTIONARY = (
+    b"PING :PONG :ERROR :Closing link QUIT :Client quit JOIN #PART #"
+    b" 331 * :No topic is set 332 * * : 366 * * :End of NAMES list 322 * * 0 : 323 * :End of LIST"
+    b" 001 * :Hi, welcome to Chat 002 * :Your host is * running version is 003 * chat-* o o"
+    b" 251 * :There are 0 users on server 401 * * :No such nick/channel 433 * * :Nickname is already in use"
+    b" 353 * = #* :\r\n:* JOIN #\r\n:* SENDMSGP #\r\n:* SENDMSG * :\r\n:* SENDMSG #"
+)
+MAX_INFLATED_SIZE = 2 ** 20
+
+
+class DeflateState(object):
+    __slots__ = ("compressor", "users", "pending", "fresh")
+
+    def __init__(self, compressor, users=0):
+        self.compressor = compressor
+        self.users = users
+        self.pending = False
+        self.fresh = True
+
+    def compress(self, data, users=1):
+        if users == self.users:
+            state = self
+        else:
+            state = DeflateState(self.compressor.copy(), users)
+            self.users -= users
+        state.fresh = False
+        compressor = state.compressor
+        output = compressor.compress(data)
+        if users > 1:
+            output += compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            state.pending = True
+        return (state, output)
+
+    def flush(self):
+        self.pending = False
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def new_deflate_state(level):
+    return DeflateState(zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY, DICTIONARY))
+
+
+def new_inflater():
+    return zlib.decompressobj(zlib.MAX_WBITS, DICTIONARY)
+
+
+def compress_fanout(clients, data):
+    groups = {}
+    for client in clients:
+        members = groups.get(client.deflate)
+        if members is None:
+            groups[client.deflate] = [client]
+        else:
+            members.append(client)
+    for (state, members) in groups.items():
+        (state, output) = state.compress(data, len(members))
+        for client in members:
+            client.deflate = state
+            client.enqueue_compressed(output)
@@ -0,0 +1,90 @@
+import zlib
+
+from nose.tools import assert_equal, assert_in, assert_is, assert_is_not, assert_true
+
+from compression import DICTIONARY, compress_fanout, new_deflate_state, new_inflater
+from testutil import connect, make_server, read_output
+
+
+class Member(object):
+
+    def __init__(self, deflate):
+        self.deflate = deflate
+        self.output = b""
+
+    def enqueue_compressed(self, data):
+        self.output += data
+
+
+def inflate(data):
+    return zlib.decompressobj(zlib.MAX_WBITS, DICTIONARY).decompress(data)
+
+
+class TestDeflateState:
+
+    def test_roundtrip(self):
+        state = new_deflate_state(6)
+        state.users = 1
+        (state, output) = state.compress(b":john!john@host SENDMSG #chan :hello\r\n")
+        assert_true(state.pending)
+        output += state.flush()
+        assert_equal(inflate(output), b":john!john@host SENDMSG #chan :hello\r\n")
+
+    def test_fanout_compresses_once_per_state(self):
+        shared = new_deflate_state(6)
+        shared.users = 3
+        members = [Member(shared) for _ in range(3)]
+        compress_fanout(members, b"first\r\n")
+        assert_is(members[0].deflate, shared)
+        assert_true(not shared.pending)
+        compress_fanout(members[:2], b"second\r\n")
+        assert_is(members[0].deflate, members[1].deflate)
+        assert_is_not(members[0].deflate, shared)
+        assert_is(members[2].deflate, shared)
+        assert_equal(shared.users, 1)
+        compress_fanout(members, b"third\r\n")
+        for member in members:
+            if member.deflate.pending:
+                member.output += member.deflate.flush()
+        assert_equal(inflate(members[0].output), b"first\r\nsecond\r\nthird\r\n")
+        assert_equal(inflate(members[2].output), b"first\r\nthird\r\n")
+
+
+class TestCompressCommand:
+
+    def test_negotiation(self):
+        server = make_server()
+        (client, peer) = connect(server)
+        client.data_received(b"COMPRESS DEFLATE\r\n")
+        assert_equal(read_output(client, peer), (":%s COMPRESS DEFLATE BOTH\r\n" % server.name).encode())
+        compressor = zlib.compressobj(zdict=DICTIONARY)
+        client.data_received(compressor.compress(b"NICK john\r\nUSER john * * :John\r\n") + compressor.flush(zlib.Z_SYNC_FLUSH))
+        inflater = new_inflater()
+        output = inflater.decompress(read_output(client, peer))
+        assert_in(b" 001 john :Hi, welcome to Chat\r\n", output)
+        client.data_received(compressor.compress(b"COMPRESS DEFLATE\r\n") + compressor.flush(zlib.Z_SYNC_FLUSH))
+        assert_in(b"FAIL COMPRESS ALREADY_ACTIVE", inflater.decompress(read_output(client, peer)))
+        client.disconnect("bye")
+        assert_in(b"ERROR :bye\r\n", inflater.decompress(peer.recv(2 ** 20)))
+
+    def test_outbound_only(self):
+        server = make_server()
+        (client, peer) = connect(server)
+        client.data_received(b"COMPRESS DEFLATE OUT\r\nNICK john\r\nUSER john * * :John\r\n")
+        data = read_output(client, peer)
+        (plain, compressed) = data.split(b"\r\n", 1)
+        assert_equal(plain, (":%s COMPRESS DEFLATE OUT" % server.name).encode())
+        assert_in(b" 001 john ", new_inflater().decompress(compressed))
+
+    def test_bad_data(self):
+        server = make_server()
+        (client, peer) = connect(server)
+        client.data_received(b"COMPRESS DEFLATE\r\n")
+        client.data_received(b"NICK john\r\n")
+        assert_true(client.closed)
+
+    def test_disabled(self):
+        server = make_server("--compress-level=0")
+        (client, peer) = connect(server)
+        client.data_received(b"COMPRESS DEFLATE\r\n")
+        assert_in(b" 421 * COMPRESS :Unknown command", read_output(client, peer))
@@ -0,0 +1,276 @@
+import os
+import asyncio
+import functools
+import selectors
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+BACKENDS = {
+    "auto": "DefaultSelector",
+    "epoll": "EpollSelector",
+    "kqueue": "KqueueSelector",
+    "devpoll": "DevpollSelector",
+    "poll": "PollSelector",
+    "select": "SelectSelector",
+}
+
+
+def available_backends():
+    return [name for (name, cls) in sorted(BACKENDS.items()) if hasattr(selectors, cls)]
+
+
+def available_engines():
+    engines = ["asyncio", "selectors"]
+    if uvloop is not None:
+        engines.append("uvloop")
+    return engines
+
+
+def create_engine(name, server, backend="auto"):
+    if name == "selectors":
+        return SelectorEngine(server, backend)
+    if name == "asyncio":
+        return AsyncioEngine(server, backend)
+    if name == "uvloop" and uvloop is not None:
+        return AsyncioEngine(server, loop_factory=uvloop.new_event_loop)
+    raise ValueError("Unsupported event engine: %r" % name)
+
+
+class SelectorEngine(object):
+    supports_handoff = True
+
+    def __init__(self, server, backend="auto"):
+        if backend not in available_backends():
+            raise ValueError("Unsupported event loop backend: %r" % backend)
+        self.server = server
+        self.backend = backend
+        self.selector = getattr(selectors, BACKENDS[backend])()
+        self.watchers = {}
+
+    def register(self, client):
+        self.selector.register(client.connection, selectors.EVENT_READ, client)
+
+    def unregister(self, client):
+        client.socket_writable_notification()
+        try:
+            self.selector.unregister(client.connection)
+        except (KeyError, ValueError):
+            pass
+
+    def wake(self):
+        pass
+
+    def watch(self, fileobj, on_readable=None, on_writable=None):
+        events = 0
+        if on_readable is not None:
+            events |= selectors.EVENT_READ
+        if on_writable is not None:
+            events |= selectors.EVENT_WRITE
+        if fileobj in self.watchers:
+            self.selector.modify(fileobj, events)
+        else:
+            self.selector.register(fileobj, events)
+        self.watchers[fileobj] = (on_readable, on_writable)
+
+    def unwatch(self, fileobj):
+        if self.watchers.pop(fileobj, None) is not None:
+            self.selector.unregister(fileobj)
+
+    def set_write_interest(self, client, enabled):
+        events = selectors.EVENT_READ
+        if enabled:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(client.connection, events, client)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        server = self.server
+        clients = server.clients
+        metrics = server.metrics
+        ready = self.selector.select(timeout)
+        if not ready and not server.tasks:
+            metrics.idle_polls += 1
+            server.timers.run()
+            return
+        start = metrics.clock()
+        for (key, events) in ready:
+            client = key.data
+            if client is None:
+                self.__notify_watcher(key.fileobj, events)
+                continue
+            if events & selectors.EVENT_READ and client.connection in clients:
+                client.socket_readable_notification()
+            if events & selectors.EVENT_WRITE and client.connection in clients:
+                client.socket_writable_notification()
+        server.timers.run()
+        server.run_tasks()
+        metrics.ready_fds.observe(len(ready))
+        metrics.loop_time.observe(metrics.clock() - start)
+
+    def __notify_watcher(self, fileobj, events):
+        watcher = self.watchers.get(fileobj)
+        if watcher is not None and events & selectors.EVENT_READ and watcher[0] is not None:
+            watcher[0]()
+        watcher = self.watchers.get(fileobj)
+        if watcher is not None and events & selectors.EVENT_WRITE and watcher[1] is not None:
+            watcher[1]()
+
+    def run(self, server_sockets):
+        server = self.server
+        for s in server_sockets:
+            self.watch(s, functools.partial(server.accept_connection, s))
+        while True:
+            self.poll(0 if server.tasks else server.timers.next_timeout())
+
+
+class ClientProtocol(asyncio.Protocol):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+        self.client = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        server = self.engine.server
+        address = transport.get_extra_info("peername")
+        reason = server.refuse_reason(address[0])
+        if reason is not None:
+            server.metrics.connections_refused += 1
+            server.print_info("Refused connection from %s:%s (%s).", address[0], address[1], reason)
+            transport.write(("ERROR :%s\r\n" % reason).encode())
+            transport.close()
+            return
+        server.setup_connection(transport.get_extra_info("socket"))
+        self.engine.protocols[transport] = self
+        self.client = server.add_client(transport, address)
+
+    def data_received(self, data):
+        if self.transport in self.engine.server.clients:
+            self.client.data_received(data)
+
+    def eof_received(self):
+        if self.transport in self.engine.server.clients:
+            self.client.disconnect("EOT")
+
+    def connection_lost(self, exc):
+        if self.transport in self.engine.server.clients:
+            self.client.disconnect(exc or "EOT")
+        self.engine.protocols.pop(self.transport, None)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.engine.flush(self.client)
+
+
+class AsyncioEngine(object):
+    supports_handoff = False
+
+    def __init__(self, server, backend="auto", loop_factory=None):
+        if loop_factory is None:
+            if backend not in available_backends():
+                raise ValueError("Unsupported event loop backend: %r" % backend)
+
+            def loop_factory():
+                return asyncio.SelectorEventLoop(getattr(selectors, BACKENDS[backend])())
+        self.server = server
+        self.backend = backend
+        self.loop_factory = loop_factory
+        self.loop = None
+        self.protocols = {}
+        self.watchers = {}
+        self.__pending_flushes = set()
+
+    def register(self, client):
+        pass
+
+    def unregister(self, client):
+        self.flush(client)
+        self.__pending_flushes.discard(client)
+
+    def wake(self):
+        self.loop.call_soon(self.__run_tasks)
+
+    def watch(self, fileobj, on_readable=None, on_writable=None):
+        if fileobj in self.watchers and self.loop is not None:
+            self.__remove_watcher(fileobj)
+        self.watchers[fileobj] = (on_readable, on_writable)
+        if self.loop is not None:
+            self.__add_watcher(fileobj)
+
+    def unwatch(self, fileobj):
+        if fileobj in self.watchers:
+            if self.loop is not None:
+                self.__remove_watcher(fileobj)
+            del self.watchers[fileobj]
+
+    def __add_watcher(self, fileobj):
+        (on_readable, on_writable) = self.watchers[fileobj]
+        if on_readable is not None:
+            self.loop.add_reader(fileobj, on_readable)
+        if on_writable is not None:
+            self.loop.add_writer(fileobj, on_writable)
+
+    def __remove_watcher(self, fileobj):
+        self.loop.remove_reader(fileobj)
+        self.loop.remove_writer(fileobj)
+
+    def __run_tasks(self):
+        self.server.run_tasks()
+        if self.server.tasks:
+            self.loop.call_soon(self.__run_tasks)
+
+    def set_write_interest(self, client, enabled):
+        if enabled and client not in self.__pending_flushes:
+            self.__pending_flushes.add(client)
+            self.loop.call_soon(self.flush, client)
+
+    def flush(self, client):
+        self.__pending_flushes.discard(client)
+        protocol = self.protocols.get(client.connection)
+        if protocol is None or protocol.paused or not client.has_output():
+            return
+        client.transport_writable_notification(protocol.transport)
+
+    def __run_timers(self):
+        timers = self.server.timers
+        timers.run()
+        timeout = timers.next_timeout()
+        if timeout is None or timeout > timers.resolution:
+            timeout = timers.resolution
+        self.loop.call_later(timeout, self.__run_timers)
+
+    async def start_serving(self, server_sockets):
+        self.loop = asyncio.get_running_loop()
+        for fileobj in self.watchers:
+            self.__add_watcher(fileobj)
+        servers = []
+        for s in server_sockets:
+            servers.append(await self.loop.create_server(lambda: ClientProtocol(self), sock=s, backlog=self.server.backlog))
+        self.loop.call_soon(self.__run_timers)
+        return servers
+
+    async def serve(self, server_sockets):
+        servers = await self.start_serving(server_sockets)
+        await asyncio.gather(*(x.serve_forever() for x in servers))
+
+    def run(self, server_sockets):
+        loop = self.loop_factory()
+        try:
+            loop.run_until_complete(self.serve(server_sockets))
+        finally:
+            loop.close()
@@ -0,0 +1,94 @@
+import socket
+import asyncio
+import selectors
+
+from nose.tools import assert_equal, assert_true
+
+from engine import ClientProtocol
+from testutil import connect, make_server
+
+
+def payload(count):
+    return [b"message %06d %s\r\n" % (i, b"y" * (i % 50)) for i in range(count)]
+
+
+class TestSelectorEngine:
+
+    def write_events(self, server, client):
+        return server.engine.selector.get_key(client.connection).events & selectors.EVENT_WRITE
+
+    def test_write_interest_follows_the_send_buffer(self):
+        server = make_server("--engine=selectors", "--max-sendq=%d" % 2 ** 24)
+        (client, peer) = connect(server, buffer_size=4096)
+        assert_true(not self.write_events(server, client))
+        lines = payload(5000)
+        for line in lines:
+            client.enqueue(line)
+        assert_true(self.write_events(server, client))
+        server.engine.poll(0)
+        assert_true(client.has_output())
+        assert_true(self.write_events(server, client))
+        output = b""
+        while client.has_output():
+            try:
+                output += peer.recv(2 ** 16)
+            except BlockingIOError:
+                pass
+            server.engine.poll(0)
+        assert_true(not self.write_events(server, client))
+        output += peer.recv(2 ** 20)
+        assert_equal(output, b"".join(lines))
+
+    def test_idle_iterations_skip_the_loop_histograms(self):
+        server = make_server("--engine=selectors")
+        (client, peer) = connect(server)
+        metrics = server.metrics
+        server.engine.poll(0)
+        assert_equal((metrics.idle_polls, metrics.loop_time.count), (1, 0))
+        peer.sendall(b"NICK john\r\n")
+        server.engine.poll(1)
+        assert_equal((metrics.idle_polls, metrics.loop_time.count, metrics.ready_fds.count), (1, 1, 1))
+
+
+class TestAsyncioEngine:
+
+    async def exchange(self, server, lines):
+        engine = server.engine
+        loop = engine.loop = asyncio.get_running_loop()
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        peer = socket.socket()
+        peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        peer.connect(listener.getsockname())
+        (connection, _) = listener.accept()
+        listener.close()
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        peer.setblocking(False)
+        (transport, protocol) = await loop.connect_accepted_socket(lambda: ClientProtocol(engine), connection)
+        transport.set_write_buffer_limits(high=8192)
+        client = protocol.client
+        half = len(lines) // 2
+        for line in lines[:half]:
+            client.enqueue(line)
+        await asyncio.sleep(0.05)
+        assert_true(protocol.paused)
+        for line in lines[half:]:
+            client.enqueue(line)
+        await asyncio.sleep(0.05)
+        assert_true(client.has_output())
+        output = b""
+        expected = sum(len(x) for x in lines)
+        while len(output) < expected:
+            output += await asyncio.wait_for(loop.sock_recv(peer, 2 ** 16), 5)
+        assert_true(not protocol.paused)
+        assert_true(not client.has_output())
+        transport.close()
+        peer.close()
+        return output
+
+    def test_pause_and_resume_writing(self):
+        server = make_server("--engine=asyncio", "--max-sendq=%d" % 2 ** 24)
+        lines = payload(20000)
+        output = asyncio.run(self.exchange(server, lines))
+        assert_equal(output, b"".join(lines))
@@ -0,0 +1,106 @@
+import collections
+
+from compression import compress_fanout
+
+
+def deliver(recipients, data, sender=None):
+    compressed = None
+    for client in recipients:
+        if client is not sender:
+            if client.deflate is None:
+                client.enqueue_compressed(data)
+            elif compressed is None:
+                compressed = [client]
+            else:
+                compressed.append(client)
+    if compressed is not None:
+        compress_fanout(compressed, data)
+
+
+class FanoutJob(object):
+    __slots__ = ("data", "sender", "recipients", "position", "queued")
+
+    def __init__(self, data, sender, recipients, queued):
+        self.data = data
+        self.sender = sender
+        self.recipients = recipients
+        self.position = 0
+        self.queued = queued
+
+    def run(self, limit):
+        start = self.position
+        end = min(start + limit, len(self.recipients))
+        deliver(self.recipients[start:end], self.data, self.sender)
+        self.position = end
+        return end - start
+
+    def done(self):
+        return self.position == len(self.recipients)
+
+
+class FanoutScheduler(object):
+
+    def __init__(self, server, threshold, slice_size):
+        self.server = server
+        self.threshold = threshold
+        self.slice_size = slice_size
+        self.jobs = {}
+        self.order = collections.deque()
+        self.pending = 0
+        self.running = False
+
+    def __len__(self):
+        return sum(len(x) for x in self.jobs.values())
+
+    def deliver(self, channel, data, sender=None):
+        metrics = self.server.metrics
+        jobs = self.jobs.get(channel)
+        if jobs is None:
+            if len(channel.clients) <= self.threshold:
+                metrics.fanout_direct += 1
+                deliver(tuple(channel.clients), data, sender)
+                return
+            jobs = self.jobs[channel] = collections.deque()
+            self.order.append(channel)
+        recipients = tuple(channel.clients)
+        jobs.append(FanoutJob(data, sender, recipients, metrics.clock()))
+        self.pending += len(recipients)
+        metrics.fanout_queued += 1
+        if not self.running:
+            self.running = True
+            self.server.add_task(self.__run())
+
+    def run_slice(self, budget=None):
+        if budget is None:
+            budget = self.slice_size
+        order = self.order
+        metrics = self.server.metrics
+        for _ in range(len(order)):
+            if budget <= 0:
+                break
+            channel = order.popleft()
+            jobs = self.jobs[channel]
+            quota = max(1, budget // (len(order) + 1))
+            used = 0
+            while jobs and used < quota:
+                job = jobs[0]
+                used += job.run(quota - used)
+                if job.done():
+                    jobs.popleft()
+                    metrics.fanout_lag.observe(metrics.clock() - job.queued)
+            budget -= used
+            self.pending -= used
+            if jobs:
+                order.append(channel)
+            else:
+                del self.jobs[channel]
+
+    def drain(self):
+        while self.order:
+            self.run_slice(max(1, self.pending))
+
+    def __run(self):
+        while self.order:
+            self.run_slice()
+            yield
+        self.running = False
@@ -0,0 +1,56 @@
+from nose.tools import assert_equal, assert_in, assert_true
+
+from testutil import make_client, make_server, received, run_tasks
+
+
+def make_member(server, nickname, *channels):
+    (client, peer) = make_client(server, nickname)
+    for channel_name in channels:
+        channel = server.get_channel(channel_name)
+        channel.add_member(client)
+        client.channels[channel.folded_name] = channel
+    received(client, peer)
+    return (client, peer)
+
+
+class TestFanoutScheduler:
+
+    def test_small_channels_are_delivered_directly(self):
+        server = make_server("--fanout-threshold=2")
+        (john, _) = make_member(server, "john", "#small")
+        (jack, peer) = make_member(server, "jack", "#small")
+        john.data_received(b"SENDMSG #small :hi\r\n")
+        assert_in("SENDMSG #small :hi", received(jack, peer))
+        assert_equal(server.metrics.fanout_direct, 1)
+        assert_equal(len(server.tasks), 0)
+
+    def test_large_channels_are_delivered_in_slices(self):
+        server = make_server("--fanout-threshold=2", "--fanout-slice=3")
+        members = [make_member(server, "user%d" % i, "#big") for i in range(6)]
+        (sender, sender_peer) = members[0]
+        sender.data_received(b"SENDMSG #big :one\r\nSENDMSG #big :two\r\n")
+        assert_equal(len(server.fanout), 2)
+        assert_equal(server.fanout.pending, 12)
+        server.run_tasks()
+        assert_equal(server.fanout.pending, 9)
+        (late, late_peer) = make_member(server, "late", "#big")
+        members[5][0].disconnect("bye")
+        run_tasks(server)
+        assert_equal(server.fanout.pending, 0)
+        assert_equal(server.metrics.fanout_lag.count, 2)
+        assert_equal(received(sender, sender_peer), "")
+        assert_equal(received(late, late_peer), "")
+        for (client, peer) in members[1:5]:
+            output = received(client, peer)
+            assert_true(output.index(":one") < output.index(":two"))
+
+    def test_channel_order_survives_shrinking(self):
+        server = make_server("--fanout-threshold=2", "--fanout-slice=1")
+        members = [make_member(server, "user%d" % i, "#chan") for i in range(3)]
+        members[0][0].data_received(b"SENDMSG #chan :first\r\n")
+        members[2][0].disconnect("bye")
+        members[0][0].data_received(b"SENDMSG #chan :second\r\n")
+        assert_equal(server.metrics.fanout_queued, 2)
+        server.fanout.drain()
+        output = received(*members[1])
+        assert_true(output.index(":first") < output.index(":second"))
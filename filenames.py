@@ -0,0 +1,8 @@
+import string
+
+
+SAFE_CHARACTERS = frozenset((string.ascii_letters + string.digits + "#&+,-=_").encode())
+
+
+def escape_file_name(name):
+    return "".join(chr(x) if x in SAFE_CHARACTERS else "%%%02X" % x for x in name.encode())
@@ -0,0 +1,16 @@
+from nose.tools import assert_equal, assert_not_equal
+
+from filenames import escape_file_name
+
+
+class TestEscapeFileName:
+
+    def test_escape(self):
+        assert_equal(escape_file_name("#chan_1"), "#chan_1")
+        assert_equal(escape_file_name("#a/b.c%"), "#a%2Fb%2Ec%25")
+        assert_equal(escape_file_name("#ä"), "#%C3%A4")
+        assert_equal(escape_file_name(".."), "%2E%2E")
+
+    def test_escape_is_injective(self):
+        assert_not_equal(escape_file_name("#a_/b"), escape_file_name("#a/_b"))
+        assert_not_equal(escape_file_name("#a%2Fb"), escape_file_name("#a/b"))
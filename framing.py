@@ -0,0 +1,46 @@
+class LineFramer(object):
+    __slots__ = ("max_line_length", "buffer", "__scanned", "__discarding")
+
+    def __init__(self, max_line_length=512):
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+        self.__scanned = 0
+        self.__discarding = False
+
+    def pending(self):
+        return len(self.buffer) > 0 or self.__discarding
+
+    def __decode(self, line):
+        limit = self.max_line_length - 2
+        if len(line) > limit:
+            line = line[:limit]
+        return line.decode("utf-8", "replace")
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        lines = []
+        start = 0
+        position = self.__scanned
+        while True:
+            end = buffer.find(b"\n", position)
+            if end < 0:
+                break
+            if self.__discarding:
+                self.__discarding = False
+            else:
+                line_end = end
+                if line_end > start and buffer[line_end - 1] == 13:
+                    line_end -= 1
+                lines.append(self.__decode(buffer[start:line_end]))
+            start = position = end + 1
+        if start:
+            del buffer[:start]
+        if self.__discarding:
+            del buffer[:]
+        elif len(buffer) > self.max_line_length:
+            lines.append(self.__decode(buffer))
+            del buffer[:]
+            self.__discarding = True
+        self.__scanned = len(buffer)
+        return lines
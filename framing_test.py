@@ -0,0 +1,32 @@
+from nose.tools import assert_equal
+
+from framing import LineFramer
+
+
+class TestLineFramer:
+
+    def test_split_lines(self):
+        framer = LineFramer()
+        assert_equal(framer.feed(b"PING :a\r\nPING :b\nPI"), ["PING :a", "PING :b"])
+        assert_equal(framer.feed(b"NG :c\r\n"), ["PING :c"])
+        assert_equal(bytes(framer.buffer), b"")
+
+    def test_carriage_return_split_across_reads(self):
+        framer = LineFramer()
+        assert_equal(framer.feed(b"PING :a\r"), [])
+        assert_equal(framer.feed(b"\n"), ["PING :a"])
+
+    def test_multibyte_character_split_across_reads(self):
+        framer = LineFramer()
+        data = "SENDMSG #c :é\r\n".encode()
+        assert_equal(framer.feed(data[:13]), [])
+        assert_equal(framer.feed(data[13:]), ["SENDMSG #c :é"])
+
+    def test_invalid_utf8_is_replaced(self):
+        assert_equal(LineFramer().feed(b"SENDMSG #c :\xff\r\n"), ["SENDMSG #c :�"])
+
+    def test_long_line_is_truncated(self):
+        framer = LineFramer()
+        lines = framer.feed(b"x" * 600)
+        assert_equal(lines, ["x" * 510])
+        assert_equal(framer.feed(b"yyy\r\nPING :a\r\n"), ["PING :a"])
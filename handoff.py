@@ -0,0 +1,109 @@
+import os
+import json
+import socket
+import struct
+
+
+STATE_FORMAT = 1
+LENGTH = struct.Struct("!Q")
+MAX_FDS = 250
+TIMEOUT = 30
+
+
+class HandoffError(Exception):
+    pass
+
+
+def receive_exactly(connection, size):
+    chunks = []
+    while size:
+        data = connection.recv(min(size, 2 ** 20))
+        if not data:
+            raise HandoffError("connection closed during handoff")
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+
+def send_state(connection, state, fds):
+    data = json.dumps(state).encode()
+    connection.sendall(LENGTH.pack(len(data)) + data)
+    for i in range(0, len(fds), MAX_FDS):
+        socket.send_fds(connection, [b"F"], fds[i:i + MAX_FDS])
+
+
+def receive_state(connection):
+    (length,) = LENGTH.unpack(receive_exactly(connection, LENGTH.size))
+    state = json.loads(receive_exactly(connection, length).decode())
+    if state.get("format") != STATE_FORMAT:
+        raise HandoffError("unsupported state format: %r" % state.get("format"))
+    fds = []
+    while len(fds) < state["fd_count"]:
+        (data, received, _, _) = socket.recv_fds(connection, 1, MAX_FDS)
+        if not data:
+            raise HandoffError("connection closed during handoff")
+        fds.extend(received)
+    return (state, fds)
+
+
+def take_over(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(TIMEOUT)
+    try:
+        connection.connect(path)
+        connection.sendall(b"TAKEOVER\n")
+        (state, fds) = receive_state(connection)
+    except (OSError, ValueError):
+        connection.close()
+        raise
+    return (connection, state, fds)
+
+
+class ControlSocket(object):
+
+    def __init__(self, server, path, sock=None):
+        self.server = server
+        self.path = path
+        if sock is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            os.chmod(path, 0o600)
+            sock.listen(4)
+        sock.setblocking(False)
+        self.socket = sock
+
+    def start(self):
+        self.server.engine.watch(self.socket, self.accept)
+
+    def accept(self):
+        try:
+            (connection, _) = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.settimeout(TIMEOUT)
+        try:
+            request = connection.recv(64).strip()
+            if request == b"TAKEOVER":
+                self.hand_over(connection)
+            else:
+                connection.sendall(b"ERROR unknown request\n")
+        except (OSError, ValueError, HandoffError) as e:
+            self.server.print_error("Hot restart failed: %s", e)
+        finally:
+            connection.close()
+
+    def hand_over(self, connection):
+        server = self.server
+        if not server.engine.supports_handoff:
+            raise HandoffError("the event engine does not support hot restart")
+        (state, fds) = server.snapshot()
+        state["format"] = STATE_FORMAT
+        state["fd_count"] = len(fds)
+        send_state(connection, state, fds)
+        reply = connection.recv(64).strip()
+        if reply != b"READY":
+            raise HandoffError("successor did not take over: %r" % reply.decode(errors="replace"))
+        server.print_info("Handed over %d connections.", len(server.clients))
+        raise SystemExit(0)
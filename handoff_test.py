@@ -0,0 +1,38 @@
+import os
+import socket
+import threading
+
+from nose.tools import assert_equal, assert_raises
+
+from handoff import STATE_FORMAT, HandoffError, receive_state, send_state
+
+
+class TestStateTransfer:
+
+    def test_state_and_descriptors(self):
+        (a, b) = socket.socketpair()
+        pipes = [os.pipe() for _ in range(300)]
+        fds = [r for (r, w) in pipes]
+        state = {"format": STATE_FORMAT, "fd_count": len(fds), "clients": [{"nickname": "john"}]}
+        sender = threading.Thread(target=send_state, args=(a, state, fds))
+        sender.start()
+        (received_state, received_fds) = receive_state(b)
+        sender.join()
+        assert_equal(received_state, state)
+        assert_equal(len(received_fds), 300)
+        os.write(pipes[299][1], b"x")
+        assert_equal(os.read(received_fds[299], 1), b"x")
+        for fd in received_fds:
+            os.close(fd)
+        for (r, w) in pipes:
+            os.close(r)
+            os.close(w)
+        a.close()
+        b.close()
+
+    def test_unsupported_format(self):
+        (a, b) = socket.socketpair()
+        send_state(a, {"format": STATE_FORMAT + 1, "fd_count": 0}, [])
+        assert_raises(HandoffError, receive_state, b)
+        a.close()
+        b.close()
@@ -0,0 +1,297 @@
+import os
+import re
+import mmap
+import time
+import bisect
+import struct
+import collections
+
+from filenames import escape_file_name
+
+
+HEADER = struct.Struct("<4sIQ")
+MAGIC = b"CHS1"
+FORMAT_VERSION = 1
+TAG = b"@time="
+TIMESTAMP_LENGTH = 24
+INDEX_INTERVAL = 4096
+MIN_SEGMENT_SIZE = 2 ** 16
+
+TIMESTAMP_REGEXP = re.compile(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z\Z")
+TAG_REGEXP = re.compile(rb"^@time=[^ ]* ", re.MULTILINE)
+
+
+def format_timestamp(t):
+    return (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + ".%03dZ" % (t % 1 * 1000)).encode()
+
+
+def strip_tags(chunk):
+    return TAG_REGEXP.sub(b"", chunk)
+
+
+def parse_timestamp(text):
+    match = TIMESTAMP_REGEXP.match(text)
+    if match is None:
+        return None
+    return ("%s.%sZ" % (match.group(1), (match.group(2) or "")[:3].ljust(3, "0"))).encode()
+
+
+class Segment(object):
+    __slots__ = ("number", "path", "map", "end", "times", "offsets")
+
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.map = None
+        self.end = HEADER.size
+        self.times = []
+        self.offsets = []
+
+    def create(self, size):
+        with open(self.path, "w+b") as f:
+            f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        self.map[:HEADER.size] = HEADER.pack(MAGIC, FORMAT_VERSION, self.end)
+
+    def open(self):
+        with open(self.path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        (magic, version, end) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != FORMAT_VERSION or not HEADER.size <= end <= len(self.map):
+            self.close()
+            raise ValueError("%s is not a history segment" % self.path)
+        self.end = end
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def scan(self):
+        self.times = []
+        self.offsets = []
+        position = HEADER.size
+        last = position - INDEX_INTERVAL
+        while position < self.end:
+            if position - last >= INDEX_INTERVAL:
+                self.times.append(self.timestamp_at(position))
+                self.offsets.append(position)
+                last = position
+            position = self.map.find(b"\n", position, self.end) + 1
+            if position == 0:
+                position = self.end
+
+    def timestamp_at(self, offset):
+        start = offset + len(TAG)
+        return self.map[start:start + TIMESTAMP_LENGTH]
+
+    def last_timestamp(self):
+        if self.end == HEADER.size:
+            return None
+        return self.timestamp_at(max(self.map.rfind(b"\n", HEADER.size, self.end - 1) + 1, HEADER.size))
+
+    def free(self):
+        return len(self.map) - self.end
+
+    def append(self, timestamp, line):
+        offset = self.end
+        if not self.offsets or offset - self.offsets[-1] >= INDEX_INTERVAL:
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+        self.end = offset + len(line)
+        self.map[offset:self.end] = line
+        HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, self.end)
+
+    def find(self, timestamp):
+        i = bisect.bisect_left(self.times, timestamp) - 1
+        if i < 0:
+            return HEADER.size
+        position = self.offsets[i]
+        while position < self.end and self.timestamp_at(position) < timestamp:
+            position = self.map.find(b"\n", position, self.end) + 1
+        return position
+
+
+class ChannelHistory(object):
+
+    def __init__(self, store, directory):
+        self.store = store
+        self.directory = directory
+        self.segments = []
+        self.last_timestamp = b""
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted(int(x[:-4]) for x in os.listdir(directory) if x.endswith(".seg") and x[:-4].isdigit())
+        for number in numbers:
+            segment = Segment(number, self.__segment_path(number))
+            try:
+                segment.open()
+            except ValueError:
+                continue
+            if segment.end == HEADER.size:
+                segment.close()
+                os.unlink(segment.path)
+                continue
+            segment.scan()
+            self.segments.append(segment)
+            self.last_timestamp = segment.last_timestamp()
+            segment.close()
+        if self.segments:
+            self.segments[-1].open()
+
+    def __segment_path(self, number):
+        return os.path.join(self.directory, "%016d.seg" % number)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def append(self, timestamp, data):
+        if timestamp < self.last_timestamp:
+            timestamp = self.last_timestamp
+        self.last_timestamp = timestamp
+        line = b"".join((TAG, timestamp, b" ", data))
+        segments = self.segments
+        if not segments or segments[-1].free() < len(line):
+            self.__roll()
+        segments[-1].append(timestamp, line)
+
+    def __roll(self):
+        segments = self.segments
+        number = 0
+        if segments:
+            segments[-1].close()
+            number = segments[-1].number + 1
+        segment = Segment(number, self.__segment_path(number))
+        segment.create(self.store.segment_size)
+        segments.append(segment)
+        cutoff = self.store.cutoff()
+        while len(segments) > self.store.max_segments or (cutoff is not None and len(segments) > 2 and segments[1].times[0] < cutoff):
+            os.unlink(segments.pop(0).path)
+
+    def __map(self, i):
+        segment = self.segments[i]
+        if segment.map is None:
+            segment.open()
+        return segment
+
+    def __release(self):
+        for segment in self.segments[:-1]:
+            segment.close()
+
+    def __position(self, timestamp):
+        if not self.segments:
+            return (0, HEADER.size)
+        i = bisect.bisect_left([x.times[0] for x in self.segments], timestamp) - 1
+        if i < 0:
+            return (0, HEADER.size)
+        return (i, self.__map(i).find(timestamp))
+
+    def __floor(self, timestamp=None):
+        cutoff = self.store.cutoff()
+        if cutoff is not None and (timestamp is None or cutoff > timestamp):
+            timestamp = cutoff
+        if timestamp is None:
+            return (0, HEADER.size)
+        return self.__position(timestamp)
+
+    def __forward(self, start, count):
+        (i, position) = start
+        chunks = []
+        while count > 0 and i < len(self.segments):
+            segment = self.__map(i)
+            end = position
+            while count > 0 and end < segment.end:
+                end = segment.map.find(b"\n", end, segment.end) + 1
+                count -= 1
+            if end > position:
+                chunks.append(segment.map[position:end])
+            i += 1
+            position = HEADER.size
+        return chunks
+
+    def __backward(self, start, count, floor):
+        (i, position) = start
+        chunks = []
+        while count > 0 and i >= 0 and (i, position) > floor:
+            segment = self.__map(i)
+            limit = floor[1] if i == floor[0] else HEADER.size
+            begin = position
+            while count > 0 and begin > limit:
+                begin = max(segment.map.rfind(b"\n", HEADER.size, begin - 1) + 1, HEADER.size)
+                count -= 1
+            if begin < position:
+                chunks.append(segment.map[begin:position])
+            i -= 1
+            if i >= 0:
+                position = self.__map(i).end
+        chunks.reverse()
+        return chunks
+
+    def latest(self, count, after=None):
+        if not self.segments:
+            return []
+        try:
+            start = (len(self.segments) - 1, self.segments[-1].end)
+            return self.__backward(start, count, self.__floor(None if after is None else after + b"\xff"))
+        finally:
+            self.__release()
+
+    def before(self, timestamp, count):
+        try:
+            return self.__backward(self.__position(timestamp), count, self.__floor())
+        finally:
+            self.__release()
+
+    def after(self, timestamp, count):
+        try:
+            return self.__forward(max(self.__position(timestamp + b"\xff"), self.__floor()), count)
+        finally:
+            self.__release()
+
+
+class HistoryStore(object):
+
+    def __init__(self, directory, segment_size=2 ** 20, max_segments=16, retention=0, max_open=64, clock=time.time):
+        if segment_size < MIN_SEGMENT_SIZE:
+            raise ValueError("History segments must be at least %d bytes" % MIN_SEGMENT_SIZE)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.retention = retention
+        self.max_open = max_open
+        self.clock = clock
+        self.histories = collections.OrderedDict()
+        self.__second = None
+        self.__second_prefix = None
+
+    def timestamp(self):
+        now = self.clock()
+        second = int(now)
+        if second != self.__second:
+            self.__second = second
+            self.__second_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        return ("%s.%03dZ" % (self.__second_prefix, (now - second) * 1000)).encode()
+
+    def cutoff(self):
+        if not self.retention:
+            return None
+        return format_timestamp(self.clock() - self.retention)
+
+    def get(self, folded_name):
+        history = self.histories.get(folded_name)
+        if history is None:
+            if len(self.histories) >= self.max_open:
+                self.histories.popitem(last=False)[1].close()
+            history = ChannelHistory(self, os.path.join(self.directory, escape_file_name(folded_name)))
+            self.histories[folded_name] = history
+        else:
+            self.histories.move_to_end(folded_name)
+        return history
+
+    def append(self, folded_name, data):
+        self.get(folded_name).append(self.timestamp(), data)
+
+    def close(self):
+        for history in self.histories.values():
+            history.close()
+        self.histories.clear()
@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+from nose.tools import assert_equal, assert_is_none
+
+from history import HistoryStore, parse_timestamp, format_timestamp
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def lines(chunks):
+    return b"".join(chunks).decode().splitlines()
+
+
+def texts(chunks):
+    return [x.rsplit(":", 1)[1] for x in lines(chunks)]
+
+
+def fill(store, count, name="#c"):
+    for i in range(count):
+        store.clock.now += 1
+        store.append(name, (":n!u@h SENDMSG %s :%d" % (name, i)).encode().ljust(400, b" ") + b"\r\n")
+
+
+class TestTimestamps:
+
+    def test_parse(self):
+        assert_equal(parse_timestamp("2023-11-14T22:13:20Z"), b"2023-11-14T22:13:20.000Z")
+        assert_equal(parse_timestamp("2023-11-14T22:13:20.5Z"), b"2023-11-14T22:13:20.500Z")
+        assert_equal(parse_timestamp("2023-11-14T22:13:20.123456Z"), b"2023-11-14T22:13:20.123Z")
+        assert_is_none(parse_timestamp("yesterday"))
+
+    def test_format(self):
+        assert_equal(format_timestamp(1700000000.25), b"2023-11-14T22:13:20.250Z")
+
+
+class TestHistoryStore:
+
+    def test_queries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, segment_size=2 ** 16, clock=Clock())
+            fill(store, 1000)
+            history = store.get("#c")
+            assert_equal(len(history.segments), 7)
+            latest = lines(history.latest(3))
+            assert_equal([x.split(":")[-1].strip() for x in latest], ["997", "998", "999"])
+            assert_equal(latest[0][:31], "@time=2023-11-14T22:29:58.000Z ")
+            before = texts(history.before(b"2023-11-14T22:13:31.000Z", 5))
+            assert_equal([x.strip() for x in before], ["5", "6", "7", "8", "9"])
+            after = texts(history.after(b"2023-11-14T22:13:31.000Z", 200))
+            assert_equal([x.strip() for x in after], [str(x) for x in range(11, 211)])
+            assert_equal(len(texts(history.latest(500, b"2023-11-14T22:29:50.000Z"))), 10)
+            store.close()
+
+    def test_reopen(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, segment_size=2 ** 16, clock=Clock())
+            fill(store, 300)
+            store.close()
+            store = HistoryStore(directory, segment_size=2 ** 16, clock=Clock())
+            history = store.get("#c")
+            assert_equal([x.strip() for x in texts(history.latest(2))], ["298", "299"])
+            assert_equal(len(lines(history.after(b"2000-01-01T00:00:00.000Z", 1000))), 300)
+            fill(store, 1)
+            assert_equal([x.strip() for x in texts(history.latest(2))], ["299", "0"])
+            store.close()
+
+    def test_retention(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, segment_size=2 ** 16, max_segments=3, retention=100, clock=Clock())
+            fill(store, 1000)
+            history = store.get("#c")
+            assert_equal(len(history.segments), 2)
+            latest = texts(history.latest(1000))
+            assert_equal(len(latest), 101)
+            assert_equal(latest[0].strip(), "899")
+            assert_equal(texts(history.after(b"2000-01-01T00:00:00.000Z", 1000)), latest)
+            assert_equal(texts(history.before(b"2023-11-14T22:28:22.000Z", 1000)), latest[:2])
+            store.close()
+
+    def test_channels_with_similar_names_do_not_share_a_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(directory, segment_size=2 ** 16, clock=Clock())
+            fill(store, 2, "#a_/b")
+            fill(store, 3, "#a/_b")
+            assert_equal(len(lines(store.get("#a_/b").latest(10))), 2)
+            assert_equal(len(lines(store.get("#a/_b").latest(10))), 3)
+            assert_equal(len(os.listdir(directory)), 2)
+            store.close()
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+
+from filenames import escape_file_name
+
+
+class StreamSink(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, data):
+        getattr(sys, self.name).write(data)
+
+    def flush(self):
+        getattr(sys, self.name).flush()
+
+    def close(self):
+        self.flush()
+
+
+class RotatingFile(object):
+
+    def __init__(self, path, max_bytes=0, backups=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def write(self, data):
+        data = data.encode()
+        if self.file is None:
+            self.open()
+        if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            source = "%s.%d" % (self.path, i)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+        self.open()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def channel_log_name(channel_name):
+    return escape_file_name(channel_name) + ".log"
+
+
+class LogWriter(object):
+
+    def __init__(self, path=None, format="text", max_bytes=0, backups=0, channel_dir=None, max_pending=100000, batch_size=1000, max_open_files=64):
+        self.path = path
+        self.format = format
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.channel_dir = channel_dir
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.dropped = 0
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.__reported_dropped = 0
+        self.__sinks = {}
+        self.__channel_sinks = collections.OrderedDict()
+
+    def log(self, level, msg, args=(), fields=None):
+        self.__put((time.time(), level, None, msg, args, fields))
+
+    def channel(self, channel_name, msg, args=(), fields=None):
+        if self.channel_dir is not None:
+            self.__put((time.time(), "info", channel_name, msg, args, fields))
+
+    def __put(self, record):
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run, name="log-writer", daemon=True)
+            self.thread.start()
+        self.queue.put(record)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def format_record(self, record):
+        (timestamp, level, channel_name, msg, args, fields) = record
+        text = msg % args if args else msg
+        if self.format == "json":
+            data = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".%03dZ" % (timestamp % 1 * 1000),
+                "level": level,
+                "message": text,
+            }
+            if channel_name is not None:
+                data["channel"] = channel_name
+            if fields:
+                data.update(fields)
+            return json.dumps(data, ensure_ascii=False) + "\n"
+        if channel_name is not None:
+            return "[%s] %s\n" % (time.strftime("%H:%M:%S", time.localtime(timestamp)), text)
+        if self.path is not None:
+            return "%s %s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), level.upper(), text)
+        return text + "\n"
+
+    def __sink(self, level, channel_name):
+        if channel_name is not None:
+            sink = self.__channel_sinks.get(channel_name)
+            if sink is None:
+                if len(self.__channel_sinks) >= self.max_open_files:
+                    self.__channel_sinks.popitem(last=False)[1].close()
+                path = os.path.join(self.channel_dir, channel_log_name(channel_name))
+                sink = self.__channel_sinks[channel_name] = RotatingFile(path, self.max_bytes, self.backups)
+            else:
+                self.__channel_sinks.move_to_end(channel_name)
+            return sink
+        if self.path is not None:
+            key = "file"
+        elif level == "error":
+            key = "stderr"
+        else:
+            key = "stdout"
+        sink = self.__sinks.get(key)
+        if sink is None:
+            if key == "file":
+                sink = RotatingFile(self.path, self.max_bytes, self.backups)
+            else:
+                sink = StreamSink(key)
+            self.__sinks[key] = sink
+        return sink
+
+    def __write(self, record, touched):
+        sink = self.__sink(record[1], record[2])
+        try:
+            sink.write(self.format_record(record))
+        except OSError as e:
+            sys.stderr.write("Could not write log record: %s\n" % e)
+            return
+        touched.add(sink)
+
+    def __run(self):
+        records = self.queue
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            touched = set()
+            stop = False
+            for record in batch:
+                if record is None:
+                    stop = True
+                    continue
+                self.__write(record, touched)
+            dropped = self.dropped
+            if dropped != self.__reported_dropped:
+                self.__write((time.time(), "error", None, "Dropped %d log records.", (dropped - self.__reported_dropped,), None), touched)
+                self.__reported_dropped = dropped
+            for sink in touched:
+                try:
+                    sink.flush()
+                except OSError as e:
+                    sys.stderr.write("Could not flush log: %s\n" % e)
+            if stop:
+                for sink in list(self.__sinks.values()) + list(self.__channel_sinks.values()):
+                    sink.close()
+                self.__sinks.clear()
+                self.__channel_sinks.clear()
+                return
@@ -0,0 +1,70 @@
+import os
+import json
+import tempfile
+
+from nose.tools import assert_equal, assert_not_equal, assert_true
+
+from logwriter import LogWriter, RotatingFile, channel_log_name
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestRotatingFile:
+
+    def test_rotate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "chat.log")
+            f = RotatingFile(path, max_bytes=10, backups=2)
+            for line in ("first\n", "second\n", "third\n", "fourth\n"):
+                f.write(line)
+            f.close()
+            assert_equal(read(path), "fourth\n")
+            assert_equal(read(path + ".1"), "third\n")
+            assert_equal(read(path + ".2"), "second\n")
+            assert_true(not os.path.exists(path + ".3"))
+
+    def test_rotate_without_backups(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "chat.log")
+            f = RotatingFile(path, max_bytes=10)
+            f.write("first\n")
+            f.write("second\n")
+            f.close()
+            assert_equal(read(path), "second\n")
+            assert_equal(os.listdir(directory), ["chat.log"])
+
+
+class TestLogWriter:
+
+    def test_close_writes_pending_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "chat.log")
+            log = LogWriter(path)
+            for i in range(1000):
+                log.log("info", "record %d", (i,))
+            log.close()
+            lines = read(path).splitlines()
+            assert_equal(len(lines), 1000)
+            assert_true(lines[-1].endswith(" INFO record 999"))
+
+    def test_json_channel_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = LogWriter(format="json", channel_dir=directory)
+            log.channel("#a_b", "<%s> %s", ("nick", "hello"), {"nick": "nick"})
+            log.close()
+            record = json.loads(read(os.path.join(directory, "#a_b.log")))
+            assert_equal(record["message"], "<nick> hello")
+            assert_equal(record["channel"], "#a_b")
+            assert_equal(record["nick"], "nick")
+
+    def test_channel_log_disabled(self):
+        log = LogWriter()
+        log.channel("#a", "ignored")
+        assert_equal(log.thread, None)
+
+    def test_channel_log_name(self):
+        assert_equal(channel_log_name("#a_b/c"), "#a_b%2Fc.log")
+        assert_not_equal(channel_log_name("#a_/b"), channel_log_name("#a/_b"))
@@ -0,0 +1,229 @@
+import os
+import socket
+import time
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+SIZE_BUCKETS = (0, 512, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        total = 0
+        for (i, count) in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def cumulative(self):
+        total = 0
+        for (bound, count) in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield (bound, total)
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics(object):
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = time.time()
+        self.commands = {}
+        self.loop_time = Histogram(LATENCY_BUCKETS)
+        self.ready_fds = Histogram(COUNT_BUCKETS)
+        self.idle_polls = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections_accepted = 0
+        self.connections_refused = 0
+        self.fanout_direct = 0
+        self.fanout_queued = 0
+        self.fanout_lag = Histogram(LATENCY_BUCKETS)
+
+    def command_histogram(self, command):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram(LATENCY_BUCKETS)
+        return histogram
+
+    def sendq_histogram(self, server):
+        histogram = Histogram(SIZE_BUCKETS)
+        for client in server.clients.values():
+            histogram.observe(client.write_queue_size())
+        return histogram
+
+    def render(self, server):
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        def histogram(name, h, labels=""):
+            separator = "," if labels else ""
+            for (bound, total) in h.cumulative():
+                lines.append("%s_bucket{%s%sle=\"%s\"} %d" % (name, labels, separator, format_bound(bound), total))
+            labels = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %r" % (name, labels, float(h.sum)))
+            lines.append("%s_count%s %d" % (name, labels, h.count))
+
+        family("chat_command_duration_seconds", "histogram", "Time spent in command handlers.")
+        for command in sorted(self.commands):
+            histogram("chat_command_duration_seconds", self.commands[command], "command=\"%s\"" % escape_label(command))
+        family("chat_loop_iteration_seconds", "histogram", "Time spent handling the events of one event loop iteration.")
+        histogram("chat_loop_iteration_seconds", self.loop_time)
+        family("chat_loop_idle_iterations_total", "counter", "Event loop iterations with no ready file descriptors or tasks; these are not included in the loop histograms.")
+        lines.append("chat_loop_idle_iterations_total %d" % self.idle_polls)
+        family("chat_loop_ready_fds", "histogram", "File descriptors ready per event loop iteration.")
+        histogram("chat_loop_ready_fds", self.ready_fds)
+        family("chat_sendq_bytes", "histogram", "Unsent bytes queued per connection at scrape time.")
+        histogram("chat_sendq_bytes", self.sendq_histogram(server))
+        family("chat_received_bytes_total", "counter", "Bytes received from clients.")
+        lines.append("chat_received_bytes_total %d" % self.bytes_received)
+        family("chat_sent_bytes_total", "counter", "Bytes sent to clients.")
+        lines.append("chat_sent_bytes_total %d" % self.bytes_sent)
+        family("chat_accepted_connections_total", "counter", "Connections accepted.")
+        lines.append("chat_accepted_connections_total %d" % self.connections_accepted)
+        family("chat_refused_connections_total", "counter", "Connections refused by the client limits.")
+        lines.append("chat_refused_connections_total %d" % self.connections_refused)
+        family("chat_connections", "gauge", "Open client connections.")
+        lines.append("chat_connections %d" % len(server.clients))
+        family("chat_users", "gauge", "Registered nicknames.")
+        lines.append("chat_users %d" % len(server.nicknames))
+        family("chat_channels", "gauge", "Channels with at least one member.")
+        lines.append("chat_channels %d" % len(server.channels))
+        family("chat_fanout_messages_total", "counter", "Channel messages by delivery path.")
+        lines.append("chat_fanout_messages_total{path=\"direct\"} %d" % self.fanout_direct)
+        lines.append("chat_fanout_messages_total{path=\"queued\"} %d" % self.fanout_queued)
+        family("chat_fanout_queued_jobs", "gauge", "Channel messages waiting for delivery.")
+        lines.append("chat_fanout_queued_jobs %d" % len(server.fanout))
+        family("chat_fanout_queued_deliveries", "gauge", "Channel members still to receive a queued message.")
+        lines.append("chat_fanout_queued_deliveries %d" % server.fanout.pending)
+        family("chat_fanout_lag_seconds", "histogram", "Time from queueing a channel message to its last delivery.")
+        histogram("chat_fanout_lag_seconds", self.fanout_lag)
+        family("chat_timers", "gauge", "Pending timers.")
+        lines.append("chat_timers %d" % len(server.timers))
+        family("chat_tasks", "gauge", "Pending server tasks.")
+        lines.append("chat_tasks %d" % len(server.tasks))
+        family("chat_start_time_seconds", "gauge", "Start time of the server since the Unix epoch.")
+        lines.append("chat_start_time_seconds %r" % self.started)
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsConnection(object):
+    __slots__ = ("endpoint", "connection", "request", "response")
+
+    def __init__(self, endpoint, connection):
+        self.endpoint = endpoint
+        self.connection = connection
+        self.request = b""
+        self.response = None
+
+    def readable(self):
+        try:
+            data = self.connection.recv(4096)
+        except BlockingIOError:
+            return
+        except socket.error:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.request += data
+        if b"\r\n\r\n" in self.request or b"\n\n" in self.request:
+            self.respond()
+        elif len(self.request) > 8192:
+            self.close()
+
+    def respond(self):
+        request_line = self.request.split(b"\n", 1)[0].split()
+        path = request_line[1].split(b"?", 1)[0] if len(request_line) > 1 else b""
+        if request_line[:1] != [b"GET"]:
+            (status, body) = ("405 Method Not Allowed", b"")
+        elif path not in (b"/", b"/metrics"):
+            (status, body) = ("404 Not Found", b"")
+        else:
+            server = self.endpoint.server
+            (status, body) = ("200 OK", server.metrics.render(server).encode())
+        header = "HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))
+        self.response = memoryview(header.encode() + body)
+        self.endpoint.server.engine.watch(self.connection, on_writable=self.writable)
+        self.writable()
+
+    def writable(self):
+        try:
+            sent = self.connection.send(self.response)
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.close()
+            return
+        self.response = self.response[sent:]
+        if not self.response:
+            self.close()
+
+    def close(self):
+        self.endpoint.server.engine.unwatch(self.connection)
+        self.connection.close()
+
+
+class MetricsEndpoint(object):
+
+    def __init__(self, server, address, sock=None):
+        self.server = server
+        self.address = address
+        if sock is not None:
+            self.socket = sock
+        elif "/" in address:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(address)
+        else:
+            (host, _, port) = address.rpartition(":")
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host or "127.0.0.1", int(port)))
+        if sock is None:
+            self.socket.listen(16)
+        self.socket.setblocking(False)
+
+    def start(self):
+        self.server.engine.watch(self.socket, self.accept)
+
+    def accept(self):
+        try:
+            (connection, _) = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.setblocking(False)
+        self.server.engine.watch(connection, MetricsConnection(self, connection).readable)
@@ -0,0 +1,47 @@
+from nose.tools import assert_equal, assert_in, assert_is_none
+
+import chat
+from metrics import Histogram, Metrics
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        h = Histogram((1, 10, 100))
+        for value in (0, 1, 5, 50, 500):
+            h.observe(value)
+        assert_equal(h.counts, [2, 1, 1, 1])
+        assert_equal(h.count, 5)
+        assert_equal(h.sum, 556)
+
+    def test_cumulative(self):
+        h = Histogram((1, 10))
+        for value in (1, 5, 50):
+            h.observe(value)
+        assert_equal(list(h.cumulative()), [(1, 1), (10, 2), (float("inf"), 3)])
+
+    def test_quantile(self):
+        h = Histogram((1, 10, 100))
+        assert_is_none(h.quantile(0.5))
+        for value in [1] * 98 + [50, 500]:
+            h.observe(value)
+        assert_equal(h.quantile(0.5), 1)
+        assert_equal(h.quantile(0.99), 100)
+        assert_equal(h.quantile(1.0), float("inf"))
+
+
+class TestMetrics:
+
+    def test_render(self):
+        (options, _) = chat.option_parser().parse_args(["--listen=127.0.0.1"])
+        server = chat.Server(options)
+        metrics = Metrics()
+        metrics.command_histogram("JOIN").observe(0.0002)
+        metrics.bytes_received = 42
+        lines = metrics.render(server).splitlines()
+        assert_in("# TYPE chat_command_duration_seconds histogram", lines)
+        assert_in("chat_command_duration_seconds_bucket{command=\"JOIN\",le=\"0.00025\"} 1", lines)
+        assert_in("chat_command_duration_seconds_bucket{command=\"JOIN\",le=\"+Inf\"} 1", lines)
+        assert_in("chat_command_duration_seconds_count{command=\"JOIN\"} 1", lines)
+        assert_in("chat_received_bytes_total 42", lines)
+        assert_in("chat_users 0", lines)
@@ -2,6 +2,6 @@ from setuptools import setup
 
 
 setup(
-    use_scm_version=True,
+    use_scm_version={"write_to": "version.py"},
     setup_requires=['setuptools_scm'],
 )
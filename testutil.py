@@ -0,0 +1,42 @@
+import socket
+
+import chat
+
+
+def make_server(*args):
+    (options, _) = chat.option_parser().parse_args(["--listen=127.0.0.1", "--flood-rate=0"] + list(args))
+    return chat.Server(options)
+
+
+def connect(server, buffer_size=None):
+    (connection, peer) = socket.socketpair()
+    if buffer_size is not None:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    connection.setblocking(False)
+    peer.setblocking(False)
+    client = server.add_client(connection, ("127.0.0.1", 0))
+    return (client, peer)
+
+
+def make_client(server, nickname, user=None, real_name=None):
+    (client, peer) = connect(server)
+    client.data_received(("NICK %s\r\nUSER %s * * :%s\r\n" % (nickname, user or nickname, real_name or nickname)).encode())
+    return (client, peer)
+
+
+def read_output(client, peer):
+    client.socket_writable_notification()
+    try:
+        return peer.recv(2 ** 20)
+    except BlockingIOError:
+        return b""
+
+
+def received(client, peer):
+    return read_output(client, peer).decode()
+
+
+def run_tasks(server):
+    while server.tasks:
+        server.run_tasks()
@@ -0,0 +1,88 @@
+import time
+
+
+class Timer(object):
+    __slots__ = ("tick", "callback", "args", "active")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+
+class TimerWheel(object):
+
+    def __init__(self, resolution=1.0, slots=512, clock=time.monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        self.__slots = [[] for _ in range(slots)]
+        self.__tick = int(clock() / resolution)
+        self.__next_tick = None
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def schedule(self, delay, callback, *args):
+        tick = -int(-(self.clock() + delay) // self.resolution)
+        tick = max(tick, self.__tick + 1)
+        timer = Timer(tick, callback, args)
+        self.__slots[tick % len(self.__slots)].append(timer)
+        self.__count += 1
+        if self.__next_tick is not None and tick < self.__next_tick:
+            self.__next_tick = tick
+        return timer
+
+    def cancel(self, timer):
+        if timer.active:
+            timer.active = False
+            self.__count -= 1
+
+    def next_timeout(self, now=None):
+        if not self.__count:
+            return None
+        if now is None:
+            now = self.clock()
+        if self.__next_tick is None:
+            self.__next_tick = self.__find_next_tick()
+        return max(0.0, self.__next_tick * self.resolution - now)
+
+    def __find_next_tick(self):
+        slots = self.__slots
+        for tick in range(self.__tick + 1, self.__tick + 1 + len(slots)):
+            for timer in slots[tick % len(slots)]:
+                if timer.active and timer.tick <= tick:
+                    return tick
+        return min(timer.tick for slot in slots for timer in slot if timer.active)
+
+    def run(self, now=None):
+        if now is None:
+            now = self.clock()
+        target = int(now / self.resolution)
+        if target <= self.__tick:
+            return
+        slots = self.__slots
+        due = []
+        for tick in range(self.__tick + 1, self.__tick + 1 + min(target - self.__tick, len(slots))):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            pending = []
+            for timer in slot:
+                if not timer.active:
+                    continue
+                if timer.tick <= target:
+                    due.append(timer)
+                else:
+                    pending.append(timer)
+            slot[:] = pending
+        if target - self.__tick > len(slots):
+            due.sort(key=lambda timer: timer.tick)
+        self.__tick = target
+        self.__next_tick = None
+        for timer in due:
+            if timer.active:
+                timer.active = False
+                self.__count -= 1
+                timer.callback(*timer.args)
@@ -0,0 +1,62 @@
+from nose.tools import assert_equal
+
+from timers import TimerWheel
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel:
+
+    def setup_wheel(self, slots=8):
+        self.clock = FakeClock()
+        self.fired = []
+        return TimerWheel(resolution=1.0, slots=slots, clock=self.clock)
+
+    def test_fires_when_due(self):
+        wheel = self.setup_wheel()
+        wheel.schedule(2.5, self.fired.append, "a")
+        wheel.schedule(1, self.fired.append, "b")
+        assert_equal(wheel.next_timeout(), 1.0)
+        self.clock.now += 1
+        wheel.run()
+        assert_equal(self.fired, ["b"])
+        assert_equal(wheel.next_timeout(), 2.0)
+        self.clock.now += 2
+        wheel.run()
+        assert_equal(self.fired, ["b", "a"])
+        assert_equal(wheel.next_timeout(), None)
+
+    def test_cancel(self):
+        wheel = self.setup_wheel()
+        timer = wheel.schedule(1, self.fired.append, "a")
+        wheel.cancel(timer)
+        assert_equal(len(wheel), 0)
+        self.clock.now += 5
+        wheel.run()
+        assert_equal(self.fired, [])
+
+    def test_delay_longer_than_one_rotation(self):
+        wheel = self.setup_wheel(slots=4)
+        wheel.schedule(10, self.fired.append, "a")
+        assert_equal(wheel.next_timeout(), 10.0)
+        self.clock.now += 6
+        wheel.run()
+        assert_equal(self.fired, [])
+        self.clock.now += 4
+        wheel.run()
+        assert_equal(self.fired, ["a"])
+
+    def test_long_sleep_fires_everything_due(self):
+        wheel = self.setup_wheel(slots=4)
+        for delay in range(1, 10):
+            wheel.schedule(delay, self.fired.append, delay)
+        self.clock.now += 100
+        wheel.run()
+        assert_equal(self.fired, list(range(1, 10)))
@@ -0,0 +1,139 @@
+import re
+import itertools
+
+
+WILDCARDS = re.compile(r"[*?]")
+
+
+def has_wildcards(mask):
+    return WILDCARDS.search(mask) is not None
+
+
+def literal_prefix(mask):
+    return WILDCARDS.split(mask, 1)[0]
+
+
+class TrieNode(object):
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+class NicknameTrie(object):
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __find(self, key):
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def get(self, key):
+        node = self.__find(key)
+        return None if node is None else node.value
+
+    def insert(self, key, value):
+        node = self.root
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = TrieNode()
+            node = child
+        if node.value is None:
+            self.size += 1
+        node.value = value
+
+    def remove(self, key, value):
+        path = [self.root]
+        for char in key:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].value is not value:
+            return
+        path[-1].value = None
+        self.size -= 1
+        for i in range(len(key), 0, -1):
+            node = path[i]
+            if node.value is not None or node.children:
+                break
+            del path[i - 1].children[key[i - 1]]
+
+    def items(self, prefix="", after=None):
+        node = self.__find(prefix)
+        if node is None:
+            return iter(())
+        if after is not None and not after.startswith(prefix):
+            if after < prefix:
+                after = None
+            else:
+                return iter(())
+        return self.__walk(node, prefix, after)
+
+    def __walk(self, node, key, after):
+        if node.value is not None and (after is None or key > after):
+            yield (key, node.value)
+        for char in sorted(node.children):
+            child_key = key + char
+            if after is None:
+                yield from self.__walk(node.children[char], child_key, None)
+                continue
+            bound = after[:len(child_key)]
+            if child_key < bound:
+                continue
+            yield from self.__walk(node.children[char], child_key, after if child_key == bound else None)
+
+
+class UserIndex(object):
+
+    def __init__(self):
+        self.nicknames = NicknameTrie()
+        self.hosts = {}
+        self.users = {}
+
+    def __len__(self):
+        return len(self.nicknames)
+
+    def add(self, client):
+        self.nicknames.insert(client.folded_nickname, client)
+        self.hosts.setdefault(client.host.lower(), set()).add(client)
+        self.users.setdefault(client.user.lower(), set()).add(client)
+
+    def remove(self, client):
+        self.nicknames.remove(client.folded_nickname, client)
+        for (table, key) in [(self.hosts, client.host.lower()), (self.users, client.user.lower())]:
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(client)
+                if not bucket:
+                    del table[key]
+
+    def rename(self, client, old_folded_nickname):
+        self.nicknames.remove(old_folded_nickname, client)
+        self.nicknames.insert(client.folded_nickname, client)
+
+    def search(self, nickname_prefix="", host=None, user=None, batch_size=100):
+        if host is not None or user is not None:
+            bucket = list(self.hosts.get(host, ()) if host is not None else self.users.get(user, ()))
+            for i in range(0, len(bucket), batch_size):
+                yield bucket[i:i + batch_size]
+            return
+        after = None
+        while True:
+            batch = list(itertools.islice(self.nicknames.items(nickname_prefix, after), batch_size))
+            if batch:
+                yield [value for (_, value) in batch]
+            if len(batch) < batch_size:
+                return
+            after = batch[-1][0]
@@ -0,0 +1,148 @@
+from nose.tools import assert_equal, assert_in, assert_is, assert_is_none, assert_not_in, assert_true
+
+from testutil import make_client, make_server, received, run_tasks
+from userindex import NicknameTrie, UserIndex
+
+
+class User(object):
+
+    def __init__(self, nickname, user="user", host="host"):
+        self.nickname = nickname
+        self.folded_nickname = nickname
+        self.user = user
+        self.host = host
+
+
+class TestNicknameTrie:
+
+    def test_items_are_sorted_and_resumable(self):
+        trie = NicknameTrie()
+        for key in ["bob", "al", "alice", "alex", "b", "carol"]:
+            trie.insert(key, key.upper())
+        assert_equal([x for (x, _) in trie.items()], ["al", "alex", "alice", "b", "bob", "carol"])
+        assert_equal([x for (x, _) in trie.items("al")], ["al", "alex", "alice"])
+        assert_equal([x for (x, _) in trie.items("al", "alex")], ["alice"])
+        assert_equal([x for (x, _) in trie.items("", "alf")], ["alice", "b", "bob", "carol"])
+        assert_equal([x for (x, _) in trie.items("b", "a")], ["b", "bob"])
+        assert_equal(list(trie.items("b", "c")), [])
+        assert_equal(list(trie.items("d")), [])
+
+    def test_remove_prunes_nodes(self):
+        trie = NicknameTrie()
+        trie.insert("alice", 1)
+        trie.insert("al", 2)
+        trie.remove("alice", 3)
+        assert_equal(trie.get("alice"), 1)
+        trie.remove("alice", 1)
+        assert_is_none(trie.get("alice"))
+        assert_equal(len(trie), 1)
+        assert_equal(list(trie.root.children["a"].children["l"].children), [])
+
+
+class TestUserIndex:
+
+    def test_search(self):
+        index = UserIndex()
+        users = [User("u%03d" % i, host="host%d" % (i % 2)) for i in range(250)]
+        for user in users:
+            index.add(user)
+        batches = list(index.search(batch_size=100))
+        assert_equal([len(x) for x in batches], [100, 100, 50])
+        assert_equal(sum(batches, []), users)
+        assert_equal(len(sum(index.search(host="host1"), [])), 125)
+        assert_equal(sum(index.search("u01"), []), users[10:20])
+        index.remove(users[0])
+        index.rename(users[1], "u001")
+        assert_not_in("host0", [x.host for x in sum(index.search("u000"), [])])
+        assert_equal(len(index), 249)
+
+
+class TestWhoCommand:
+
+    def test_who_mask(self):
+        server = make_server()
+        (john, peer) = make_client(server, "john", "jsmith", "John Smith")
+        make_client(server, "jack", "jack", "Jack")
+        make_client(server, "mary", "mary", "Mary")
+        john.data_received(b"WHO j*\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_in(" 352 john * jsmith 127.0.0.1 %s john H :0 John Smith\r\n" % server.name, output)
+        assert_in(" jack H :0 Jack\r\n", output)
+        assert_not_in("mary", output)
+        assert_true(output.endswith(" 315 john j* :End of WHO list\r\n"))
+        john.data_received(b"WHO *@127.0.0.1\r\nWHO *smith* r\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_equal(output.count(" 352 "), 4)
+        john.data_received(b"NICK zed\r\nWHO j*\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_equal(output.count(" 352 "), 1)
+
+    def test_who_channel(self):
+        server = make_server()
+        (john, peer) = make_client(server, "john")
+        (jack, _) = make_client(server, "jack")
+        john.data_received(b"JOIN #chan\r\n")
+        jack.data_received(b"JOIN #chan\r\n")
+        received(john, peer)
+        john.data_received(b"WHO #chan\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_in(" 352 john #chan jack ", output)
+        assert_in(" 352 john #chan john ", output)
+
+    def test_output_is_capped(self):
+        server = make_server("--who-limit=3")
+        (john, peer) = make_client(server, "john")
+        for i in range(5):
+            make_client(server, "user%d" % i)
+        john.data_received(b"WHO user*\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_equal(output.count(" 352 "), 3)
+        assert_in(" 416 john WHO :Output too long\r\n", output)
+
+    def test_output_waits_for_the_send_queue_outside_the_task_list(self):
+        server = make_server("--max-sendq=12000", "--who-limit=1000")
+        (john, peer) = make_client(server, "john")
+        for i in range(250):
+            make_client(server, "user%03d" % i)
+        received(john, peer)
+        john.data_received(b"WHO user*\r\n")
+        output = ""
+        parked = 0
+        while "315 john" not in output:
+            server.run_tasks()
+            if john.write_queue_size() > server.max_sendq // 2:
+                assert_equal(len(server.tasks), 0)
+                parked += 1
+            output += received(john, peer)
+        assert_true(parked >= 2)
+        assert_equal(output.count(" 352 "), 250)
+
+    def test_disconnect_removes_user(self):
+        server = make_server()
+        (john, peer) = make_client(server, "john")
+        (jack, _) = make_client(server, "jack")
+        jack.data_received(b"QUIT\r\n")
+        assert_is_none(server.user_index.nicknames.get("jack"))
+        assert_is(server.user_index.nicknames.get("john"), john)
+
+    def test_whois(self):
+        server = make_server()
+        (john, peer) = make_client(server, "john", "jsmith", "John Smith")
+        john.data_received(b"JOIN #b,#a\r\n")
+        received(john, peer)
+        john.data_received(b"WHOIS john,nobody\r\n")
+        run_tasks(server)
+        output = received(john, peer)
+        assert_equal(output.splitlines(), [
+            ":%s 311 john john jsmith 127.0.0.1 * :John Smith" % server.name,
+            ":%s 319 john john :#a #b" % server.name,
+            ":%s 312 john john %s :Chat" % (server.name, server.name),
+            ":%s 318 john john :End of WHOIS list" % server.name,
+            ":%s 401 john nobody :No such nick/channel" % server.name,
+            ":%s 318 john nobody :End of WHOIS list" % server.name,
+        ])